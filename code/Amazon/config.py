@@ -3,3 +3,12 @@ s3_bucket_name = "my-disk-export-bucket"
 #exportdisktype= ("vhd", "vmdk", "ova")
 #exportdisktype= "vhd"
 importdesktype= ("vhd", "vhdx", "vmdk", "raw")
+download_method = "export"  # "export" exports the instance as VHD to S3 and downloads it, "ebs_direct" reads the allocated blocks of the snapshot (needs the ebs:ListSnapshotBlocks and ebs:GetSnapshotBlock permissions)
+precopy = False  # True reads a snapshot while the instance still runs, after the stop only the changed blocks are read (needs "ebs_direct")
+ebs_connections = 32  # concurrent GetSnapshotBlock calls
+ebs_endpoint_url = None  # another EBS direct endpoint, e.g. a local stand-in for testing
+s3_endpoint_url = None  # another S3 endpoint, e.g. a local stand-in for testing
+# transfer profile of the S3 download of an export
+s3_multipart_chunksize = 64 * 1024 * 1024  # bytes per ranged part
+s3_max_concurrency = 16  # parts downloaded at the same time, also the size of the connection pool
+s3_max_io_queue = 1000  # parts waiting to be written to disk
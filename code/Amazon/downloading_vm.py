@@ -11,6 +11,237 @@ region = "eu-west-1"
 vm_size = "t3.medium"
 download_path = "C:/aws_disks"
 """
+def ensure_bucket(s3_client, s3_bucket_name, region):
+    """
+    Create the S3 bucket for the disk export when it does not exist yet.
+    """
+    #print(f"Checking S3 bucket: {s3_bucket_name}...")
+    try:
+        s3_client.head_bucket(Bucket=s3_bucket_name)
+        #print("S3 bucket exists")
+    except:
+        #print(f"Creating S3 bucket: {s3_bucket_name}...")
+        if region == 'us-east-1':
+            s3_client.create_bucket(Bucket=s3_bucket_name)
+        else:
+            s3_client.create_bucket(
+                Bucket=s3_bucket_name,
+                CreateBucketConfiguration={'LocationConstraint': region}
+            )
+        #print("S3 bucket created")
+
+
+def s3_client(session, region):
+    """
+    S3 client with a connection pool as large as the transfer concurrency, shared by all parts of a download.
+    """
+    import sys
+    from botocore.config import Config
+    sys.path.append(r"C:/projects/nomadsky/code/Amazon")
+    import config
+
+    return session.client(
+        's3',
+        region_name=region,
+        endpoint_url=getattr(config, 's3_endpoint_url', None),
+        config=Config(max_pool_connections=getattr(config, 's3_max_concurrency', 10))
+    )
+
+
+def s3_transfer_config(object_size=None):
+    """
+    The transfer profile from config.py for multipart S3 downloads.
+    For an object of object_size bytes the parts are made smaller (down to 8 MiB) when there would be fewer
+    parts than connections, so every connection has a part to download.
+    """
+    import sys
+    from boto3.s3.transfer import TransferConfig
+    sys.path.append(r"C:/projects/nomadsky/code/Amazon")
+    import config
+
+    concurrency = getattr(config, 's3_max_concurrency', 10)
+    chunksize = getattr(config, 's3_multipart_chunksize', 8 * 1024 * 1024)
+    if object_size:
+        chunksize = max(8 * 1024 * 1024, min(chunksize, -(-object_size // concurrency)))
+    return TransferConfig(
+        multipart_threshold=chunksize,
+        multipart_chunksize=chunksize,
+        max_concurrency=concurrency,
+        max_io_queue=getattr(config, 's3_max_io_queue', 100),
+        use_threads=True
+    )
+
+
+def download_export(s3, bucket, key, output_path, progress=None):
+    """
+    Download an exported disk from S3 with parallel ranged GETs, with the part size and concurrency of
+    s3_transfer_config(). The finished parts are kept in "<output_path>.ranges", so after a dropped connection
+    or an engine restart the download continues with the missing parts, the export itself is not repeated.
+    The parts are hashed as they are written and compared with the checksum S3 has of the object.
+
+    Returns:
+        int: the size of the object
+    """
+    import sys
+    sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/basic")
+    import ranged_download
+
+    head = s3.head_object(Bucket=bucket, Key=key, ChecksumMode='ENABLED')
+    object_size = head['ContentLength']
+    transfer_config = s3_transfer_config(object_size)
+    # a new url on every attempt, the finished parts do not depend on it
+    url = s3.generate_presigned_url('get_object', Params={'Bucket': bucket, 'Key': key}, ExpiresIn=24 * 3600)
+    return ranged_download.download(
+        url,
+        output_path,
+        size=object_size,
+        connections=transfer_config.max_request_concurrency,
+        range_size=transfer_config.multipart_chunksize,
+        progress=progress,
+        expected=s3_checksums(head)
+    )
+
+
+def root_volume(ec2_client, instance_id):
+    """
+    Returns:
+        tuple: (instance, volume id of the root volume)
+    """
+    response = ec2_client.describe_instances(InstanceIds=[instance_id])
+    instance = response['Reservations'][0]['Instances'][0]
+    for bdm in instance['BlockDeviceMappings']:
+        if bdm['DeviceName'] == instance['RootDeviceName'] and 'Ebs' in bdm:
+            return instance, bdm['Ebs']['VolumeId']
+    raise Exception("Could not find root volume")
+
+
+def wait_for_snapshot(ec2_client, snapshot_id):
+    import time
+
+    while True:
+        snapshot_status = ec2_client.describe_snapshots(SnapshotIds=[snapshot_id])
+        state = snapshot_status['Snapshots'][0]['State']
+        if state == 'completed':
+            return
+        elif state == 'error':
+            raise Exception("Snapshot creation failed")
+        time.sleep(15)
+
+
+def precopy_aws_osdisk(shared_data):
+    """
+    First phase of a warm copy: read a snapshot of the root volume while the instance still runs.
+    download_aws_osdisk() later stops at the blocks that changed since this snapshot.
+    Only possible with download_method "ebs_direct", the export to S3 has no block level diff.
+
+    Returns:
+        dict: message, and precopy_snapshot_id and output_path when the warm copy is enabled in config.py
+    """
+    import sys
+    import os
+    import boto3
+    from datetime import datetime
+
+    sys.path.append(r"C:/projects/nomadsky/code/Amazon")
+    import config
+    import ebs_direct
+    sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/basic")
+    import migration_ledger
+    import progress_events
+
+    vm_name = sys.argv[3].lower()
+    if not getattr(config, 'precopy', False) or getattr(config, 'download_method', 'export') != "ebs_direct":
+        return {'message': "no pre-copy, the disk is downloaded after the VM stopped"}
+
+    region = shared_data.get('region', '')
+    resource_id = shared_data.get('resource_id', '')
+    instance_id = resource_id.split('/')[-1] if resource_id.startswith('arn:') else resource_id
+
+    session = boto3.Session()
+    ec2_client = session.client('ec2', region_name=region)
+
+    # a snapshot of this migration is reused when the engine restarted halfway
+    snapshot_id = migration_ledger.find_artifact('precopy_snapshot_id')
+    output_path = migration_ledger.find_artifact('output_path')
+    if not snapshot_id:
+        instance, volume_id = root_volume(ec2_client, instance_id)
+        snapshot_id = ec2_client.create_snapshot(
+            VolumeId=volume_id,
+            Description=f"Pre-copy snapshot for {vm_name} download - {datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        )['SnapshotId']
+        migration_ledger.record_artifact('precopy_snapshot_id', snapshot_id)
+        output_path = None
+    if not output_path:
+        os.makedirs(config.download_path, exist_ok=True)
+        output_path = os.path.join(config.download_path, f"{vm_name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.raw")
+        migration_ledger.record_artifact('output_path', output_path)
+
+    wait_for_snapshot(ec2_client, snapshot_id)
+    progress = progress_events.ProgressReporter(action="precopy")
+    blocks = ebs_direct.download_snapshot(
+        ebs_direct.ebs_client(session, region),
+        snapshot_id,
+        output_path,
+        connections=getattr(config, 'ebs_connections', 32),
+        progress=progress
+    )
+    progress.done()
+
+    return {
+        'message': f"OS disk of VM '{vm_name}' pre-copied while running",
+        'precopy_snapshot_id': snapshot_id,
+        'output_path': output_path,
+        'allocated_blocks': blocks['blocks']
+    }
+
+
+def s3_checksums(head):
+    """
+    The checksums S3 keeps of a whole object, from head_object(ChecksumMode='ENABLED'): the ETag of an object
+    uploaded in one part without KMS is its MD5, a full object SHA256 when one was given with the upload.
+
+    Returns:
+        dict: {algorithm: hex digest}
+    """
+    import sys
+    sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/basic")
+    import integrity
+
+    checksums = {}
+    etag = head.get('ETag', '').strip('"')
+    if etag and '-' not in etag and head.get('ServerSideEncryption') != 'aws:kms':
+        checksums['md5'] = etag
+    if head.get('ChecksumSHA256') and '-' not in head['ChecksumSHA256']:
+        checksums['sha256'] = integrity.base64_to_hex(head['ChecksumSHA256'])
+    return checksums
+
+
+def prepare_export_bucket(shared_data):
+    """
+    Check or create the S3 bucket of the export before the VM is stopped, so it runs next to the other steps.
+
+    Returns:
+        dict: Result containing message and the bucket name
+    """
+    import sys
+    import boto3
+
+    sys.path.append(r"C:/projects/nomadsky/code/Amazon")
+    import config
+
+    if getattr(config, 'download_method', 'export') == "ebs_direct":
+        return {'message': "the snapshot is read with the EBS direct APIs, no S3 bucket needed"}
+
+    region = shared_data.get('region', '')
+    session = boto3.Session()
+    ensure_bucket(s3_client(session, region), config.s3_bucket_name, region)
+    result = {
+        'message': f"S3 bucket '{config.s3_bucket_name}' is ready for the export",
+        's3_bucket_name': config.s3_bucket_name
+    }
+    return result
+
+
 def download_aws_osdisk(shared_data):
     """
     Download OS disk from a deallocated AWS EC2 instance.
@@ -30,6 +261,9 @@ def download_aws_osdisk(shared_data):
 
     sys.path.append(r"C:/projects/nomadsky/code/Amazon")
     import config
+    import ebs_direct
+    sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/basic")
+    import migration_ledger
     
     # Get parameters from config
     source = sys.argv[1]
@@ -55,53 +289,46 @@ def download_aws_osdisk(shared_data):
     # Define output path
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     output_vhd_path = os.path.join(download_path, f"{vm_name}_{timestamp}.vhd")
+    # A resumed migration finds the disk it downloaded before the restart
+    output_vhd_path = migration_ledger.find_artifact('output_path') or output_vhd_path
     
-    # Check if already downloaded
-    if os.path.exists(output_vhd_path):
+    # A warm copy read the disk while the instance ran, only the blocks that changed since then are left
+    precopy_snapshot_id = migration_ledger.find_artifact('precopy_snapshot_id')
+
+    # Check if already downloaded, a snapshot read that did not finish is continued below
+    if os.path.exists(output_vhd_path) and not ebs_direct.is_partial(output_vhd_path) and not precopy_snapshot_id:
         result = {
             'message': f"VM '{vm_name}' OS disk already downloaded!",
             'vm_name': vm_name,
             'vm_size': vm_size,
             'resource_id': resource_id,
             'storage_location': output_vhd_path,
+            'output_path': output_vhd_path,
             'file_size_gb': round(os.path.getsize(output_vhd_path) / (1024**3), 2),
             'status': 'already_exists'
         }
         #print(f"OS disk already exists at: {output_vhd_path}")
         return result
     
-    # Check for any existing files with same VM name
-    existing_files = [f for f in os.listdir(download_path) if f.startswith(vm_name) and f.endswith('.vhd')]
-    if existing_files:
-        existing_path = os.path.join(download_path, existing_files[0])
-        result = {
-            'message': f"VM '{vm_name}' OS disk already downloaded!",
-            'vm_name': vm_name,
-            'vm_size': vm_size,
-            'resource_id': resource_id,
-            'storage_location': existing_path,
-            'file_size_gb': round(os.path.getsize(existing_path) / (1024**3), 2),
-            'status': 'already_exists'
-        }
-        #print(f"OS disk already exists at: {existing_path}")
-        return result
+    # A disk downloaded by an earlier migration of this instance is found by the artifact cache of the download step
     
     #print(f"Downloading OS disk for VM '{vm_name}' (Instance: {instance_id})...")
     
     # Interactive login via boto3
     session = boto3.Session()
     ec2_client = session.client('ec2', region_name=region)
-    s3_client = session.client('s3', region_name=region)
+    s3 = s3_client(session, region)
     
     snapshot_id = None
     export_task_id = None
     s3_key = None
+    reading = False  # the blocks of the snapshot are being read, it is kept on an error so a retry continues
+    exported = False  # the export is in S3, it is kept on an error so a retry continues the download
     
     try:
-        # Get instance details
+        # Get instance details and the root volume
         #print("Checking instance state...")
-        response = ec2_client.describe_instances(InstanceIds=[instance_id])
-        instance = response['Reservations'][0]['Instances'][0]
+        instance, volume_id = root_volume(ec2_client, instance_id)
         
         # Check if instance is stopped/deallocated
         state = instance['State']['Name']
@@ -110,83 +337,147 @@ def download_aws_osdisk(shared_data):
         
         #print(f"Instance state: {state}")
         
-        # Get root volume ID
-        root_device = instance['RootDeviceName']
-        volume_id = None
-        
-        for bdm in instance['BlockDeviceMappings']:
-            if bdm['DeviceName'] == root_device and 'Ebs' in bdm:
-                volume_id = bdm['Ebs']['VolumeId']
-                break
-        
-        if not volume_id:
-            raise Exception("Could not find root volume")
-        
         #print(f"Root volume ID: {volume_id}")
         
         # Get volume size
         volume_details = ec2_client.describe_volumes(VolumeIds=[volume_id])
         volume_size_gb = volume_details['Volumes'][0]['Size']
         
-        # Create or verify S3 bucket
-        #print(f"Checking S3 bucket: {s3_bucket_name}...")
-        try:
-            s3_client.head_bucket(Bucket=s3_bucket_name)
-            #print("S3 bucket exists")
-        except:
-            #print(f"Creating S3 bucket: {s3_bucket_name}...")
-            if region == 'us-east-1':
-                s3_client.create_bucket(Bucket=s3_bucket_name)
-            else:
-                s3_client.create_bucket(
-                    Bucket=s3_bucket_name,
-                    CreateBucketConfiguration={'LocationConstraint': region}
-                )
-            #print("S3 bucket created")
-        
-        # Create snapshot of the volume
-        #print("Creating snapshot of OS disk...")
-        snapshot_response = ec2_client.create_snapshot(
-            VolumeId=volume_id,
-            Description=f"Snapshot for {vm_name} download - {timestamp}"
-        )
-        snapshot_id = snapshot_response['SnapshotId']
+        # Reuse the snapshot of this migration when the engine restarted halfway
+        snapshot_id = migration_ledger.find_artifact('snapshot_id')
+        if snapshot_id:
+            try:
+                ec2_client.describe_snapshots(SnapshotIds=[snapshot_id])
+            except Exception:
+                snapshot_id = None
+
+        if not snapshot_id:
+            # Create snapshot of the volume
+            #print("Creating snapshot of OS disk...")
+            snapshot_response = ec2_client.create_snapshot(
+                VolumeId=volume_id,
+                Description=f"Snapshot for {vm_name} download - {timestamp}"
+            )
+            snapshot_id = snapshot_response['SnapshotId']
+            migration_ledger.record_artifact('snapshot_id', snapshot_id)
         
         #print(f"Snapshot created: {snapshot_id}. Waiting for completion...")
         
-        # Wait for snapshot to complete (with progress updates)
-        while True:
-            snapshot_status = ec2_client.describe_snapshots(SnapshotIds=[snapshot_id])
-            progress = snapshot_status['Snapshots'][0]['Progress']
-            state = snapshot_status['Snapshots'][0]['State']
-            
-            #print(f"Snapshot progress: {progress} - State: {state}")
-            
-            if state == 'completed':
-                #print("Snapshot completed!")
-                break
-            elif state == 'error':
-                raise Exception("Snapshot creation failed")
-            
-            time.sleep(15)
-        
-        # Export snapshot to S3
-        #print("Starting export to S3...")
-        s3_key = f"exports/{vm_name}_{timestamp}.vhd"
-        
-        export_response = ec2_client.create_instance_export_task(
-            Description=f"Export {vm_name} OS disk",
-            ExportToS3Task={
-                'DiskImageFormat': 'VHD',
-                'S3Bucket': s3_bucket_name,
-                'S3Prefix': f'exports/{vm_name}_{timestamp}'
-            },
-            InstanceId=instance_id,
-            TargetEnvironment='microsoft'
-        )
+        # Wait for snapshot to complete
+        wait_for_snapshot(ec2_client, snapshot_id)
+
+        if precopy_snapshot_id and os.path.exists(output_vhd_path):
+            # Read only the blocks that changed since the pre-copy snapshot into the pre-copied image
+            sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/basic")
+            import progress_events
+            progress = progress_events.ProgressReporter(action="download")
+            reading = True  # both snapshots stay until the delta is applied, a retry continues with the same pair
+            blocks = ebs_direct.download_changed_blocks(
+                ebs_direct.ebs_client(session, region),
+                precopy_snapshot_id,
+                snapshot_id,
+                output_vhd_path,
+                connections=getattr(config, 'ebs_connections', 32),
+                progress=progress
+            )
+            progress.done()
+
+            # Clean up both snapshots
+            for kind, snapshot in (('snapshot_id', snapshot_id), ('precopy_snapshot_id', precopy_snapshot_id)):
+                ec2_client.delete_snapshot(SnapshotId=snapshot)
+                migration_ledger.record_artifact(kind, None)
+
+            result = {
+                'message': f"VM '{vm_name}' OS disk synced, {blocks['changed_blocks']} blocks changed since the pre-copy!",
+                'vm_name': vm_name,
+                'vm_size': vm_size,
+                'resource_id': resource_id,
+                'storage_location': output_vhd_path,
+                'output_path': output_vhd_path,
+                'exportdisktype': 'raw',
+                'file_size_gb': round(blocks['volume_size'] / (1024**3), 2),
+                'disk_size_gb': volume_size_gb,
+                'allocated_blocks': blocks['blocks'],
+                'changed_blocks': blocks['changed_blocks'],
+                'block_manifest': blocks['manifest'],
+                'integrity_manifest': blocks['integrity_manifest'],
+                'volume_id': volume_id,
+                'status': 'download_completed'
+            }
+            return result
+
+        if getattr(config, 'download_method', 'export') == "ebs_direct":
+            # Read the allocated blocks of the snapshot, no export task and no S3 round trip
+            sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/basic")
+            import progress_events
+            if not output_vhd_path.endswith('.raw'):
+                output_vhd_path = os.path.join(download_path, f"{vm_name}_{timestamp}.raw")
+            migration_ledger.record_artifact('output_path', output_vhd_path)
+            progress = progress_events.ProgressReporter(action="download")
+            reading = True
+            blocks = ebs_direct.download_snapshot(
+                ebs_direct.ebs_client(session, region),
+                snapshot_id,
+                output_vhd_path,
+                connections=getattr(config, 'ebs_connections', 32),
+                progress=progress
+            )
+            progress.done()
+
+            # Clean up snapshot (optional - comment out if you want to keep the snapshot)
+            ec2_client.delete_snapshot(SnapshotId=snapshot_id)
+            migration_ledger.record_artifact('snapshot_id', None)
+
+            result = {
+                'message': f"VM '{vm_name}' OS disk read from its snapshot in AWS!",
+                'vm_name': vm_name,
+                'vm_size': vm_size,
+                'resource_id': resource_id,
+                'storage_location': output_vhd_path,
+                'output_path': output_vhd_path,
+                'exportdisktype': 'raw',
+                'file_size_gb': round(blocks['volume_size'] / (1024**3), 2),
+                'disk_size_gb': volume_size_gb,
+                'allocated_blocks': blocks['blocks'],
+                'block_manifest': blocks['manifest'],
+                'integrity_manifest': blocks['integrity_manifest'],
+                'volume_id': volume_id,
+                'status': 'download_completed'
+            }
+            return result
+
+        # Create or verify S3 bucket, normally already done by the prepare step
+        ensure_bucket(s3, s3_bucket_name, region)
         
-        export_task_id = export_response['ExportTask']['ExportTaskId']
-        #print(f"Export task created: {export_task_id}")
+        # Reuse the export task of this migration when the engine restarted halfway
+        export_task_id = migration_ledger.find_artifact('export_task_id')
+        if export_task_id:
+            try:
+                export_state = ec2_client.describe_export_tasks(ExportTaskIds=[export_task_id])['ExportTasks'][0]['State']
+                if export_state in ['cancelled', 'cancelling']:
+                    export_task_id = None
+            except Exception:
+                export_task_id = None
+
+        if not export_task_id:
+            # Export snapshot to S3
+            #print("Starting export to S3...")
+            s3_key = f"exports/{vm_name}_{timestamp}.vhd"
+
+            export_response = ec2_client.create_instance_export_task(
+                Description=f"Export {vm_name} OS disk",
+                ExportToS3Task={
+                    'DiskImageFormat': 'VHD',
+                    'S3Bucket': s3_bucket_name,
+                    'S3Prefix': f'exports/{vm_name}_{timestamp}'
+                },
+                InstanceId=instance_id,
+                TargetEnvironment='microsoft'
+            )
+
+            export_task_id = export_response['ExportTask']['ExportTaskId']
+            migration_ledger.record_artifact('export_task_id', export_task_id)
+            #print(f"Export task created: {export_task_id}")
         
         # Wait for export to complete
         #print("Waiting for export to complete (this may take a while)...")
@@ -209,18 +500,27 @@ def download_aws_osdisk(shared_data):
         export_details = ec2_client.describe_export_tasks(ExportTaskIds=[export_task_id])
         s3_bucket = export_details['ExportTasks'][0]['ExportToS3Task']['S3Bucket']
         s3_key = export_details['ExportTasks'][0]['ExportToS3Task']['S3Key']
+        migration_ledger.record_artifact('s3_key', f"s3://{s3_bucket}/{s3_key}")
+        exported = True
+        # the retry of this step continues in the same partial file
+        migration_ledger.record_artifact('output_path', output_vhd_path)
         
         # Download from S3
         #print(f"Downloading from S3: s3://{s3_bucket}/{s3_key}...")
         #print(f"Saving to: {output_vhd_path}")
         
-        # Download with progress
-        s3_client.download_file(
-            s3_bucket, 
-            s3_key, 
-            output_vhd_path,
-            Callback=lambda bytes_transferred: print(f"Downloaded: {bytes_transferred / (1024**2):.2f} MB", end='\r')
-        )
+        # Download the parts in parallel with the transfer profile of config.py, a retry continues with the parts
+        # that are missing; the progress is rate-limited and goes to the engine instead of stdout.
+        # The file gets its name only when it is complete and matches the checksum S3 has
+        sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/basic")
+        import progress_events
+        import integrity
+        progress = progress_events.ProgressReporter(action="download")
+        partial_path = output_vhd_path + ".part"
+        download_export(s3, s3_bucket, s3_key, partial_path, progress)
+        progress.done()
+        os.replace(partial_path, output_vhd_path)
+        os.replace(integrity.manifest_path(partial_path), integrity.manifest_path(output_vhd_path))
         
         #print(f"\nDownload completed!")
         
@@ -229,22 +529,28 @@ def download_aws_osdisk(shared_data):
         
         # Clean up S3 (optional - comment out if you want to keep the file in S3)
         #print("Cleaning up S3...")
-        s3_client.delete_object(Bucket=s3_bucket, Key=s3_key)
+        s3.delete_object(Bucket=s3_bucket, Key=s3_key)
         
         # Clean up snapshot (optional - comment out if you want to keep the snapshot)
         #print("Cleaning up snapshot...")
         ec2_client.delete_snapshot(SnapshotId=snapshot_id)
-        
+        # the export and the snapshot are gone, a resumed migration must not describe or delete them again
+        migration_ledger.record_artifact('snapshot_id', None)
+        migration_ledger.record_artifact('export_task_id', None)
+        migration_ledger.record_artifact('s3_key', None)
+
         result = {
             'message': f"VM '{vm_name}' OS disk downloaded successfully from AWS!",
             'vm_name': vm_name,
             'vm_size': vm_size,
             'resource_id': resource_id,
             'storage_location': output_vhd_path,
+            'output_path': output_vhd_path,
             'file_size_gb': file_size_gb,
             'disk_size_gb': volume_size_gb,
             'snapshot_id': snapshot_id,
             'volume_id': volume_id,
+            'integrity_manifest': integrity.manifest_path(output_vhd_path),
             'status': 'download_completed'
         }
         
@@ -255,16 +561,27 @@ def download_aws_osdisk(shared_data):
         #print(f"\nError occurred: {str(e)}")
         #print("Cleaning up resources...")
         
+        if exported:
+            # the export in S3, its ledger entries and the finished parts stay: the retry of this step continues the
+            # download instead of waiting hours for a new export
+            raise Exception(f"Failed to download OS disk for VM '{vm_name}', the export s3://{s3_bucket}/{s3_key} is kept to continue: {str(e)}")
+
         try:
             if s3_key:
-                s3_client.delete_object(Bucket=s3_bucket_name, Key=s3_key)
+                s3.delete_object(Bucket=s3_bucket_name, Key=s3_key)
+                migration_ledger.record_artifact('export_task_id', None)
                 #print("S3 object deleted")
         except:
             pass
         
+        if reading:
+            # the snapshot, its ledger entry and the block manifest stay: the retry of this step reads the missing blocks
+            raise Exception(f"Failed to download OS disk for VM '{vm_name}', snapshot {snapshot_id} is kept to continue: {str(e)}")
+
         try:
             if snapshot_id:
                 ec2_client.delete_snapshot(SnapshotId=snapshot_id)
+                migration_ledger.record_artifact('snapshot_id', None)
                 #print("Snapshot deleted")
         except:
             pass
@@ -0,0 +1,348 @@
+"""
+Read an EBS snapshot with the EBS direct APIs (ListSnapshotBlocks / GetSnapshotBlock).
+
+Only the blocks that hold data are listed by AWS, so only those are downloaded. They are fetched with
+many concurrent GetSnapshotBlock calls and written at their offset in a sparse raw image.
+The SHA256 checksum AWS sends with every block is verified, and the checksums of all blocks are kept in
+"<output_path>.blocks.json". That manifest also lets an interrupted download continue with the missing blocks.
+The verified block checksums are the leaves of the integrity manifest of the image, so it needs no extra hashing.
+
+download_changed_blocks() brings such an image from one snapshot to a later snapshot of the same volume: only the
+blocks ListChangedBlocks reports are fetched, or zeroed when they are gone. The blocks are handled page by page,
+10000 at a time, while the next page is listed; the finished blocks are kept in the manifest, so an interrupted
+delta continues where it stopped.
+
+Settings in config.py:
+download_method = "ebs_direct"  # use this instead of the instance export to S3
+ebs_connections = 32            # concurrent GetSnapshotBlock calls
+ebs_endpoint_url = None         # another EBS direct endpoint, e.g. a local stand-in for testing
+"""
+
+
+def manifest_path(output_path):
+    return output_path + ".blocks.json"
+
+
+def is_partial(output_path):
+    """True when a snapshot download to output_path was started but not finished."""
+    import json
+
+    try:
+        with open(manifest_path(output_path)) as f:
+            return not json.load(f).get('complete', False)
+    except (OSError, ValueError):
+        return False
+
+
+def ebs_client(session, region):
+    """An EBS direct client with a connection pool as large as the number of concurrent calls."""
+    import sys
+    from botocore.config import Config
+    sys.path.append(r"C:/projects/nomadsky/code/Amazon")
+    import config
+
+    connections = getattr(config, 'ebs_connections', 32)
+    return session.client(
+        'ebs',
+        region_name=region,
+        endpoint_url=getattr(config, 'ebs_endpoint_url', None),
+        config=Config(max_pool_connections=connections, retries={'max_attempts': 10, 'mode': 'adaptive'})
+    )
+
+
+def list_blocks(client, snapshot_id):
+    """
+    Yield the pages of blocks of a snapshot.
+
+    Returns:
+        iterator of (volume size in GiB, block size in bytes, [(block index, block token)])
+    """
+    next_token = None
+    while True:
+        arguments = {'SnapshotId': snapshot_id, 'MaxResults': 10000}
+        if next_token:
+            arguments['NextToken'] = next_token
+        response = client.list_snapshot_blocks(**arguments)
+        blocks = [(block['BlockIndex'], block['BlockToken']) for block in response.get('Blocks', [])]
+        yield response['VolumeSize'], response['BlockSize'], blocks
+        next_token = response.get('NextToken')
+        if not next_token:
+            return
+
+
+def fetch_block(client, snapshot_id, block_index, block_token, attempts=3):
+    """
+    Get one block and verify its checksum.
+
+    Returns:
+        tuple: (data, base64 SHA256 checksum)
+
+    Raises:
+        Exception: If the checksum does not match after all attempts
+    """
+    import base64
+    import hashlib
+
+    for attempt in range(attempts):
+        response = client.get_snapshot_block(SnapshotId=snapshot_id, BlockIndex=block_index, BlockToken=block_token)
+        data = response['BlockData'].read()
+        checksum = base64.b64encode(hashlib.sha256(data).digest()).decode()
+        if response.get('ChecksumAlgorithm', 'SHA256') != 'SHA256' or response.get('Checksum') in (None, checksum):
+            return data, checksum
+    raise Exception(f"block {block_index} of snapshot {snapshot_id} has a wrong checksum")
+
+
+def write_integrity_manifest(output_path, manifest):
+    """The integrity manifest of the image with the block checksums as leaves, verified by AWS already."""
+    import sys
+    import base64
+    sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/basic")
+    import integrity
+
+    digests = {int(index): base64.b64decode(checksum) for index, checksum in manifest['blocks'].items()}
+    tree = integrity.tree_from_digests(manifest['volume_size'], manifest['block_size'], digests)
+    return integrity.write_manifest(output_path, tree, verified=['ebs-block-sha256'])
+
+
+def _run_parallel(work, items, connections):
+    """
+    Call work(*item) for every item on connections threads, with at most two items per thread waiting.
+    The items are produced while the threads work, so a listing and the downloads overlap.
+
+    Raises:
+        Exception: the first error of a work call, no new items are started after it
+    """
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+
+    in_flight = threading.BoundedSemaphore(connections * 2)
+    failed = []
+
+    def run(item):
+        try:
+            work(*item)
+        except Exception as e:
+            failed.append(e)
+        finally:
+            in_flight.release()
+
+    with ThreadPoolExecutor(max_workers=connections) as executor:
+        for item in items:
+            if failed:
+                break
+            in_flight.acquire()
+            executor.submit(run, item)
+    if failed:
+        raise failed[0]
+
+
+def _load_manifest(output_path):
+    import json
+
+    try:
+        with open(manifest_path(output_path)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _save_manifest(output_path, manifest):
+    import os
+    import json
+
+    temporary = manifest_path(output_path) + ".tmp"
+    with open(temporary, "w") as f:
+        json.dump(manifest, f)
+    os.replace(temporary, manifest_path(output_path))
+
+
+def download_snapshot(client, snapshot_id, output_path, connections=32, progress=None):
+    """
+    Download the allocated blocks of a snapshot into a sparse raw image.
+
+    Args:
+        client: EBS direct client, see ebs_client()
+        snapshot_id: a completed snapshot
+        output_path: the raw image to write
+        connections: concurrent GetSnapshotBlock calls
+        progress: optional progress_events.ProgressReporter, counts the bytes of the allocated blocks
+
+    Returns:
+        dict: volume_size (bytes), block_size, blocks (number of allocated blocks) and manifest (path)
+    """
+    import os
+    import sys
+    import threading
+    sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/basic")
+    import ranged_download
+
+    manifest = {'snapshot_id': snapshot_id, 'complete': False, 'blocks': {}}
+    previous = _load_manifest(output_path)
+    if previous and previous.get('snapshot_id') == snapshot_id and 'delta' not in previous \
+            and os.path.exists(output_path):
+        manifest = previous
+
+    lock = threading.Lock()
+
+    def fetch(block_index, block_token, block_size):
+        data, checksum = fetch_block(client, snapshot_id, block_index, block_token)
+        with open(output_path, "r+b") as f:
+            f.seek(block_index * block_size)
+            f.write(data)
+        with lock:
+            manifest['blocks'][str(block_index)] = checksum
+            if len(manifest['blocks']) % 1000 == 0:
+                _save_manifest(output_path, manifest)
+        if progress is not None:
+            progress.add(len(data))
+
+    def missing_blocks():
+        for volume_size_gib, block_size, blocks in list_blocks(client, snapshot_id):
+            if 'volume_size' not in manifest:
+                manifest['volume_size'] = volume_size_gib * 1024**3
+                manifest['block_size'] = block_size
+                open(output_path, "wb").close()
+                ranged_download.make_sparse(output_path)
+                os.truncate(output_path, manifest['volume_size'])
+                _save_manifest(output_path, manifest)
+            if progress is not None:
+                progress.total_bytes = (progress.total_bytes or 0) + len(blocks) * block_size
+            for block_index, block_token in blocks:
+                if str(block_index) in manifest['blocks']:
+                    if progress is not None:
+                        progress.add(block_size)
+                    continue
+                yield block_index, block_token, block_size
+
+    try:
+        _run_parallel(fetch, missing_blocks(), connections)
+    finally:
+        with lock:
+            _save_manifest(output_path, manifest)
+
+    manifest['complete'] = True
+    _save_manifest(output_path, manifest)
+    return {
+        'volume_size': manifest['volume_size'],
+        'block_size': manifest['block_size'],
+        'blocks': len(manifest['blocks']),
+        'manifest': manifest_path(output_path),
+        'integrity_manifest': write_integrity_manifest(output_path, manifest)
+    }
+
+
+def list_changed_blocks(client, first_snapshot_id, second_snapshot_id):
+    """
+    Yield the pages of blocks that differ between two snapshots of the same volume.
+
+    Returns:
+        iterator of (volume size in GiB, block size in bytes, [(block index, block token of the second snapshot)]),
+        the token is None for a block that holds no data in the second snapshot
+    """
+    next_token = None
+    while True:
+        arguments = {'FirstSnapshotId': first_snapshot_id, 'SecondSnapshotId': second_snapshot_id, 'MaxResults': 10000}
+        if next_token:
+            arguments['NextToken'] = next_token
+        response = client.list_changed_blocks(**arguments)
+        blocks = [(block['BlockIndex'], block.get('SecondBlockToken')) for block in response.get('ChangedBlocks', [])]
+        yield response['VolumeSize'], response['BlockSize'], blocks
+        next_token = response.get('NextToken')
+        if not next_token:
+            return
+
+
+def download_changed_blocks(client, first_snapshot_id, second_snapshot_id, output_path, connections=32, progress=None):
+    """
+    Update an image of first_snapshot_id, made by download_snapshot(), to second_snapshot_id.
+
+    Args:
+        client: EBS direct client, see ebs_client()
+        first_snapshot_id: the snapshot the image holds
+        second_snapshot_id: a later completed snapshot of the same volume
+        output_path: the raw image to update
+        connections: concurrent GetSnapshotBlock calls
+        progress: optional progress_events.ProgressReporter, counts the bytes of the changed blocks
+
+    Returns:
+        dict: volume_size (bytes), block_size, blocks (allocated blocks), changed_blocks and manifest (path)
+
+    Raises:
+        Exception: If the image is not a complete copy of first_snapshot_id
+    """
+    import os
+    import threading
+
+    manifest = _load_manifest(output_path)
+    delta = (manifest or {}).get('delta', {})
+    if delta.get('from') == first_snapshot_id:
+        if delta.get('to') != second_snapshot_id:
+            # a delta to an earlier snapshot of the stopped volume was interrupted, its blocks are in this one too
+            manifest['delta'] = {'from': first_snapshot_id, 'to': second_snapshot_id, 'done': []}
+            _save_manifest(output_path, manifest)
+    elif not manifest or manifest.get('snapshot_id') != first_snapshot_id or not manifest.get('complete'):
+        raise Exception(f"{output_path} is not a complete copy of snapshot {first_snapshot_id}")
+    else:
+        manifest['delta'] = {'from': first_snapshot_id, 'to': second_snapshot_id, 'done': []}
+        manifest['complete'] = False
+        _save_manifest(output_path, manifest)
+
+    lock = threading.Lock()
+    done = set(manifest['delta']['done'])
+    changed = [0]
+
+    def update(block_index, block_token, block_size):
+        if block_token is None:
+            data, checksum = bytes(block_size), None
+        else:
+            data, checksum = fetch_block(client, second_snapshot_id, block_index, block_token)
+        with open(output_path, "r+b") as f:
+            f.seek(block_index * block_size)
+            f.write(data)
+        with lock:
+            if checksum is None:
+                manifest['blocks'].pop(str(block_index), None)
+            else:
+                manifest['blocks'][str(block_index)] = checksum
+            done.add(block_index)
+            changed[0] += 1
+            if len(done) % 1000 == 0:
+                manifest['delta']['done'] = sorted(done)
+                _save_manifest(output_path, manifest)
+        if progress is not None:
+            progress.add(block_size)
+
+    def changed_blocks():
+        for volume_size_gib, block_size, blocks in list_changed_blocks(client, first_snapshot_id, second_snapshot_id):
+            if volume_size_gib * 1024**3 > manifest['volume_size']:
+                # the volume grew between the snapshots
+                manifest['volume_size'] = volume_size_gib * 1024**3
+                os.truncate(output_path, manifest['volume_size'])
+            if progress is not None:
+                progress.total_bytes = (progress.total_bytes or 0) + len(blocks) * block_size
+            for block_index, block_token in blocks:
+                if block_index in done:
+                    if progress is not None:
+                        progress.add(block_size)
+                    continue
+                yield block_index, block_token, block_size
+
+    try:
+        _run_parallel(update, changed_blocks(), connections)
+    finally:
+        with lock:
+            manifest['delta']['done'] = sorted(done)
+            _save_manifest(output_path, manifest)
+
+    del manifest['delta']
+    manifest['snapshot_id'] = second_snapshot_id
+    manifest['complete'] = True
+    _save_manifest(output_path, manifest)
+    return {
+        'volume_size': manifest['volume_size'],
+        'block_size': manifest['block_size'],
+        'blocks': len(manifest['blocks']),
+        'changed_blocks': changed[0],
+        'manifest': manifest_path(output_path),
+        'integrity_manifest': write_integrity_manifest(output_path, manifest)
+    }
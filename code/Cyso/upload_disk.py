@@ -1,41 +1,17 @@
 #!/usr/bin/env python3
-def uploading_disk(vm_name):
+def destination_session():
     """
-    Cyso.cloud OpenStack VM Access Script
-    This script authenticates to Cyso.cloud OpenStack and downloads the image
+    Ask for the application secret and log in to the destination cloud.
+
+    Returns:
+        keystoneauth1 session
     """
-    
     import os
     import sys
-    import webbrowser
-    from novaclient import client as nova_client
-    from glanceclient import client as glance_client
     from keystoneauth1 import session
-    from keystoneauth1.identity import v3
-    import getpass
-    import json
     sys.path.append(r"C:/projects/digitalnomadsky/code/Cyso")
     import tkinter as tk
-    from tkinter import simpledialog
-    import time
-    import requests
-    from requests.exceptions import ConnectionError, ChunkedEncodingError
-    
-
-    # Get arguments
-    source = sys.argv[1]
-    destination = sys.argv[2]
-    vm_name = sys.argv[3].lower()
     import config
-    
-    chunk_size = 50 * 1024 * 1024  # 50 MB per chunk
-    shared_data_json = sys.argv[4]  # 4th argument
-    shared_data = json.loads(shared_data_json)
-    # Extract specific value
-    disktype = shared_data.get('importdisktype', '')
-    output_path = shared_data.get('output_path', '')
-    
-
 
     from keystoneauth1.identity.v3 import ApplicationCredential
 
@@ -68,6 +44,105 @@ def uploading_disk(vm_name):
      application_credential_secret= password
     )
     sess = session.Session(auth=auth)
+    return sess
+
+
+def wait_for_image(glance, image_id, image_name, vm_name, destination):
+    """
+    Wait for an uploaded image to become active (check every 20 seconds, max 2 hours).
+
+    Returns:
+        dict: message and image_id
+    """
+    import time
+
+    for _ in range(360):
+        img = glance.images.get(image_id)
+        if img.status == 'active':
+            return {'message' : f"Image {image_name} uploaded (ID: {image_id})",
+                   'image_id' : image_id}
+        elif img.status == 'error':
+            raise IndexError(f"VM '{vm_name}' upload failed in {destination}")
+        time.sleep(20)
+
+    raise IndexError(f"VM '{vm_name}' image creation timeout in {destination}")
+
+
+def uploading_stream(shared_data, chunks, size, disktype):
+    """
+    Upload a disk that arrives as chunks (streaming mode) to a new Glance image.
+
+    Returns:
+        dict: message and image_id, like uploading_disk
+    """
+    import sys
+    from glanceclient import client as glance_client
+    sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/basic")
+    import migration_ledger
+    import stream_pipeline
+    import integrity
+
+    destination = sys.argv[2]
+    vm_name = sys.argv[3].lower()
+    sess = destination_session()
+    glance = glance_client.Client("2", session=sess)
+
+    image_name = f"osdisk-{vm_name}"
+    image = glance.images.create(
+        name=image_name,
+        disk_format=disktype,
+        container_format='bare',
+        visibility='private'
+    )
+    migration_ledger.record_artifact('image_id', image.id)
+    reader = integrity.HashingReader(stream_pipeline.ChunkReader(chunks, size))
+    glance.images.upload(image.id, reader, image_size=size)
+    result = wait_for_image(glance, image.id, image_name, vm_name, destination)
+    result['verified'] = integrity.compare(reader.hexdigests(), integrity.glance_checksums(glance.images.get(image.id)))
+    return result
+
+
+def uploading_disk(vm_name):
+    """
+    Cyso.cloud OpenStack VM Access Script
+    This script authenticates to Cyso.cloud OpenStack and downloads the image
+    """
+    
+    import os
+    import sys
+    import webbrowser
+    from novaclient import client as nova_client
+    from glanceclient import client as glance_client
+    from keystoneauth1 import session
+    from keystoneauth1.identity import v3
+    import getpass
+    import json
+    sys.path.append(r"C:/projects/digitalnomadsky/code/Cyso")
+    import tkinter as tk
+    from tkinter import simpledialog
+    import time
+    import requests
+    from requests.exceptions import ConnectionError, ChunkedEncodingError
+    
+
+    # Get arguments
+    source = sys.argv[1]
+    destination = sys.argv[2]
+    vm_name = sys.argv[3].lower()
+    import config
+    sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/basic")
+    import migration_ledger
+    
+    chunk_size = 50 * 1024 * 1024  # 50 MB per chunk
+    shared_data_json = sys.argv[4]  # 4th argument
+    shared_data = json.loads(shared_data_json)
+    # Extract specific value
+    disktype = shared_data.get('importdisktype', '')
+    output_path = shared_data.get('output_path', '')
+    
+
+
+    sess = destination_session()
     glance = glance_client.Client("2", session=sess)
 
     image_name= f"osdisk-{vm_name}"
@@ -75,6 +150,17 @@ def uploading_disk(vm_name):
     container_format='bare'
     if source == "azure":
         disk_format="raw"
+
+    # An image uploaded by this migration before a restart of the engine is not uploaded again
+    image_id = migration_ledger.find_artifact('image_id')
+    if image_id:
+        try:
+            img = glance.images.get(image_id)
+            if img.status == 'active':
+                return {'message' : f"Image {image_name} already uploaded (ID: {image_id})",
+                       'image_id' : image_id}
+        except Exception:
+            pass
  
     # Create image metadata
     image = glance.images.create(
@@ -83,6 +169,7 @@ def uploading_disk(vm_name):
         container_format=container_format,
         visibility='private'
     )
+    migration_ledger.record_artifact('image_id', image.id)
 
     
     # Upload in chunks
@@ -90,17 +177,17 @@ def uploading_disk(vm_name):
     file_size = os.path.getsize(output_path)
     uploaded = 0
    
+    sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/basic")
+    import progress_events
+    import integrity
+    progress = progress_events.ProgressReporter(total_bytes=file_size, action="upload")
     with open(output_path, 'rb') as f:
-        glance.images.upload(image.id, f)
-    
-    # Wait for image to become active (check every 5 seconds, max 30 minutes)
-    for _ in range(360):
-        img = glance.images.get(image.id)
-        if img.status == 'active':
-            return {'message' : f"Image {image_name} uploaded (ID: {image.id})",
-                   'image_id' : image.id}
-        elif img.status == 'error':
-            raise IndexError(f"VM '{vmname}' upload failed in {destination}")
-        time.sleep(20)
+        # the bytes are hashed while they are sent, Glance hashes what it received
+        reader = integrity.HashingReader(progress_events.ProgressFile(f, progress))
+        glance.images.upload(image.id, reader, image_size=file_size)
+    progress.done()
     
-    raise IndexError(f"VM '{vmname}' image creation timeout in {destination}")
+    # Wait for image to become active
+    result = wait_for_image(glance, image.id, image_name, vm_name, destination)
+    result['verified'] = integrity.compare(reader.hexdigests(), integrity.glance_checksums(glance.images.get(image.id)))
+    return result
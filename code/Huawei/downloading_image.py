@@ -27,6 +27,8 @@ def download_huawei_vm(shared_data):
 
     sys.path.append(r"C:/projects/nomadsky/code/huawei")
     import config
+    sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/basic")
+    import migration_ledger
     source = sys.argv[1]
     destination = sys.argv[2]
     vm_name = sys.argv[3].lower()
@@ -45,6 +47,8 @@ def download_huawei_vm(shared_data):
     # Define output path (Huawei exports as QCOW2 by default)
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     output_file_path = os.path.join(download_path, f"{vm_name}_{timestamp}.qcow2")
+    # A resumed migration finds the disk it downloaded before the restart
+    output_file_path = migration_ledger.find_artifact('output_path') or output_file_path
     
     # Check if already downloaded
     if os.path.exists(output_file_path):
@@ -52,25 +56,14 @@ def download_huawei_vm(shared_data):
             'message': f"VM '{vm_name}' OS disk already downloaded!",
             'vm_name': vm_name,
             'storage_location': output_file_path,
+            'output_path': output_file_path,
             'file_size_gb': round(os.path.getsize(output_file_path) / (1024**3), 2),
             'status': 'already_exists'
         }
         print(f"OS disk already exists at: {output_file_path}")
         return result
     
-    # Check for existing files with same VM name
-    existing_files = [f for f in os.listdir(download_path) if f.startswith(vm_name) and f.endswith('.qcow2')]
-    if existing_files:
-        existing_path = os.path.join(download_path, existing_files[0])
-        result = {
-            'message': f"VM '{vm_name}' OS disk already downloaded!",
-            'vm_name': vm_name,
-            'storage_location': existing_path,
-            'file_size_gb': round(os.path.getsize(existing_path) / (1024**3), 2),
-            'status': 'already_exists'
-        }
-        print(f"OS disk already exists at: {existing_path}")
-        return result
+    # A disk downloaded by an earlier migration of this server is found by the artifact cache of the download step
     
     print(f"Downloading OS disk for VM '{vm_name}'...")
     
@@ -104,29 +97,38 @@ def download_huawei_vm(shared_data):
         if search_result['status'].upper() not in ['SHUTOFF', 'STOPPED']:
             raise Exception(f"VM must be stopped. Current status: {search_result['status']}")
         
-        print("Creating image from VM...")
-        
-        # Create whole image from server
-        from huaweicloudsdkims.v2 import CreateImageRequestBody
-        
-        image_request = CreateWholeImageRequest()
-        image_body = CreateWholeImageRequestBody(
-            name=f"{vm_name}_export_{timestamp}",
-            instance_id=server_id,
-            description=f"Export image for {vm_name}"
-        )
-        image_request.body = image_body
-        
-        image_response = ims_client.create_whole_image(image_request)
-        image_id = image_response.job_id
-        
-        print(f"Image creation job started: {image_id}")
-        print("Waiting for image creation to complete (this may take several minutes)...")
-        
-        # Wait for image to be created
         from huaweicloudsdkims.v2 import ShowJobRequest
-        
-        while True:
+
+        # Reuse the image of this migration when the engine restarted halfway
+        image_id = migration_ledger.find_artifact('image_id')
+        image_job_id = None
+        if not image_id:
+            image_job_id = migration_ledger.find_artifact('image_job_id')
+
+        if not image_id and not image_job_id:
+            print("Creating image from VM...")
+
+            # Create whole image from server
+            from huaweicloudsdkims.v2 import CreateImageRequestBody
+
+            image_request = CreateWholeImageRequest()
+            image_body = CreateWholeImageRequestBody(
+                name=f"{vm_name}_export_{timestamp}",
+                instance_id=server_id,
+                description=f"Export image for {vm_name}"
+            )
+            image_request.body = image_body
+
+            image_response = ims_client.create_whole_image(image_request)
+            image_job_id = image_response.job_id
+            migration_ledger.record_artifact('image_job_id', image_job_id)
+
+            print(f"Image creation job started: {image_job_id}")
+            print("Waiting for image creation to complete (this may take several minutes)...")
+
+        # Wait for image to be created
+        while image_job_id:
+            image_id = image_job_id
             job_request = ShowJobRequest(job_id=image_id)
             job_response = ims_client.show_job(job_request)
             
@@ -137,6 +139,7 @@ def download_huawei_vm(shared_data):
                 # Get the actual image ID from job
                 if job_response.entities and 'image_id' in job_response.entities:
                     image_id = job_response.entities['image_id']
+                migration_ledger.record_artifact('image_id', image_id)
                 print(f"Image created successfully: {image_id}")
                 break
             elif status == 'FAIL':
@@ -144,25 +147,32 @@ def download_huawei_vm(shared_data):
             
             time.sleep(15)
         
-        # Export image to OBS
-        print(f"Exporting image to OBS bucket: {obs_bucket}...")
-        
-        from huaweicloudsdkims.v2 import ExportImageRequest, ExportImageRequestBody
-        
-        obs_file_key = f"exports/{vm_name}_{timestamp}.qcow2"
-        
-        export_request = ExportImageRequest(image_id=image_id)
-        export_body = ExportImageRequestBody(
-            bucket_url=obs_bucket,
-            file_format="qcow2",  # QCOW2 is native format
-            image_id=image_id
-        )
-        export_request.body = export_body
-        
-        export_response = ims_client.export_image(export_request)
-        export_job_id = export_response.job_id
-        
-        print(f"Export job started: {export_job_id}")
+        # Reuse the export of this migration when the engine restarted halfway
+        export_job_id = migration_ledger.find_artifact('export_job_id')
+        obs_file_key = migration_ledger.find_artifact('obs_key')
+
+        if not export_job_id or not obs_file_key:
+            # Export image to OBS
+            print(f"Exporting image to OBS bucket: {obs_bucket}...")
+
+            from huaweicloudsdkims.v2 import ExportImageRequest, ExportImageRequestBody
+
+            obs_file_key = f"exports/{vm_name}_{timestamp}.qcow2"
+
+            export_request = ExportImageRequest(image_id=image_id)
+            export_body = ExportImageRequestBody(
+                bucket_url=obs_bucket,
+                file_format="qcow2",  # QCOW2 is native format
+                image_id=image_id
+            )
+            export_request.body = export_body
+
+            export_response = ims_client.export_image(export_request)
+            export_job_id = export_response.job_id
+            migration_ledger.record_artifact('obs_key', obs_file_key)
+            migration_ledger.record_artifact('export_job_id', export_job_id)
+
+            print(f"Export job started: {export_job_id}")
         print("Waiting for export to complete...")
         
         # Wait for export to complete
@@ -192,6 +202,7 @@ def download_huawei_vm(shared_data):
             raise Exception(f"Failed to download from OBS: {resp.errorMessage}")
         
         print("Download completed!")
+        migration_ledger.record_artifact('output_path', output_file_path)
         
         # Get file size
         file_size_gb = round(os.path.getsize(output_file_path) / (1024**3), 2)
@@ -212,6 +223,7 @@ def download_huawei_vm(shared_data):
             'vm_size': vm_size,
             'resource_id': resource_id,
             'storage_location': output_file_path,
+            'output_path': output_file_path,
             'file_size_gb': file_size_gb,
             'file_format': 'QCOW2',
             'status': 'download_completed'
@@ -227,6 +239,8 @@ def download_huawei_vm(shared_data):
         try:
             if obs_file_key:
                 obs_client.deleteObject(obs_bucket, obs_file_key)
+                migration_ledger.record_artifact('export_job_id', None)
+                migration_ledger.record_artifact('obs_key', None)
                 print("OBS object deleted")
         except:
             pass
@@ -236,6 +250,8 @@ def download_huawei_vm(shared_data):
                 from huaweicloudsdkims.v2 import DeleteImageRequest
                 delete_request = DeleteImageRequest(image_id=image_id)
                 ims_client.delete_image(delete_request)
+                migration_ledger.record_artifact('image_job_id', None)
+                migration_ledger.record_artifact('image_id', None)
                 print("Image deleted")
         except:
             pass
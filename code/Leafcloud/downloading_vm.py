@@ -1,42 +1,19 @@
 
 #!/usr/bin/env python3
-def export_os_disk(vm_name):
+def source_session():
     """
-    Leaf.cloud OpenStack VM Access Script
-    This script authenticates to Leaf.cloud OpenStack and downloads the image
+    Ask for the application secret and log in to the source cloud.
+
+    Returns:
+        keystoneauth1 session
     """
-    
     import os
     import sys
-    import webbrowser
-    from novaclient import client as nova_client
-    from glanceclient import client as glance_client
     from keystoneauth1 import session
-    from keystoneauth1.identity import v3
-    import getpass
-    import json
     sys.path.append(r"C:/projects/digitalnomadsky/code/Leafcloud")
     import tkinter as tk
-    from tkinter import simpledialog
-    import time
-    import requests
-    from requests.exceptions import ConnectionError, ChunkedEncodingError
-
-    # Get arguments
-    source = sys.argv[1]
-    destination = sys.argv[2]
-    vm_name = sys.argv[3].lower()
     import config
-    output_path= fr"C:\Temp\osdisk-{vm_name}.qcow2"
-    chunk_size = 50 * 1024 * 1024  # 50 MB per chunk
 
-    if os.path.exists(output_path):
-               result = {
-                  'message': f"VM {vm_name} already downloaded from {source}!",
-                  'output_path' : output_path
-                 }
-               return result
-   
     # Step 1: Get credentials
     #print("\n[1/4] Getting credentials...")
     # Use ApplicationCredential instead of Password
@@ -71,6 +48,120 @@ def export_os_disk(vm_name):
      application_credential_secret= password
     )
     sess = session.Session(auth=auth)
+    return sess
+
+
+def snapshot_image(glance, server, vm_name):
+    """
+    Snapshot the VM to a Glance image and wait until it is active.
+
+    Returns:
+        tuple: (image_id, image_name)
+    """
+    import sys
+    import time
+    sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/basic")
+    import migration_ledger
+
+    # Reuse the snapshot of this migration when the engine restarted halfway
+    image_id = migration_ledger.find_artifact('snapshot_image_id')
+    if image_id:
+        try:
+            image_name = glance.images.get(image_id).name
+        except Exception:
+            image_id = None
+
+    if not image_id:
+        # Create snapshot/image of the VM
+        image_name = f"{vm_name}_snapshot_{int(__import__('time').time())}"
+        image_id = server.create_image(image_name)
+        migration_ledger.record_artifact('snapshot_image_id', image_id)
+    for _ in range(360):
+        image = glance.images.get(image_id)
+        if image.status == 'active':
+            break 
+        elif image.status == 'error':
+            raise Exception(f"Image creation failed")
+        time.sleep(20)
+    return image_id, image_name
+
+
+def open_image_source(shared_data):
+    """
+    Snapshot the VM and open the image file for the streaming mode.
+
+    Returns:
+        dict: url, headers function, size in bytes and disktype of the image
+    """
+    import sys
+    from novaclient import client as nova_client
+    from glanceclient import client as glance_client
+    sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/basic")
+    import integrity
+
+    vm_name = sys.argv[3].lower()
+    sess = source_session()
+    nova = nova_client.Client("2.1", session=sess)
+    servers = nova.servers.list(search_opts={'name': vm_name})
+    if not servers:
+        raise IndexError(f"VM '{vm_name}' not found")
+    glance = glance_client.Client("2", session=sess)
+    image_id, image_name = snapshot_image(glance, servers[0], vm_name)
+    image = glance.images.get(image_id)
+
+    # Get direct URL from Glance endpoint
+    endpoint = sess.get_endpoint(service_type='image')
+    return {
+        'url': f"{endpoint}/v2/images/{image_id}/file",
+        'headers': lambda: {'X-Auth-Token': sess.get_token()},
+        'size': image.size,
+        'disktype': image.disk_format,
+        'checksums': integrity.glance_checksums(image)
+    }
+
+
+def export_os_disk(vm_name):
+    """
+    Leaf.cloud OpenStack VM Access Script
+    This script authenticates to Leaf.cloud OpenStack and downloads the image
+    """
+    
+    import os
+    import sys
+    import webbrowser
+    from novaclient import client as nova_client
+    from glanceclient import client as glance_client
+    from keystoneauth1 import session
+    from keystoneauth1.identity import v3
+    import getpass
+    import json
+    sys.path.append(r"C:/projects/digitalnomadsky/code/Leafcloud")
+    import tkinter as tk
+    from tkinter import simpledialog
+    import time
+    import requests
+    from requests.exceptions import ConnectionError, ChunkedEncodingError
+
+    # Get arguments
+    source = sys.argv[1]
+    destination = sys.argv[2]
+    vm_name = sys.argv[3].lower()
+    import config
+    sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/basic")
+    import migration_ledger
+    output_path= fr"C:\Temp\osdisk-{vm_name}.qcow2"
+    chunk_size = 50 * 1024 * 1024  # 50 MB per chunk
+
+    # a download that was interrupted is continued below instead of reused
+    import ranged_download
+    if os.path.exists(output_path) and not ranged_download.is_partial(output_path):
+               result = {
+                  'message': f"VM {vm_name} already downloaded from {source}!",
+                  'output_path' : output_path
+                 }
+               return result
+   
+    sess = source_session()
     nova = nova_client.Client("2.1", session=sess)
     
     # Find VM by name
@@ -81,49 +172,28 @@ def export_os_disk(vm_name):
     server = servers[0]
     glance = glance_client.Client("2", session=sess)
     
-    # Create snapshot/image of the VM
-    image_name = f"{vm_name}_snapshot_{int(__import__('time').time())}"
-    image_id = server.create_image(image_name)
-    for _ in range(360):
-        image = glance.images.get(image_id)
-        if image.status == 'active':
-            break 
-        elif image.status == 'error':
-            return False, f"Image creation failed"
-        time.sleep(20)
+    image_id, image_name = snapshot_image(glance, server, vm_name)
 
     image = glance.images.get(image_id)
-    download_url = glance.images.data(image_id, do_checksum=False)
     
     # Get direct URL from Glance endpoint
     endpoint = sess.get_endpoint(service_type='image')
     url = f"{endpoint}/v2/images/{image_id}/file"
     
-    # Download with retry (max 5 attempts)
-    for attempt in range(5):
-        try:
-            # Resume from where we left off
-            resume_pos = os.path.getsize(output_path) if os.path.exists(output_path) else 0
-            headers = {'Range': f'bytes={resume_pos}-'} if resume_pos > 0 else {}
-            headers['X-Auth-Token'] = sess.get_token()
-            
-            response = requests.get(url, headers=headers, stream=True, timeout=30)
-            response.raise_for_status()
-
-            mode = 'ab' if resume_pos > 0 else 'wb'
-            with open(output_path, mode) as f:
-                for chunk in response.iter_content(chunk_size=chunk_size):
-                    if chunk:
-                        f.write(chunk)
-            
-            return {'message': f"Image {image_name} ready (ID: {image_id}) and downloaded to {output_path}",
-                   'output_path': output_path}
-            
-        except (requests.exceptions.RequestException, IOError) as e:
-            if attempt < 4:
-                time.sleep(2 ** attempt)  # Exponential backoff
-                continue
-            return False, f"Download failed after 5 attempts: {e}"
+    import progress_events
+    import integrity
+    progress = progress_events.ProgressReporter(total_bytes=getattr(image, 'size', None), action="download")
+
+    # parallel ranged GETs, a failed range is retried on its own; the image is checked against the Glance checksum
+    ranged_download.download(url, output_path, size=getattr(image, 'size', None),
+                             headers=lambda: {'X-Auth-Token': sess.get_token()}, progress=progress,
+                             expected=integrity.glance_checksums(image))
+    progress.done()
+    migration_ledger.record_artifact('output_path', output_path)
+
+    return {'message': f"Image {image_name} ready (ID: {image_id}) and downloaded to {output_path}",
+           'output_path': output_path,
+           'integrity_manifest': integrity.manifest_path(output_path)}
 
 
 
@@ -1,6 +1,8 @@
 #Parameters to find your VM. 
 tenantid = "78ba35ee-470e-4a16-ba92-ad53510ad7f6"  # your tenant-id, this is used to find VMs.
 
+precopy = False  # True copies a snapshot of the OS disk while the VM still runs, after the stop only the changed pages are downloaded.
+
 #Parameters to upload your VM.
 location = "westeurope"  # The VM will be created in this location.
 destionationtenantid = "78ba35ee-470e-4a16-ba92-ad53510ad7f6" # the VM will be creaed in this tenant
@@ -9,3 +11,4 @@ resource_group = "output" # the VM will be created in this resource group.
 
 storage_account_name = "compliceert20"   # a temp storage account to upload the disk file. 
 container_name = "vhds"  # the temp container name to upload the disk file.  
+upload_mode = "blob"  # "blob" uploads the disk file to the temp storage account and imports it, "managed_disk" uploads it straight into an empty managed disk.
@@ -34,28 +34,32 @@ def start_vm (shared_data):
   resource_client = ResourceManagementClient(credential, subscription_id)
 
   #storage_id = "/subscriptions/41aff5e1-41c9-4509-9fcb-d761d7f33740/resourceGroups/output/providers/Microsoft.Storage/storageAccounts/compliceert20" 
-  # Create managed disk from VHD
-  disk_params = Disk(
-      location=location,
-      hyper_v_generation='V2',  # V1 or V2 - match your source VM
-      security_profile=DiskSecurityProfile(
-        security_type=SecurityTypes.TRUSTED_LAUNCH),  # For Trusted Launch VMs
-      creation_data={
-          'create_option': DiskCreateOption.IMPORT,
-          'source_uri': vhd_url,
-          'storage_account_id': storage_id
-        },
-      os_type= os_type
-    )
+  if shared_data.get('disk_id'):
+    # the disk was uploaded straight into a managed disk (upload_mode "managed_disk"), no import needed
+    managed_disk = compute_client.disks.get(resource_group, disk_name)
+  else:
+    # Create managed disk from VHD
+    disk_params = Disk(
+        location=location,
+        hyper_v_generation='V2',  # V1 or V2 - match your source VM
+        security_profile=DiskSecurityProfile(
+          security_type=SecurityTypes.TRUSTED_LAUNCH),  # For Trusted Launch VMs
+        creation_data={
+            'create_option': DiskCreateOption.IMPORT,
+            'source_uri': vhd_url,
+            'storage_account_id': storage_id
+          },
+        os_type= os_type
+      )
     
-  disk_creation = compute_client.disks.begin_create_or_update(
-        resource_group,
-        disk_name,
-        disk_params
-    )
+    disk_creation = compute_client.disks.begin_create_or_update(
+          resource_group,
+          disk_name,
+          disk_params
+      )
 
-  disk_creation.wait()
-  managed_disk = disk_creation.result()
+    disk_creation.wait()
+    managed_disk = disk_creation.result()
   #print(f"Managed disk created: {managed_disk.id}")
   #print(f"Creating VM '{vm_name}'...")
     
@@ -6,6 +6,239 @@
 # -------------------------------
 
 
+def grant_read_access(shared_data):
+        """
+        Export the OS disk of the VM with a read SAS url of one hour.
+
+        Returns:
+            str: the SAS url of the disk
+        """
+        import sys
+        sys.path.append(r"C:/projects/digitalnomadsky/code/Microsoft")
+        from azure.identity import InteractiveBrowserCredential
+        from azure.mgmt.compute import ComputeManagementClient
+        import config
+
+        subscription_id = shared_data.get('subscription_id', '')
+        resource_group = shared_data.get('resource_group', '')
+        os_disk_id = shared_data.get('os_disk_id', '')
+
+        # Use interactive browser login
+        tenant_id = config.tenantid
+        credential = InteractiveBrowserCredential(tenant_id=tenant_id)
+        compute_client = ComputeManagementClient(credential, subscription_id)
+
+        sas = compute_client.disks.begin_grant_access(
+          resource_group_name=resource_group,
+          disk_name=os_disk_id.split('/')[-1],
+          grant_access_data={"access": "Read", "duration_in_seconds": 3600}
+          ).result()
+        return sas.access_sas
+
+
+def allocated_ranges(sas_url, size, segment=64 * 1024**3):
+        """
+        The page ranges of the exported disk that hold data. A managed disk is a page blob, the pages that were
+        never written are not listed. The VHD footer in the last 512 bytes is always included.
+
+        Returns:
+            list: (start, end) byte ranges, end included
+        """
+        from azure.storage.blob import BlobClient
+
+        blob_client = BlobClient.from_blob_url(sas_url)
+        ranges = []
+        # the listing is asked per segment, one call over a large fragmented disk can time out
+        for offset in range(0, size, segment):
+            page_ranges = blob_client.get_page_ranges(offset=offset, length=min(segment, size - offset))[0]
+            ranges += [(page_range['start'], page_range['end']) for page_range in page_ranges]
+        ranges.append((size - 512, size - 1))
+        return ranges
+
+
+def compute_client_for(shared_data):
+        import sys
+        sys.path.append(r"C:/projects/digitalnomadsky/code/Microsoft")
+        from azure.identity import InteractiveBrowserCredential
+        from azure.mgmt.compute import ComputeManagementClient
+        import config
+
+        credential = InteractiveBrowserCredential(tenant_id=config.tenantid)
+        return ComputeManagementClient(credential, shared_data.get('subscription_id', ''))
+
+
+def create_incremental_snapshot(compute_client, shared_data, kind):
+        """
+        Take an incremental snapshot of the OS disk. Incremental snapshots of the same disk can be compared page by page.
+
+        Returns:
+            str: the name of the snapshot
+        """
+        import time
+
+        resource_group = shared_data.get('resource_group', '')
+        os_disk_id = shared_data.get('os_disk_id', '')
+        disk = compute_client.disks.get(resource_group, os_disk_id.split('/')[-1])
+        snapshot_name = f"{disk.name}-{kind}-{int(time.time())}"
+        compute_client.snapshots.begin_create_or_update(resource_group, snapshot_name, {
+            'location': disk.location,
+            'incremental': True,
+            'creation_data': {'create_option': 'Copy', 'source_resource_id': disk.id}
+        }).result()
+        return snapshot_name
+
+
+def grant_snapshot_access(compute_client, shared_data, snapshot_name):
+        """A read SAS url of a snapshot, valid for a day so a large disk can be read in one go."""
+        return compute_client.snapshots.begin_grant_access(
+          resource_group_name=shared_data.get('resource_group', ''),
+          snapshot_name=snapshot_name,
+          grant_access_data={"access": "Read", "duration_in_seconds": 86400}
+          ).result().access_sas
+
+
+def delete_snapshot(compute_client, shared_data, snapshot_name):
+        resource_group = shared_data.get('resource_group', '')
+        try:
+            compute_client.snapshots.begin_revoke_access(resource_group, snapshot_name).result()
+        except Exception:
+            pass
+        compute_client.snapshots.begin_delete(resource_group, snapshot_name).result()
+
+
+def changed_ranges(sas_url, previous_sas_url, size, segment=64 * 1024**3):
+        """
+        The page ranges that differ between two incremental snapshots of the same disk.
+        The VHD footer in the last 512 bytes is always counted as changed.
+
+        Returns:
+            tuple: (changed, cleared) lists of (start, end) byte ranges, end included; the cleared pages read as zeros
+        """
+        from azure.storage.blob import BlobClient
+
+        blob_client = BlobClient.from_blob_url(sas_url)
+        changed = []
+        cleared = []
+        for offset in range(0, size, segment):
+            page_ranges, clear_ranges = blob_client.get_page_range_diff_for_managed_disk(
+                previous_sas_url, offset=offset, length=min(segment, size - offset))
+            changed += [(page_range['start'], page_range['end']) for page_range in page_ranges]
+            cleared += [(page_range['start'], page_range['end']) for page_range in clear_ranges]
+        changed.append((size - 512, size - 1))
+        return changed, cleared
+
+
+def precopy_disk(shared_data):
+        """
+        First phase of a two-phase download: copy an incremental snapshot of the OS disk while the VM still runs.
+        download_vm() later fetches only the pages that changed since this snapshot.
+
+        Returns:
+            dict: message, and precopy_snapshot and output_path when the pre-copy is enabled in config.py
+        """
+        import sys
+        import os
+        sys.path.append(r"C:/projects/digitalnomadsky/code/Microsoft")
+        sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/basic")
+        import config
+        import migration_ledger
+        import progress_events
+        import ranged_download
+
+        vmname = sys.argv[3].lower()
+        if not getattr(config, 'precopy', False):
+            return {'message': "no pre-copy, the disk is downloaded after the VM stopped"}
+
+        output_path = fr"C:\Temp\osdisk-{vmname}.vhd"
+        compute_client = compute_client_for(shared_data)
+
+        # a snapshot of this migration is reused when the engine restarted halfway, a new one starts a new copy
+        snapshot_name = migration_ledger.find_artifact('precopy_snapshot')
+        if snapshot_name is None:
+            snapshot_name = create_incremental_snapshot(compute_client, shared_data, "precopy")
+            migration_ledger.record_artifact('precopy_snapshot', snapshot_name)
+            for path in (output_path, ranged_download.state_path(output_path)):
+                if os.path.exists(path):
+                    os.remove(path)
+
+        if not os.path.exists(output_path) or ranged_download.is_partial(output_path):
+            sas_url = grant_snapshot_access(compute_client, shared_data, snapshot_name)
+            progress = progress_events.ProgressReporter(action="precopy")
+            size = ranged_download.remote_size(sas_url)
+            ranged_download.download(sas_url, output_path, size=size, ranges=allocated_ranges(sas_url, size),
+                                     progress=progress)
+            progress.done()
+            compute_client.snapshots.begin_revoke_access(shared_data.get('resource_group', ''), snapshot_name).result()
+
+        return {
+            'message': f"OS disk of VM '{vmname}' pre-copied while running",
+            'precopy_snapshot': snapshot_name,
+            'output_path': output_path
+        }
+
+
+def sync_delta(shared_data, output_path):
+        """
+        Second phase of a two-phase download: take an incremental snapshot of the stopped VM and write the pages that
+        changed since the pre-copy snapshot into the pre-copied disk. Both snapshots are deleted afterwards.
+
+        Returns:
+            int: the bytes of the changed pages
+        """
+        import sys
+        import os
+        sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/basic")
+        import migration_ledger
+        import progress_events
+        import ranged_download
+
+        compute_client = compute_client_for(shared_data)
+        precopy_snapshot = migration_ledger.find_artifact('precopy_snapshot')
+        final_snapshot = migration_ledger.find_artifact('final_snapshot')
+        if final_snapshot is None:
+            final_snapshot = create_incremental_snapshot(compute_client, shared_data, "final")
+            migration_ledger.record_artifact('final_snapshot', final_snapshot)
+
+        previous_sas_url = grant_snapshot_access(compute_client, shared_data, precopy_snapshot)
+        sas_url = grant_snapshot_access(compute_client, shared_data, final_snapshot)
+        size = ranged_download.remote_size(sas_url)
+        changed, cleared = changed_ranges(sas_url, previous_sas_url, size)
+
+        # a disk that grew between the snapshots has its old footer in the middle now
+        previous_size = os.path.getsize(output_path)
+        if previous_size < size and not ranged_download.is_partial(output_path):
+            cleared.append((previous_size - 512, previous_size - 1))
+
+        progress = progress_events.ProgressReporter(action="download")
+        ranged_download.zero_ranges(output_path, cleared)
+        ranged_download.download(sas_url, output_path, size=size, ranges=changed, progress=progress, existing=True)
+        progress.done()
+
+        for kind, snapshot_name in (('final_snapshot', final_snapshot), ('precopy_snapshot', precopy_snapshot)):
+            delete_snapshot(compute_client, shared_data, snapshot_name)
+            migration_ledger.record_artifact(kind, None)
+        return sum(end + 1 - start for start, end in ranged_download.merge_ranges(changed))
+
+
+def open_disk_source(shared_data):
+        """
+        Open the OS disk of the VM for the streaming mode, the disk of a managed disk export is a fixed VHD.
+
+        Returns:
+            dict: url, size in bytes and disktype of the disk
+        """
+        import sys
+        sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/basic")
+        import stream_pipeline
+
+        sas_url = grant_read_access(shared_data)
+        return {
+            'url': sas_url,
+            'size': stream_pipeline.remote_size(sas_url),
+            'disktype': 'vhd'
+        }
+
+
 def download_vm(shared_data):
         import sys
         import json
@@ -41,7 +274,23 @@ def download_vm(shared_data):
         output_path = fr"C:\Temp\osdisk-{vmname}.vhd"
         exportdisktype = shared_data.get('exportdisktype', '')
 
-        if os.path.exists(output_path):
+        sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/basic")
+        import ranged_download
+        import migration_ledger
+        import integrity
+        if migration_ledger.find_artifact('precopy_snapshot') and os.path.exists(output_path):
+               # the pre-copy step already has the disk of the running VM, only the changes since then are left
+               changed_bytes = sync_delta(shared_data, output_path)
+               result = {
+                  'message': f"VM '{vmname}' successfully downloaded from '{source}', {changed_bytes / (1024**3):.2f} GB changed since the pre-copy!",
+                  'exportdisktype' : exportdisktype,
+                  'output_path' : output_path,
+                  'changed_bytes' : changed_bytes,
+                  'integrity_manifest' : integrity.manifest_path(output_path)
+                 }
+               return result
+
+        if os.path.exists(output_path) and not ranged_download.is_partial(output_path):
                #file_size_gb = os.path.getsize(output_path) / (1024**3) 
                result = {
                   'message': f"VM {vmname} already downloaded from {source}!",
@@ -51,62 +300,33 @@ def download_vm(shared_data):
                return result
         
         else: 
-              # Use interactive browser login
-              tenant_id = config.tenantid
-              credential = InteractiveBrowserCredential(tenant_id=tenant_id)
-
               # -------------------------------
               # 3) REQUEST DISK EXPORT (ASYNC)
               # -------------------------------
-              compute_client = ComputeManagementClient(credential, subscription_id)
-
-              # Generate SAS URL
-              now_utc = datetime.now(timezone.utc)
-              expiry_time = now_utc + timedelta(hours=1)
-
-              sas = compute_client.disks.begin_grant_access(
-                resource_group_name=resource_group,
-                disk_name=os_disk_id.split('/')[-1],
-                grant_access_data={"access": "Read", "duration_in_seconds": 3600}
-                ).result()
-              sas_url = sas.access_sas
+              sas_url = grant_read_access(shared_data)
               #print(sas_url)
 
               # -------------------------------
               # 4) DOWNLOAD THE VHD
               # -------------------------------
 
-              chunk_size = 50 * 1024 * 1024  # 50 MB per chunk
-              max_retries = 200
-
-              # Resume if file exists
-              start_byte = os.path.getsize(output_path) if os.path.exists(output_path) else 0
-
-              while True:
-                    headers = {"Range": f"bytes={start_byte}-"}
-                    try:
-                       with requests.get(sas_url, headers=headers, stream=True, timeout=60) as r:
-                           r.raise_for_status()
-                           mode = "ab" if start_byte > 0 else "wb"
-                           with open(output_path, mode) as f:
-                               for chunk in r.iter_content(chunk_size=chunk_size):
-                                   if chunk:
-                                       f.write(chunk)
-                                       start_byte += len(chunk)
-                                       #print(f"Downloaded {start_byte / (1024*1024):.1f} MB", end="\r")
-                       break  # finished successfully
-                    except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
-                       #print(f"\nConnection error, retrying... ({e})")
-                       sleep(10)  # wait a few seconds
-                       max_retries -= 1
-                       if max_retries <= 0:
-                           raise Exception("Max retries exceeded")
+              import progress_events
+
+              # parallel ranged GETs, an interrupted download continues with its missing ranges.
+              # Only the allocated pages are fetched, the empty parts of the disk stay holes in a sparse file
+              progress = progress_events.ProgressReporter(action="download")
+              size = ranged_download.remote_size(sas_url)
+              ranges = allocated_ranges(sas_url, size)
+              ranged_download.download(sas_url, output_path, size=size, ranges=ranges, progress=progress,
+                                       expected=ranged_download.remote_checksums(sas_url))
 
+              progress.done()
               file_size_gb = os.path.getsize(output_path) / (1024**3) 
               result = {
                   'message': f"VM '{vmname}' successfully downloaded from '{source}'!",
                   'exportdisktype' : exportdisktype,
                   'output_path' : output_path,
+                  'integrity_manifest' : integrity.manifest_path(output_path)
                   }
               return result
 
@@ -1,29 +1,22 @@
-def upload_disk(shared_data):
-    
+def ensure_storage(credential):
+    """
+    Create the storage account and the blob container of the destination when they do not exist yet.
+
+    Returns:
+        tuple: (storage account properties, storage key)
+    """
     import sys
     sys.path.append(r"C:/projects/digitalnomadsky/code/Microsoft")
     from azure.mgmt.storage import StorageManagementClient
-    from azure.storage.blob import BlobServiceClient, BlobClient
-    import os
-    from azure.identity import InteractiveBrowserCredential
+    from azure.storage.blob import BlobServiceClient
     import config
     from azure.core.exceptions import ResourceNotFoundError
 
-
-    # Variables
     subscription_id = config.subscription_id
     resource_group = config.resource_group
-    storage_account_name = config.storage_account_name 
-    location = config.location 
+    storage_account_name = config.storage_account_name
+    location = config.location
     container_name = config.container_name
-    vhd_path = shared_data.get('output_path', '')
-    disktype = shared_data.get('importdisktype', '')
-    vm_name = shared_data.get('vm_name', '')
-    blob_name = f"osdisk{vm_name}.{disktype}"
-    account_url = f"https://{storage_account_name}.blob.core.windows.net"
-
-    tenant_id = config.destionationtenantid
-    credential = InteractiveBrowserCredential(tenant_id=tenant_id)
 
     # Create storage account
     storage_client = StorageManagementClient(credential, subscription_id)
@@ -44,9 +37,6 @@ def upload_disk(shared_data):
         storage_account = storage_client.storage_accounts.get_properties(resource_group, storage_account_name)
         #print("Storage account created")
 
- 
-
-    
     # Get storage account key
     keys = storage_client.storage_accounts.list_keys(resource_group, storage_account_name)
     storage_key = keys.keys[0].value
@@ -65,15 +55,295 @@ def upload_disk(shared_data):
         blob_service.create_container(container_name)
         #print("Container created")
 
-    # Upload VHD
-    blob_client = blob_service.get_blob_client(container=container_name, blob=blob_name)
+    return storage_account, storage_key
+
+
+def prepare_storage(shared_data):
+    """
+    Prepare the destination storage before the disk is there, so it runs next to the download.
+
+    Returns:
+        dict: account_url and storage_id, the same keys upload_disk returns
+    """
+    import sys
+    sys.path.append(r"C:/projects/digitalnomadsky/code/Microsoft")
+    from azure.identity import InteractiveBrowserCredential
+    import config
+
+    if config.upload_mode == "managed_disk":
+        # the disk is uploaded straight into a managed disk, no storage account is needed
+        return {}
+
+    credential = InteractiveBrowserCredential(tenant_id=config.destionationtenantid)
+    storage_account, storage_key = ensure_storage(credential)
+    result = {
+        'account_url': f"https://{config.storage_account_name}.blob.core.windows.net",
+        'storage_id': storage_account.id
+    }
+    return result
+
+
+def open_managed_disk_upload(shared_data, size):
+    """
+    Create an empty managed disk for an upload of size bytes (a fixed VHD) and open it for writing.
+    A disk is only taken as uploaded when the ledger of this migration says its upload was finished; the write
+    access of an upload that was cut off is used again, any other disk of that name is deleted and created anew.
+
+    Returns:
+        tuple: (compute client, disk, BlobClient on the write SAS url or None when the disk is already uploaded)
+    """
+    import sys
+    import time
+    sys.path.append(r"C:/projects/digitalnomadsky/code/Microsoft")
+    from azure.identity import InteractiveBrowserCredential
+    from azure.mgmt.compute import ComputeManagementClient
+    from azure.mgmt.compute.models import Disk, CreationData, DiskCreateOption, DiskSecurityProfile, SecurityTypes, GrantAccessData
+    from azure.storage.blob import BlobClient
+    from azure.core.exceptions import ResourceNotFoundError
+    import config
+    sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/basic")
+    import migration_ledger
+
+    vm_name = shared_data.get('vm_name', '')
+    disk_name = f"disk-name-mooi-{vm_name}"
+    credential = InteractiveBrowserCredential(tenant_id=config.destionationtenantid)
+    compute_client = ComputeManagementClient(credential, config.subscription_id)
+    sas_seconds = 86400
+
     try:
-        blob_client.get_blob_properties()
-        #print("Blob already exists")
+        disk = compute_client.disks.get(config.resource_group, disk_name)
     except ResourceNotFoundError:
+        disk = None
+
+    if disk is not None:
+        uploaded = migration_ledger.find_artifact('managed_disk_uploaded')
+        write_access = migration_ledger.find_artifact('managed_disk_sas') or {}
+        if uploaded == disk.id and disk.disk_state != 'ActiveUpload':
+            return compute_client, disk, None
+        same_size = disk.creation_data.upload_size_bytes == size
+        if (disk.disk_state == 'ActiveUpload' and same_size and write_access.get('disk_id') == disk.id
+                and write_access.get('expires', 0) > time.time() + 3600):
+            # an upload of before a restart: the same write access is used, revoking it would close the disk half written
+            return compute_client, disk, BlobClient.from_blob_url(write_access['url'])
+        if disk.disk_state != 'ReadyToUpload' or not same_size:
+            # a disk of an earlier attempt without a finished upload, whose write access is gone or of another size:
+            # start over
+            if disk.disk_state == 'ActiveUpload':
+                compute_client.disks.begin_revoke_access(config.resource_group, disk_name).result()
+            compute_client.disks.begin_delete(config.resource_group, disk_name).result()
+            disk = None
+
+    if disk is None:
+        disk_params = Disk(
+            location=config.location,
+            hyper_v_generation='V2',  # the same disk settings create_vm uses for an imported disk
+            security_profile=DiskSecurityProfile(
+              security_type=SecurityTypes.TRUSTED_LAUNCH),
+            creation_data=CreationData(
+                create_option=DiskCreateOption.UPLOAD,
+                upload_size_bytes=size
+            ),
+            os_type=shared_data.get('os_type', '')
+        )
+        disk = compute_client.disks.begin_create_or_update(config.resource_group, disk_name, disk_params).result()
+
+    sas = compute_client.disks.begin_grant_access(
+        config.resource_group,
+        disk_name,
+        GrantAccessData(access='Write', duration_in_seconds=sas_seconds)
+    ).result()
+    migration_ledger.record_artifact('managed_disk_sas', {'disk_id': disk.id, 'url': sas.access_sas,
+                                                          'expires': time.time() + sas_seconds})
+    return compute_client, disk, BlobClient.from_blob_url(sas.access_sas)
+
+
+def close_managed_disk_upload(compute_client, disk):
+    """Revoke the write access, the disk can then be attached to a VM. The ledger marks the upload as finished."""
+    import sys
+    sys.path.append(r"C:/projects/digitalnomadsky/code/Microsoft")
+    import config
+    sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/basic")
+    import migration_ledger
+
+    compute_client.disks.begin_revoke_access(config.resource_group, disk.name).result()
+    migration_ledger.record_artifact('managed_disk_uploaded', disk.id)
+    migration_ledger.record_artifact('managed_disk_sas', None)
+
+
+def upload_managed_disk(shared_data):
+    """
+    Upload the VHD straight into a new managed disk: no storage account, no import copy and no blob left behind.
+
+    Returns:
+        dict: disk_id and disk_name, create_vm attaches this disk
+    """
+    import sys
+    import os
+    sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/basic")
+    import page_blob_upload
+    import progress_events
+    import qcow2_reader
+
+    vhd_path = shared_data.get('output_path', '')
+    if qcow2_reader.is_qcow2(vhd_path):
+        # the transform step left the qcow2 as it is, only its allocated clusters are written
+        with qcow2_reader.Qcow2Image(vhd_path) as image:
+            vhd_size, blocks = image.fixed_vhd()
+            compute_client, disk, blob_client = open_managed_disk_upload(shared_data, vhd_size)
+            if blob_client is not None:
+                progress = progress_events.ProgressReporter(total_bytes=image.allocated_bytes(), action="upload")
+                page_blob_upload.upload_extents(blob_client, page_blob_upload.nonzero_extents(blocks), progress=progress)
+                close_managed_disk_upload(compute_client, disk)
+                progress.done()
+        return {'disk_id': disk.id, 'disk_name': disk.name}
+
+    file_size = os.path.getsize(vhd_path)
+    compute_client, disk, blob_client = open_managed_disk_upload(shared_data, file_size)
+    if blob_client is not None:
+        progress = progress_events.ProgressReporter(total_bytes=file_size, action="upload")
+        # the disk already has its full size, only the parts that are not zero are written
+        with open(vhd_path, "rb") as f:
+            blocks = page_blob_upload.numbered(page_blob_upload.file_blocks(f, progress))
+            page_blob_upload.upload_extents(blob_client, page_blob_upload.nonzero_extents(blocks))
+        close_managed_disk_upload(compute_client, disk)
+        progress.done()
+
+    result = {
+        'disk_id': disk.id,
+        'disk_name': disk.name
+    }
+    return result
+
+
+def upload_stream(shared_data, chunks, size, disktype):
+    """
+    Upload a disk that arrives as chunks (streaming mode) to a page blob, page by page.
+
+    Returns:
+        dict: account_url and storage_id, like upload_disk
+    """
+    import sys
+    sys.path.append(r"C:/projects/digitalnomadsky/code/Microsoft")
+    from azure.storage.blob import BlobServiceClient
+    from azure.identity import InteractiveBrowserCredential
+    import config
+    sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/basic")
+    import stream_pipeline
+    import page_blob_upload
+
+    if config.upload_mode == "managed_disk":
+        compute_client, disk, blob_client = open_managed_disk_upload(shared_data, size)
+        if blob_client is not None:
+            blocks = stream_pipeline.aligned_chunks(chunks, page_blob_upload.block_size)
+            page_blob_upload.upload_extents(blob_client, page_blob_upload.nonzero_extents(page_blob_upload.numbered(blocks)))
+            close_managed_disk_upload(compute_client, disk)
+        return {'disk_id': disk.id, 'disk_name': disk.name}
+
+    vm_name = shared_data.get('vm_name', '')
+    blob_name = f"osdisk{vm_name}.{disktype}"
+    account_url = f"https://{config.storage_account_name}.blob.core.windows.net"
+
+    credential = InteractiveBrowserCredential(tenant_id=config.destionationtenantid)
+    storage_account, storage_key = ensure_storage(credential)
+    blob_service = BlobServiceClient(account_url=account_url, credential=storage_key)
+    blob_client = blob_service.get_blob_client(container=config.container_name, blob=blob_name)
+
+    # a page blob has a fixed size of whole 512 byte pages, the parts that are not zero are written as they arrive
+    blocks = stream_pipeline.aligned_chunks(chunks, page_blob_upload.block_size)
+    page_blob_upload.upload_blocks(blob_client, size, blocks, remote=sibling_blocks(account_url, storage_key, blob_name))
+
+    result = {
+        'account_url': account_url,
+        'storage_id': storage_account.id
+    }
+    return result
+
+
+def sibling_blocks(account_url, storage_key, blob_name):
+    """
+    The blocks other disks in the container already hold, with the block store on, so the upload of blob_name
+    lets Azure copy them from there. None when the block store is off.
+    """
+    import sys
+    from datetime import datetime, timedelta, timezone
+    from azure.storage.blob import generate_blob_sas, BlobSasPermissions
+    sys.path.append(r"C:/projects/digitalnomadsky/code/Microsoft")
+    sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/basic")
+    import config
+    import block_store
+
+    if not block_store.enabled():
+        return None
+
+    def source_url(location):
+        sas = generate_blob_sas(
+            account_name=config.storage_account_name,
+            container_name=config.container_name,
+            blob_name=location,
+            account_key=storage_key,
+            permission=BlobSasPermissions(read=True),
+            expiry=datetime.now(timezone.utc) + timedelta(days=1)
+        )
+        return f"{account_url}/{config.container_name}/{location}?{sas}"
+
+    return block_store.RemoteBlocks(f"{account_url}/{config.container_name}", blob_name, source_url)
+
+
+def upload_disk(shared_data):
+    
+    import sys
+    sys.path.append(r"C:/projects/digitalnomadsky/code/Microsoft")
+    from azure.storage.blob import BlobServiceClient, BlobClient
+    import os
+    from azure.identity import InteractiveBrowserCredential
+    import config
+    from azure.core.exceptions import ResourceNotFoundError
+
+    if config.upload_mode == "managed_disk":
+        return upload_managed_disk(shared_data)
+
+
+    # Variables
+    subscription_id = config.subscription_id
+    resource_group = config.resource_group
+    storage_account_name = config.storage_account_name 
+    location = config.location 
+    container_name = config.container_name
+    vhd_path = shared_data.get('output_path', '')
+    disktype = shared_data.get('importdisktype', '')
+    vm_name = shared_data.get('vm_name', '')
+    blob_name = f"osdisk{vm_name}.{disktype}"
+    account_url = f"https://{storage_account_name}.blob.core.windows.net"
+
+    tenant_id = config.destionationtenantid
+    credential = InteractiveBrowserCredential(tenant_id=tenant_id)
+
+    storage_account, storage_key = ensure_storage(credential)
+    blob_service = BlobServiceClient(account_url=account_url, credential=storage_key)
+
+    # Upload VHD, a blob of an upload that did not finish is uploaded again
+    sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/basic")
+    import page_blob_upload
+    import qcow2_reader
+    blob_client = blob_service.get_blob_client(container=container_name, blob=blob_name)
+    if not page_blob_upload.is_complete(blob_client) and qcow2_reader.is_qcow2(vhd_path):
+        import progress_events
+        # the transform step left the qcow2 as it is, the blob becomes a fixed VHD of its allocated clusters
+        with qcow2_reader.Qcow2Image(vhd_path) as image:
+            vhd_size, blocks = image.fixed_vhd()
+            progress = progress_events.ProgressReporter(total_bytes=image.allocated_bytes(), action="upload")
+            page_blob_upload.upload_sparse(blob_client, vhd_size, blocks, progress=progress,
+                                           remote=sibling_blocks(account_url, storage_key, blob_name))
+            progress.done()
+    elif not page_blob_upload.is_complete(blob_client):
         #print("Uploading VHD...")
-        with open(vhd_path, "rb") as data:
-            blob_client.upload_blob(data, blob_type="PageBlob", overwrite=False)
+        import progress_events
+        file_size = os.path.getsize(vhd_path)
+        progress = progress_events.ProgressReporter(total_bytes=file_size, action="upload")
+        # only the parts of the disk that are not zero are sent, the other pages of a page blob read as zero
+        page_blob_upload.upload_file(blob_client, vhd_path, file_size, progress=progress,
+                                     remote=sibling_blocks(account_url, storage_key, blob_name))
+        progress.done()
         #print(f"VHD uploaded: {blob_client.url}")
     result = {
         'account_url': account_url,
@@ -1,12 +1,16 @@
 import webview
-from urllib.parse import urlparse, parse_qs
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response
 from flask_cors import CORS
-import subprocess
 import threading
-import json
+import sys
 from datetime import datetime
 
+sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/basic")
+import step_runner
+import migration_jobs
+import progress_events
+import conversion_scheduler
+
 unique_id = datetime.now().strftime("%Y%m%d%H%M%S%f")
 
 # Flask setup
@@ -26,26 +30,88 @@ def run_script():
     destination = data.get('destination')
     vmname = data.get('vmname')
     extraValue = data.get('extraValue', {})
+    mode = data.get('mode')  # optional: 'subprocess' to run this step isolated in its own python process
+    # the ledger keeps the artifacts of every VM apart, the session id is shared by all VMs of this session
+    extraValue = dict(extraValue or {}, job_id=f"{unique_id}-{source}-{destination}-{vmname}")
     
-    # Path to your scripts
-    script_path = f'C:/projects/digitalnomadsky/code/nomadsky-engine/scripts/{script_name}'  
+    result = step_runner.run_step(script_name, source, destination, vmname, extraValue, unique_id, mode)
+    if result['success']:
+        return jsonify(result)
+    else:
+        return jsonify(result), 500
+
+# Flask API endpoints to run a whole migration on the server
+@app.route('/api/migrations', methods=['POST'])
+def start_migration():
+    data = request.json
+    source = data.get('source')
+    destination = data.get('destination')
+    vmname = data.get('vmname')
+    priority = data.get('priority', 0)  # optional: a higher priority converts first when migrations wait for a slot
+    if not source or not destination or not vmname:
+        return jsonify({
+            'success': False,
+            'error': 'source, destination and vmname are required'
+        }), 400
     try:
-        result = subprocess.run(
-            ['python', script_path, source, destination, vmname, json.dumps(extraValue), unique_id],
-            capture_output=True,
-            text=True,
-            check=True
-        )
-        
+        priority = int(priority)
+    except (TypeError, ValueError):
         return jsonify({
-            'success': True,
-            'output': result.stdout
-        })
-    except subprocess.CalledProcessError as e:
+            'success': False,
+            'error': 'priority must be a whole number'
+        }), 400
+
+    job = migration_jobs.start_migration(source, destination, vmname, priority)
+    return jsonify({
+        'success': True,
+        'job_id': job.job_id
+    })
+
+@app.route('/api/migrations', methods=['GET'])
+def list_migrations():
+    return jsonify([job.to_dict() for job in migration_jobs.list_jobs()])
+
+@app.route('/api/migrations/<job_id>/resume', methods=['POST'])
+def resume_migration(job_id):
+    job = migration_jobs.resume_migration(job_id)
+    if job is None:
         return jsonify({
             'success': False,
-            'error': e.stderr
-        }), 500
+            'error': f"migration '{job_id}' not found"
+        }), 404
+    return jsonify({
+        'success': True,
+        'job_id': job.job_id
+    })
+
+@app.route('/api/migrations/<job_id>', methods=['GET'])
+def get_migration(job_id):
+    job = migration_jobs.get_job(job_id)
+    if job is None:
+        return jsonify({
+            'success': False,
+            'error': f"migration '{job_id}' not found"
+        }), 404
+    return jsonify(job.to_dict())
+
+# Conversion scheduler: slots, queue depth and the throughput of every running conversion
+@app.route('/api/conversions', methods=['GET'])
+def conversions():
+    return jsonify(conversion_scheduler.scheduler().status())
+
+# Progress events: the steps post them, the UI reads them as Server-Sent Events
+@app.route('/api/progress', methods=['POST'])
+def post_progress():
+    progress_events.publish(request.json)
+    return jsonify({'success': True})
+
+@app.route('/api/progress/<unique_id>', methods=['GET'])
+def progress_stream(unique_id):
+    return Response(
+        progress_events.sse_stream(unique_id),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache'}
+    )
 
 def run_flask():
     """Run Flask in background thread"""
@@ -85,7 +151,9 @@ class Api:
 with open('C:/projects/digitalnomadsky/code/nomadsky-engine/UI/frontend.html', 'r') as f:
     form_html = f.read()
 
-# Start Flask in background thread
+# Start the warm step workers and Flask in background thread
+step_runner.start_workers()
+migration_jobs.resume_migrations()
 flask_thread = threading.Thread(target=run_flask, daemon=True)
 flask_thread.start()
 
@@ -46,75 +46,126 @@ function updateStep(stepId, status, customMessage = null, extraData = null) {
     }
 }
 
-// Run a single script via Flask
-async function runScript(stepId, scriptName, successMessage, sharedData) {
-    updateStep(stepId, 'running', 'Processing...');
-    
-    const bodyObj = {
-        script: scriptName,
+// Start the migration on the server, the engine runs all steps
+async function startMigration() {
+    const body = JSON.stringify({
         source: source,
         destination: destination,
-        vmname: vmname,
-        extraValue: sharedData
-    };
-    const body = JSON.stringify(bodyObj);  
-    try {     
-            const response = await fetch('http://localhost:5000/api/run-script', {
-            method: 'POST',
-            headers: {'Content-Type': 'application/json'},
-            body: body 
-        });
-        const result = await response.json();
+        vmname: vmname
+    });
+    const response = await fetch('http://localhost:5000/api/migrations', {
+        method: 'POST',
+        headers: {'Content-Type': 'application/json'},
+        body: body
+    });
+    const result = await response.json();
+    if (!result.success) {
+        throw new Error(result.error);
+    }
+    return result.job_id;
+}
+
+// Step element of every step script, filled from the job
+const stepIds = {};
+
+function formatBytes(bytes) {
+    const units = ['B', 'KB', 'MB', 'GB', 'TB'];
+    let i = 0;
+    while (bytes >= 1024 && i < units.length - 1) {
+        bytes /= 1024;
+        i++;
+    }
+    return `${bytes.toFixed(1)} ${units[i]}`;
+}
 
-        if (result.success) {
-            const data = JSON.parse(result.output);
-            updateStep(stepId, 'completed', data.message);
-            return result
-        } else {
-            updateStep(stepId, 'error', 'Script failed', {
+function formatSeconds(seconds) {
+    seconds = Math.round(seconds);
+    const h = Math.floor(seconds / 3600);
+    const m = Math.floor((seconds % 3600) / 60);
+    const s = seconds % 60;
+    return `${h}:${String(m).padStart(2, '0')}:${String(s).padStart(2, '0')}`;
+}
+
+// Show a progress event (bytes, throughput and ETA) under the running step
+function showProgress(event) {
+    const stepId = stepIds[event.step];
+    if (!stepId) return;
+    const step = document.getElementById(stepId);
+    let details = step.querySelector('.progress-details');
+    if (event.status === 'completed') {
+        if (details) details.remove();
+        return;
+    }
+    if (!details) {
+        details = document.createElement('div');
+        details.className = 'progress-details status-description';
+        step.querySelector('.status-content').appendChild(details);
+    }
+    let text = `${event.action}: ${formatBytes(event.bytes_done)}`;
+    if (event.total_bytes) {
+        text += ` of ${formatBytes(event.total_bytes)} (${Math.floor(100 * event.bytes_done / event.total_bytes)}%)`;
+    }
+    text += ` · ${formatBytes(event.throughput)}/s`;
+    if (event.eta !== null) {
+        text += ` · ETA ${formatSeconds(event.eta)}`;
+    }
+    details.textContent = text;
+}
+
+// Follow the progress events of the job as Server-Sent Events
+function watchProgress(jobId) {
+    const events = new EventSource(`http://localhost:5000/api/progress/${jobId}`);
+    events.onmessage = (message) => showProgress(JSON.parse(message.data));
+    return events;
+}
+
+// Show the state of the job on the page
+function showJob(job) {
+    for (const step of job.steps) {
+        stepIds[step.script] = step.id;
+        if (step.status === 'error') {
+            updateStep(step.id, 'error', step.message, {
                 type: 'error',
-                message: result.error
+                message: step.error
             });
-            return false;
+        } else if (step.status !== 'pending') {
+            updateStep(step.id, step.status, step.message);
         }
+    }
+}
+
+// Observe a migration job until it is finished
+async function runMigration() {
+    let jobId;
+    try {
+        jobId = await startMigration();
     } catch (error) {
-        updateStep(stepId, 'error', error.message, {
+        updateStep('step1', 'error', error.message, {
             type: 'error',
             message: error.message
         });
-        return false;
+        return;
     }
-}
-// successMessage ||
+    const progressEvents = watchProgress(jobId);
 
-    
-// Run all migration steps
-async function runMigration() {
-    const steps = [
-        { id: 'step1', script: 'fetch_vm.py', message: 'VM found successfully!'},  
-        { id: 'step2', script: 'stop_vm.py', message: 'VM stopped successfully' },
-        { id: 'step3', script: 'download_vm.py', message: 'Download completed' },
-        { id: 'step4', script: 'transform_vm.py', message: 'Format conversion completed'},
-        { id: 'step5', script: 'upload_image.py', message: 'Upload completed successfully' },
-        { id: 'step6', script: 'create_network.py', message: 'Network resources created' },
-        { id: 'step7', script: 'start_vm.py', message: 'VM is now running!' }
-    ];
+    while (true) {
+        try {
+            const response = await fetch(`http://localhost:5000/api/migrations/${jobId}`);
+            const job = await response.json();
+            showJob(job);
 
-    let sharedData = {
-    message: 'empthy'
-    }; // Store data from previous steps
-    
-    for (const step of steps) {
-        const success = await runScript(step.id, step.script, step.message, sharedData);
-        if (!success.success) {
-            return; // Stop on error
+            if (job.status === 'completed') {
+                progressEvents.close();
+                break;
+            }
+            if (job.status === 'failed') {
+                progressEvents.close();
+                return; // Stop on error
+            }
+        } catch (error) {
+            // the engine may be busy, try again on the next poll
         }
-        // Parse output and add to shared data
-        const dataout = JSON.parse(success.output); 
-        delete sharedData.message; 
-        sharedData = { ...sharedData, ...dataout }; // Merge new data
-        
-        await new Promise(resolve => setTimeout(resolve, 500)); // Small delay between steps
+        await new Promise(resolve => setTimeout(resolve, 2000));
     }
     
     // Show success banner
@@ -125,4 +176,3 @@ async function runMigration() {
 
 // Start migration when page loads
 window.addEventListener('load', runMigration);
-
@@ -0,0 +1,247 @@
+# -------------------------------
+# Index of the disk files staged in C:\Temp: the downloaded disks and their converted copies.
+# Every artifact is recorded under a key of source platform, VM name, resource id of the VM, format and kind
+# ("download" or "converted"), with its size, modification time and the root of its integrity manifest; an artifact
+# that has no manifest yet (a converted disk) is hashed once when it is registered. A step asks the cache before
+# it downloads or converts; a hit must still have the recorded size, modification time and manifest root, and must
+# not be older than general_parameters.artifact_cache_max_age, so a disk of another day is never taken for the
+# current one.
+# The artifacts together stay below general_parameters.artifact_cache_budget bytes: before a new artifact is
+# written, the least recently used ones are deleted until the budget and the free space of the disk allow it.
+# Artifacts of migrations that are still running are never deleted.
+# A migration with a warm copy in the ledger whose delta is not applied yet never gets a cached download: its disk is
+# the pre-copied image plus the changes after the stop.
+# The steps run in other processes, so every call opens its own short connection, like the migration ledger.
+# -------------------------------
+import sys
+import os
+import time
+import shutil
+import sqlite3
+
+sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/scripts")
+sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/basic")
+import general_parameters
+import migration_ledger
+import integrity
+import block_store
+
+# files that belong to an artifact and go with it
+sidecars = (".ranges", ".blocks.json", ".integrity.json", ".part")
+
+# ledger artifacts of a pre-copy (Azure, AWS), set until the delta after the stop is applied
+precopy_artifacts = ('precopy_snapshot', 'precopy_snapshot_id')
+
+_schema = """
+CREATE TABLE IF NOT EXISTS artifacts (
+    path TEXT PRIMARY KEY,
+    key TEXT,
+    kind TEXT,
+    parent TEXT,
+    size INTEGER,
+    root TEXT,
+    mtime INTEGER,
+    job_id TEXT,
+    created REAL,
+    last_used REAL
+);
+CREATE INDEX IF NOT EXISTS artifacts_key ON artifacts (key, created);
+"""
+
+
+def connect():
+    path = general_parameters.artifact_cache_path
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    connection = sqlite3.connect(path, timeout=30)
+    connection.row_factory = sqlite3.Row
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.executescript(_schema)
+    columns = [row['name'] for row in connection.execute("PRAGMA table_info(artifacts)")]
+    if 'mtime' not in columns:
+        # a cache of an earlier version, its artifacts have no modification time and are not valid anymore
+        connection.execute("ALTER TABLE artifacts ADD COLUMN mtime INTEGER")
+    return connection
+
+
+def _execute(query, parameters=()):
+    connection = connect()
+    try:
+        with connection:
+            return connection.execute(query, parameters).fetchall()
+    finally:
+        connection.close()
+
+
+def cache_key(source, vmname, resource_id, disk_format, kind="download"):
+    return "|".join([source or '', (vmname or '').lower(), resource_id or '', disk_format or '', kind])
+
+
+def _job_id():
+    return migration_ledger.current_job() or ''
+
+
+def _root(path):
+    manifest = integrity.read_manifest(path)
+    return manifest['root'] if manifest else None
+
+
+def _mtime(path):
+    return os.stat(path).st_mtime_ns
+
+
+def _manifest(path):
+    # the root of the artifact, a file that was not hashed while it was written is read once for it
+    root = _root(path)
+    if root is None:
+        manifest = integrity.TreeHash(os.path.getsize(path)).finish(path)
+        integrity.write_manifest(path, manifest)
+        root = manifest['root']
+    return root
+
+
+def _allocated(path):
+    # a sparse file only takes the space of its written parts
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return 0
+    if getattr(stat, 'st_blocks', None) is not None:
+        return min(stat.st_size, stat.st_blocks * 512)
+    return stat.st_size
+
+
+def _usage(row):
+    return sum(_allocated(row['path'] + suffix) for suffix in ("",) + sidecars)
+
+
+def _present(row):
+    # the blocks when the block store holds the disk (a checked out file is a copy of them), or else the file itself
+    if block_store.enabled() and block_store.is_stored(row['path']):
+        return True
+    if not os.path.exists(row['path']):
+        return False
+    return os.path.getsize(row['path']) == row['size'] and _mtime(row['path']) == row['mtime'] \
+        and row['root'] is not None and _root(row['path']) == row['root']
+
+
+def _fresh(row):
+    return time.time() - row['created'] <= general_parameters.artifact_cache_max_age
+
+
+def precopy_pending(shared_data=None):
+    """True when the current migration has a pre-copy whose delta is not applied yet, in shared_data or the ledger."""
+    if any((shared_data or {}).get(kind) for kind in precopy_artifacts):
+        return True
+    return bool(_job_id()) and any(migration_ledger.find_artifact(kind) for kind in precopy_artifacts)
+
+
+def valid(path):
+    """True when path is a complete, unchanged and recent artifact of the cache; it counts as used."""
+    rows = _execute("SELECT * FROM artifacts WHERE path = ?", (path,))
+    if not rows or not _fresh(rows[0]) or not _present(rows[0]):
+        return False
+    _execute("UPDATE artifacts SET last_used = ?, job_id = ? WHERE path = ?", (time.time(), _job_id(), path))
+    return True
+
+
+def lookup(source, vmname, resource_id, disk_format, kind="download", parent=None):
+    """
+    The newest valid artifact with this key.
+
+    Args:
+        parent: for a converted artifact, the path of the disk it was converted from
+
+    Returns:
+        str: the path of the artifact, or None
+    """
+    if kind == "download" and precopy_pending():
+        return None  # a cached disk would skip the changes after the stop
+    rows = _execute("SELECT * FROM artifacts WHERE key = ? ORDER BY created DESC",
+                    (cache_key(source, vmname, resource_id, disk_format, kind),))
+    for row in rows:
+        if parent is not None and row['parent'] != _parent_id(parent):
+            continue
+        if _fresh(row) and _present(row):
+            _execute("UPDATE artifacts SET last_used = ?, job_id = ? WHERE path = ?",
+                     (time.time(), _job_id(), row['path']))
+            return row['path']
+    return None
+
+
+def _parent_id(parent):
+    # a converted artifact belongs to one download of its parent, not to every file on that path
+    rows = _execute("SELECT created FROM artifacts WHERE path = ?", (parent,))
+    return f"{parent}@{rows[0]['created']}" if rows else parent
+
+
+def register(path, source, vmname, resource_id, disk_format, kind="download", parent=None):
+    """Record a complete artifact; an earlier artifact on the same path is replaced."""
+    now = time.time()
+    root = _manifest(path)
+    _execute(
+        "INSERT OR REPLACE INTO artifacts (path, key, kind, parent, size, root, mtime, job_id, created, last_used) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (path, cache_key(source, vmname, resource_id, disk_format, kind), kind,
+         _parent_id(parent) if parent else None, os.path.getsize(path), root, _mtime(path), _job_id(), now, now)
+    )
+    evict()
+
+
+def remove(path):
+    """Delete an artifact, its side files and its blocks, and forget it."""
+    for suffix in ("",) + sidecars:
+        try:
+            os.remove(path + suffix)
+        except OSError:
+            pass
+    if block_store.enabled():
+        block_store.release(path)
+    _execute("DELETE FROM artifacts WHERE path = ?", (path,))
+
+
+def evict(needed=0, folder=None):
+    """
+    Delete the least recently used artifacts until the cache with needed bytes more stays within the budget,
+    and the disk of folder has needed bytes free. Artifacts of running migrations are kept.
+
+    Returns:
+        list: the deleted paths
+    """
+    rows = _execute("SELECT * FROM artifacts ORDER BY last_used")
+    # the current migration and the ones still running need their artifacts
+    keep = set(migration_ledger.incomplete_migrations()) | {_job_id()}
+    used = sum(_usage(row) for row in rows)
+    deleted = []
+
+    def short_of_space():
+        if used + needed > general_parameters.artifact_cache_budget:
+            return True
+        if folder and needed:
+            return shutil.disk_usage(folder).free < needed
+        return False
+
+    for row in rows:
+        if not short_of_space():
+            break
+        if row['job_id'] and row['job_id'] in keep:
+            continue
+        used -= _usage(row)
+        remove(row['path'])
+        deleted.append(row['path'])
+    return deleted
+
+
+def expected_bytes(shared_data):
+    """The size of the largest disk the fetch step found, 0 when it did not report sizes."""
+    disks = shared_data.get('disk_details') or shared_data.get('disks') or []
+    sizes = [disk.get('size_gb') or 0 for disk in disks if isinstance(disk, dict)]
+    return max(sizes, default=0) * 1024**3
+
+
+def reserve(needed, path):
+    """Make room for a new artifact of about needed bytes that will be written at path."""
+    folder = os.path.dirname(path) or "."
+    os.makedirs(folder, exist_ok=True)
+    return evict(needed, folder)
@@ -0,0 +1,276 @@
+# -------------------------------
+# Content-addressed store of disk blocks, shared by all migrations of the engine.
+# A wave of VMs made from the same base image holds mostly the same blocks. With general_parameters.block_store on,
+# a downloaded disk is cut into blocks of block_size bytes, every block is kept once under its SHA256 in
+# general_parameters.block_store_path, and the disk itself becomes a recipe: the list of its block hashes.
+# A step that needs the disk as a file gets it back with checkout() and drops it again with checkin().
+# The store also remembers where a destination already received a block (e.g. a page blob of a sibling VM),
+# so an upload can let the destination copy that block itself instead of sending it again.
+# The index is a SQLite database next to the blocks; the steps run in other processes, so every call opens its
+# own short connection, like the migration ledger.
+# -------------------------------
+import sys
+import os
+import json
+import hashlib
+import sqlite3
+
+sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/scripts")
+sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/basic")
+import general_parameters
+import ranged_download
+
+block_size = 4 * 1024 * 1024  # the size of an Azure upload_page call, so a stored block is also an uploaded block
+
+_zeros = bytes(block_size)
+
+_schema = """
+CREATE TABLE IF NOT EXISTS blocks (
+    hash TEXT PRIMARY KEY,
+    size INTEGER,
+    refs INTEGER
+);
+CREATE TABLE IF NOT EXISTS images (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    recipe TEXT
+);
+CREATE TABLE IF NOT EXISTS remote (
+    destination TEXT,
+    hash TEXT,
+    location TEXT,
+    offset INTEGER,
+    PRIMARY KEY (destination, hash)
+);
+CREATE INDEX IF NOT EXISTS remote_location ON remote (destination, location);
+"""
+
+
+def enabled():
+    return getattr(general_parameters, 'block_store', False)
+
+
+def connect():
+    os.makedirs(general_parameters.block_store_path, exist_ok=True)
+    connection = sqlite3.connect(os.path.join(general_parameters.block_store_path, "index.db"), timeout=30)
+    connection.row_factory = sqlite3.Row
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.executescript(_schema)
+    return connection
+
+
+def _execute(query, parameters=()):
+    connection = connect()
+    try:
+        with connection:
+            return connection.execute(query, parameters).fetchall()
+    finally:
+        connection.close()
+
+
+def block_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def block_path(digest):
+    return os.path.join(general_parameters.block_store_path, digest[:2], digest)
+
+
+def _write_block(digest, data):
+    path = block_path(digest)
+    if os.path.exists(path):
+        return False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "wb") as f:
+        f.write(data)
+    os.replace(temporary, path)
+    return True
+
+
+# -------------------------------
+# local images
+# -------------------------------
+def is_stored(path):
+    return bool(_execute("SELECT 1 FROM images WHERE path = ?", (path,)))
+
+
+def store_image(path, progress=None):
+    """
+    Put the disk at path in the store and remove the file, its blocks stay in the store.
+    Blocks of zeros are not stored, checkout() leaves them as holes.
+
+    Returns:
+        dict: block_recipe (path), stored_bytes (new in the store) and deduplicated_bytes (already in the store)
+    """
+    if is_stored(path):
+        release(path)
+    size = os.path.getsize(path)
+    recipe = []
+    sizes = {}
+    stored = 0
+    deduplicated = 0
+    connection = connect()
+    try:
+        with open(path, "rb") as f:
+            while True:
+                data = f.read(block_size)
+                if not data:
+                    break
+                if progress is not None:
+                    progress.add(len(data))
+                if _zeros.startswith(data):
+                    recipe.append(None)
+                    continue
+                digest = block_hash(data)
+                recipe.append(digest)
+                sizes[digest] = len(data)
+                if _write_block(digest, data):
+                    stored += len(data)
+                else:
+                    deduplicated += len(data)
+        with connection:
+            for digest in recipe:
+                if digest is not None:
+                    connection.execute(
+                        "INSERT INTO blocks (hash, size, refs) VALUES (?, ?, 1) "
+                        "ON CONFLICT (hash) DO UPDATE SET refs = refs + 1",
+                        (digest, sizes[digest]))
+            connection.execute("INSERT OR REPLACE INTO images (path, size, recipe) VALUES (?, ?, ?)",
+                               (path, size, json.dumps(recipe)))
+    finally:
+        connection.close()
+    # a release() of another disk between writing a block and counting it here can have deleted the block
+    with open(path, "rb") as f:
+        for index, digest in enumerate(recipe):
+            if digest is not None and not os.path.exists(block_path(digest)):
+                f.seek(index * block_size)
+                _write_block(digest, f.read(block_size))
+    os.remove(path)
+    return {
+        'block_recipe': path,
+        'stored_bytes': stored,
+        'deduplicated_bytes': deduplicated
+    }
+
+
+def checkout(path):
+    """Write the stored disk back to path as a sparse file, when the file is not there. Returns path."""
+    if os.path.exists(path):
+        return path
+    rows = _execute("SELECT size, recipe FROM images WHERE path = ?", (path,))
+    if not rows:
+        raise Exception(f"the disk '{path}' is neither on disk nor in the block store")
+    temporary = path + ".checkout"
+    open(temporary, "wb").close()
+    ranged_download.make_sparse(temporary)
+    os.truncate(temporary, rows[0]['size'])
+    with open(temporary, "r+b") as f:
+        for index, digest in enumerate(json.loads(rows[0]['recipe'])):
+            if digest is None:
+                continue
+            with open(block_path(digest), "rb") as block:
+                f.seek(index * block_size)
+                f.write(block.read())
+    os.replace(temporary, path)
+    return path
+
+
+def checkin(path):
+    """Remove the file of a stored disk again, the store keeps its blocks."""
+    if os.path.exists(path) and is_stored(path):
+        os.remove(path)
+
+
+def release(path):
+    """Forget a stored disk; blocks that no other disk uses are deleted."""
+    connection = connect()
+    try:
+        with connection:
+            rows = connection.execute("SELECT recipe FROM images WHERE path = ?", (path,)).fetchall()
+            if not rows:
+                return
+            digests = [digest for digest in json.loads(rows[0]['recipe']) if digest is not None]
+            connection.execute("DELETE FROM images WHERE path = ?", (path,))
+            for digest in digests:
+                connection.execute("UPDATE blocks SET refs = refs - 1 WHERE hash = ?", (digest,))
+            unused = [row['hash'] for row in connection.execute("SELECT hash FROM blocks WHERE refs <= 0")]
+            connection.execute("DELETE FROM blocks WHERE refs <= 0")
+    finally:
+        connection.close()
+    for digest in unused:
+        try:
+            os.remove(block_path(digest))
+        except OSError:
+            pass
+
+
+# -------------------------------
+# blocks a destination already has
+# -------------------------------
+class RemoteBlock:
+    """A block that is copied inside the destination from location/offset instead of being sent."""
+
+    def __init__(self, location, url, offset, data):
+        self.location = location
+        self.url = url
+        self.offset = offset
+        self.data = data  # sent after all when the copy fails, e.g. because the sibling was deleted
+
+    def __len__(self):
+        return len(self.data)
+
+
+class RemoteBlocks:
+    """
+    The blocks one destination (e.g. a storage container) already holds, for the upload to one location in it.
+
+    Args:
+        destination: name of the destination, e.g. the url of the container
+        location: the blob or object that is uploaded now
+        source_url: function from a location to a url the destination can copy from
+    """
+
+    def __init__(self, destination, location, source_url):
+        self.destination = destination
+        self.location = location
+        self.source_url = source_url
+        self.received = []
+        # the location is written anew, blocks recorded for its previous content are gone
+        _execute("DELETE FROM remote WHERE destination = ? AND location = ?", (destination, location))
+
+    def blocks(self, blocks):
+        """
+        Replace the full blocks the destination already holds by RemoteBlocks.
+
+        Args:
+            blocks: iterator of (offset, data) with blocks of block_size bytes at offsets of whole blocks
+        """
+        for offset, data in blocks:
+            if len(data) != block_size or offset % block_size or _zeros.startswith(data):
+                yield offset, data
+                continue
+            digest = block_hash(data)
+            rows = _execute("SELECT location, offset FROM remote WHERE destination = ? AND hash = ?",
+                            (self.destination, digest))
+            self.received.append((digest, offset))
+            if rows and rows[0]['location'] != self.location:
+                location = rows[0]['location']
+                yield offset, RemoteBlock(location, self.source_url(location), rows[0]['offset'], data)
+            else:
+                yield offset, data
+
+    def commit(self):
+        """Record the blocks of the finished upload, so the next sibling can copy them."""
+        connection = connect()
+        try:
+            with connection:
+                connection.executemany(
+                    "INSERT OR IGNORE INTO remote (destination, hash, location, offset) VALUES (?, ?, ?, ?)",
+                    [(self.destination, digest, self.location, offset) for digest, offset in self.received])
+        finally:
+            connection.close()
+
+    def forget(self, location):
+        """A location the destination could not copy from any more."""
+        _execute("DELETE FROM remote WHERE destination = ? AND location = ?", (self.destination, location))
@@ -0,0 +1,153 @@
+# -------------------------------
+# Scheduler of the disk conversions of all migrations the engine runs.
+# Every transform (and sparsify) step reads and writes a whole disk in C:\Temp; when a wave of migrations converts
+# at the same time, the conversions fight over the cores and the staging disk and all of them get slower.
+# The engine runs these steps only with a slot of the scheduler, asked for once the step has its step worker, so
+# the queue and the running conversions are steps that wait for nothing else. The number of slots follows from
+# the cores and from the bandwidth of the staging disk divided by the throughput of one conversion. Waiting
+# conversions are started by priority of their migration, then smallest disk first, so the wave finishes as many
+# disks as early as possible. A conversion gets the cores of its slot as 'conversion_processes' in its shared_data.
+# status() gives the queue and the throughput of every running conversion, from its progress events.
+# -------------------------------
+import sys
+import os
+import time
+import heapq
+import itertools
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/scripts")
+sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/basic")
+import general_parameters
+import progress_events
+import qemu_convert
+import format_planner
+import artifact_cache
+
+staging_path = r"C:\Temp"
+cores_per_conversion = 4  # a qemu-img convert with 16 coroutines or a decode on a process pool keeps about 4 cores busy
+staging_bandwidth = {"ssd": 1000 * 1024**2, "hdd": 150 * 1024**2, "unknown": 300 * 1024**2}  # bytes per second
+
+
+def pool_size():
+    """The number of conversions that run at the same time: general_parameters.conversion_slots, or by cores and disk."""
+    if general_parameters.conversion_slots:
+        return general_parameters.conversion_slots
+    by_cores = max(1, (os.cpu_count() or 1) // cores_per_conversion)
+    bandwidth = general_parameters.staging_disk_bandwidth or staging_bandwidth[qemu_convert.media(staging_path)]
+    per_conversion, _ = format_planner.measured_throughput("convert", "local", general_parameters.planner_convert_throughput)
+    # a conversion reads its input and writes its output on the staging disk
+    by_disk = max(1, int(bandwidth // (2 * per_conversion)))
+    return min(by_cores, by_disk)
+
+
+def needs_slot(script, shared_data):
+    """True when the step converts a disk in the staging folder."""
+    if script == "transform_vm.py":
+        return not shared_data.get('streamed')
+    if script == "sparsify_vm.py":
+        return general_parameters.sparsify and not shared_data.get('streamed')
+    return False
+
+
+def conversion_size(shared_data):
+    """The bytes of the disk a step converts: the staged file, or the size the fetch step reported."""
+    path = shared_data.get('output_path') or ''
+    if path and os.path.exists(path):
+        return os.path.getsize(path)
+    return artifact_cache.expected_bytes(shared_data)
+
+
+class ConversionScheduler:
+    """
+    A fixed number of conversion slots and the priority queue of the conversions waiting for one.
+    """
+
+    def __init__(self, slots):
+        self.slots = max(1, slots)
+        self.processes = max(1, (os.cpu_count() or 1) // self.slots)
+        self.condition = threading.Condition()
+        self.waiting = []  # heap of (-priority, size, sequence)
+        self.entries = {}  # sequence -> conversion, queued or running
+        self.running = set()
+        self.finished = deque(maxlen=50)
+        self.sequence = itertools.count()
+
+    def acquire(self, job_id, step, size, priority=0):
+        """
+        Wait for a slot, step is the script of the conversion step.
+
+        Returns:
+            dict: the conversion, to be given back to release()
+        """
+        with self.condition:
+            number = next(self.sequence)
+            key = (-priority, size, number)
+            conversion = {'job_id': job_id, 'step': step, 'size': size, 'priority': priority,
+                          'queued': time.time(), 'started': None, 'processes': self.processes, 'number': number}
+            self.entries[number] = conversion
+            heapq.heappush(self.waiting, key)
+            while self.waiting[0] != key or len(self.running) >= self.slots:
+                self.condition.wait()
+            heapq.heappop(self.waiting)
+            self.running.add(number)
+            conversion['started'] = time.time()
+            self.condition.notify_all()  # the next in line may get a free slot too
+        return conversion
+
+    def release(self, conversion):
+        with self.condition:
+            self.running.discard(conversion['number'])
+            self.entries.pop(conversion['number'], None)
+            seconds = time.time() - conversion['started']
+            self.finished.append(dict(conversion, seconds=seconds,
+                                      throughput=conversion['size'] / seconds if seconds > 0 else None))
+            self.condition.notify_all()
+
+    @contextmanager
+    def slot(self, job_id, step, size, priority=0):
+        conversion = self.acquire(job_id, step, size, priority)
+        try:
+            yield conversion
+        finally:
+            self.release(conversion)
+
+    def status(self):
+        """
+        Returns:
+            dict: slots, queue_depth, the running and queued conversions (with the current throughput of the running
+            ones in bytes per second), the total throughput and the last finished conversions
+        """
+        with self.condition:
+            running = [dict(self.entries[number]) for number in self.running]
+            queued = [dict(self.entries[number]) for _, _, number in sorted(self.waiting)]
+            finished = list(self.finished)
+        for conversion in running:
+            # the step posts its progress under the migration id and its script name
+            events = [event for event in progress_events.latest(conversion['job_id'])
+                      if event.get('step') == conversion['step'] and event.get('status') == 'running']
+            conversion['throughput'] = sum(event.get('throughput') or 0 for event in events)
+            conversion['bytes_done'] = sum(event.get('bytes_done') or 0 for event in events)
+        return {
+            'slots': self.slots,
+            'processes_per_slot': self.processes,
+            'queue_depth': len(queued),
+            'running': running,
+            'queued': queued,
+            'throughput': sum(conversion['throughput'] for conversion in running),
+            'finished': finished
+        }
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def scheduler():
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = ConversionScheduler(pool_size())
+        return _scheduler
@@ -0,0 +1,210 @@
+# -------------------------------
+# Planner of the disk formats of a migration.
+# The source exports some formats, the destination imports some others, and the transform step can convert between
+# them natively (raw <-> fixed VHD in place, qcow2 and streamOptimized VMDK to a sparse raw) or with qemu-img.
+# plan() models this as a weighted graph: the download of an export format, every conversion and the upload of an
+# import format are edges, with as cost the seconds they are expected to take. The bytes come from the disk size,
+# the allocated fraction and whether a format (or the API of a platform) skips the zeros; the speeds are the
+# throughputs the progress reports measured on earlier migrations (migration_ledger), or the defaults in
+# general_parameters. Dijkstra gives the cheapest chain of zero or more conversions, and the plan says why.
+# -------------------------------
+import sys
+import os
+import heapq
+
+sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/scripts")
+sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/basic")
+import general_parameters
+import migration_ledger
+
+# the disk image formats the transform step can read and write; sparse formats only hold the allocated data,
+# compression is the size of the allocated data in the file relative to the disk
+formats = {
+    "raw": {'sparse': False, 'compression': 1.0},
+    "vhd": {'sparse': False, 'compression': 1.0},
+    "vmdk": {'sparse': True, 'compression': 0.5},  # streamOptimized, deflated grains
+    "qcow2": {'sparse': True, 'compression': 1.0},
+    "vhdx": {'sparse': True, 'compression': 1.0},
+    "vdi": {'sparse': True, 'compression': 1.0},
+    "qed": {'sparse': True, 'compression': 1.0},
+    "qcow": {'sparse': True, 'compression': 1.0},
+}
+
+# the download step of these platforms always delivers one format, whatever else preferred_type lists
+delivered = {
+    "aws": ("vhd",),  # an export task to VHD, or an EBS direct read of the raw disk
+    "huawei": ("qcow2",),
+    "gcp": ("vmdk",),
+}
+
+compressed_qcow2 = 0.5  # size of the data in a qcow2 the transform step compresses (general_parameters.qcow2_compression)
+
+hop_seconds = 1.0  # fixed cost of a conversion, so of two equal chains the one with fewer hops wins
+
+# transfers of a full-size format that still only move the allocated data
+sparse_transfers = {
+    ("azure", "export", "vhd"),  # the download reads the page ranges of the disk
+    ("azure", "import", "vhd"),  # the page blob upload skips the zero pages
+    ("aws", "export", "vhd"),  # the EBS direct read lists the snapshot blocks
+    ("aws", "export", "raw"),
+}
+
+
+def measured_throughput(action, platform, default):
+    """
+    Returns:
+        tuple: (bytes per second measured on earlier migrations, or default, and "measured" or "default")
+    """
+    try:
+        measured = migration_ledger.average_throughput(action, platform)
+    except Exception:
+        measured = None
+    if measured:
+        return measured, "measured"
+    return default, "default"
+
+
+def transfer_bytes(disk_format, platform, direction, size, allocated_fraction, converted=False):
+    """
+    The bytes a download (direction 'export') or upload ('import') of the disk in disk_format moves.
+    A converted disk is written by qemu-img or the transform step, uncompressed.
+    """
+    profile = formats.get(disk_format)
+    if profile is None:
+        return size  # an appliance or platform specific format, assume the whole disk
+    if converted and disk_format == "qcow2" and general_parameters.qcow2_compression:
+        return size * allocated_fraction * compressed_qcow2
+    if profile['sparse']:
+        return size * allocated_fraction * (1.0 if converted else profile['compression'])
+    if (platform, direction, disk_format) in sparse_transfers:
+        return size * allocated_fraction
+    return size
+
+
+def file_bytes(disk_format, size, allocated_fraction, written=False):
+    """The bytes a converter reads or writes (uncompressed) for the disk in disk_format on local disk."""
+    profile = formats[disk_format]
+    if profile['sparse']:
+        return size * allocated_fraction * (1.0 if written else profile['compression'])
+    return size
+
+
+def conversions(destination, size, allocated_fraction, convert_speed, processes):
+    """
+    The conversions the transform step can do in one go.
+
+    Returns:
+        dict: (from, to) -> (seconds, method)
+    """
+    allocated = size * allocated_fraction
+    edges = {}
+    for a in formats:
+        for b in formats:
+            if a != b:
+                # qemu-img reads the whole input and writes the whole output
+                seconds = (file_bytes(a, size, allocated_fraction)
+                           + file_bytes(b, size, allocated_fraction, written=True)) / convert_speed
+                edges[(a, b)] = (hop_seconds + seconds, "qemu-img")
+    # a fixed VHD is the raw disk plus a footer, converted in place
+    edges[("raw", "vhd")] = (hop_seconds, "in place")
+    edges[("vhd", "raw")] = (hop_seconds, "in place")
+    for target in ("raw", "vhd"):
+        # only the allocated clusters are written into a sparse raw file
+        edges[("qcow2", target)] = (hop_seconds + allocated / convert_speed, "qcow2 reader")
+        # the grains are inflated on every core
+        edges[("vmdk", target)] = (hop_seconds + allocated / (convert_speed * processes), "vmdk decoder")
+    if destination == "azure":
+        # the page blob upload reads the allocated clusters straight from the qcow2
+        edges[("qcow2", "vhd")] = (hop_seconds, "qcow2 reader at upload")
+    return edges
+
+
+def _cheapest(exports, imports, download, upload, edges):
+    # Dijkstra over (format) nodes, the download is the cost of reaching an export format
+    best = {}
+    queue = []
+    for fmt in exports:
+        heapq.heappush(queue, (download[fmt], fmt, (fmt,)))
+    routes = []
+    while queue:
+        cost, fmt, path = heapq.heappop(queue)
+        if fmt in best:
+            continue
+        best[fmt] = (cost, path)
+        if fmt in imports:
+            routes.append((cost + upload(fmt, len(path) > 1), path))
+        for (a, b), (seconds, _) in edges.items():
+            if a == fmt and b not in best:
+                heapq.heappush(queue, (cost + seconds, b, path + (b,)))
+    routes.sort(key=lambda route: route[0])
+    return routes
+
+
+def plan(source, destination, size=0, allocated_fraction=None):
+    """
+    The cheapest way from a format the source exports to a format the destination imports.
+
+    Args:
+        size: bytes of the disk, 0 when unknown (the costs are then per GiB, the choice is the same)
+        allocated_fraction: part of the disk that holds data, default general_parameters.planner_allocated_fraction
+
+    Returns:
+        dict: export and import format, the hops [from, to, method], the estimated seconds of the download,
+        conversions and upload, and 'reason', a sentence for the log
+
+    Raises:
+        Exception: If a platform has no preferred_type entry
+    """
+    exports = list(general_parameters.preferred_type[source]["export"])
+    exports = [fmt for fmt in exports if fmt in delivered.get(source, exports)] or exports
+    imports = list(general_parameters.preferred_type[destination]["import"])
+    size = size or 1024**3
+    if allocated_fraction is None:
+        allocated_fraction = general_parameters.planner_allocated_fraction
+    default_bandwidth = general_parameters.planner_bandwidth
+    download_speed, download_basis = measured_throughput("download", source, default_bandwidth)
+    upload_speed, upload_basis = measured_throughput("upload", destination, default_bandwidth)
+    convert_speed, convert_basis = measured_throughput("convert", "local", general_parameters.planner_convert_throughput)
+    processes = general_parameters.vmdk_decode_processes or os.cpu_count() or 1
+
+    download = {fmt: transfer_bytes(fmt, source, "export", size, allocated_fraction) / download_speed for fmt in exports}
+
+    def upload(fmt, converted):
+        return transfer_bytes(fmt, destination, "import", size, allocated_fraction, converted) / upload_speed
+
+    edges = conversions(destination, size, allocated_fraction, convert_speed, processes)
+    routes = _cheapest(exports, imports, download, upload, edges)
+    if not routes:
+        # no known conversion in between (e.g. an appliance format), the transform step gets the first of both
+        return {
+            'export': exports[0],
+            'import': imports[0],
+            'hops': [],
+            'seconds': None,
+            'reason': f"no conversion from {', '.join(exports)} to {', '.join(imports)} is known, "
+                      f"'{exports[0]}' is exported and transformed to '{imports[0]}'"
+        }
+
+    seconds, path = routes[0]
+    upload_seconds = upload(path[-1], len(path) > 1)
+    hops = [[a, b, edges[(a, b)][1]] for a, b in zip(path, path[1:])]
+    convert_seconds = sum(edges[(a, b)][0] for a, b in zip(path, path[1:]))
+    chain = " -> ".join(f"{b} ({method})" for a, b, method in hops)
+    reason = (f"export '{path[0]}'{', convert to ' + chain if hops else ''}, import '{path[-1]}': "
+              f"about {seconds:.0f} s for {size / 1024**3:.0f} GiB at {allocated_fraction:.0%} allocated "
+              f"(download {download[path[0]]:.0f} s at {download_speed / 1024**2:.0f} MiB/s {download_basis}, "
+              f"conversion {convert_seconds:.0f} s at {convert_speed / 1024**2:.0f} MiB/s {convert_basis}, "
+              f"upload {upload_seconds:.0f} s at {upload_speed / 1024**2:.0f} MiB/s {upload_basis})")
+    if len(routes) > 1:
+        runner_up_seconds, runner_up = routes[1]
+        reason += f"; next best '{runner_up[0]}' -> '{runner_up[-1]}' takes about {runner_up_seconds:.0f} s"
+    return {
+        'export': path[0],
+        'import': path[-1],
+        'hops': hops,
+        'seconds': seconds,
+        'download_seconds': download[path[0]],
+        'convert_seconds': convert_seconds,
+        'upload_seconds': upload_seconds,
+        'reason': reason
+    }
@@ -0,0 +1,367 @@
+# -------------------------------
+# Integrity manifests of disk images.
+# A TreeHash hashes an image while it is being written, in any order and from several threads: the image is cut
+# into leaves of leaf_size bytes, every leaf gets its SHA256 as soon as all its bytes arrived, and the leaf hashes
+# are combined pairwise into one root (like the tree hash of S3 Glacier). The parallel downloads feed it with the
+# data they write anyway, so the image is not read a second time.
+# When the source cloud publishes a checksum of the whole image (Glance os_hash_value, an S3 ETag, Azure Content-MD5)
+# the same bytes also go in order through a flat hash of that algorithm, and the result is compared with it.
+# The manifest is written next to the image as "<image>.integrity.json".
+# -------------------------------
+import os
+import json
+import base64
+import hashlib
+import threading
+
+leaf_size = 4 * 1024 * 1024
+flat_window = 256 * 1024 * 1024  # least bytes of completed leaves held for the flat hash while an earlier leaf is missing
+pending_budget = 256 * 1024 * 1024  # bytes of half-filled leaves held; beyond that a leaf is read back at the end
+read_size = 16 * 1024 * 1024
+
+
+def manifest_path(path):
+    return path + ".integrity.json"
+
+
+def in_flight_window(connections, range_size):
+    """
+    Bytes of completed leaves the flat hashes hold for a download of parallel ranges: the ranges in flight and the
+    next round of them can all finish before the first one, that must not stall the flat hashes.
+    """
+    return max(flat_window, 2 * connections * range_size)
+
+
+def tree_root(leaves):
+    """The root of a list of leaf digests (bytes), the last digest of an odd level moves up as it is."""
+    if not leaves:
+        return hashlib.sha256(b"").hexdigest()
+    level = list(leaves)
+    while len(level) > 1:
+        level = [hashlib.sha256(level[i] + level[i + 1]).digest() if i + 1 < len(level) else level[i]
+                 for i in range(0, len(level), 2)]
+    return level[0].hex()
+
+
+class TreeHash:
+    """
+    Tree hash of an image of size bytes that is written in pieces, see update().
+
+    Args:
+        size: size of the image in bytes
+        leaf: bytes per leaf
+        flat: names of hashlib algorithms (e.g. "md5", "sha512") of the whole image, computed in order
+        window: bytes of completed leaves held for the flat hashes while an earlier leaf is missing, beyond that
+            they read the rest from the file at the end; default flat_window, see in_flight_window()
+    """
+
+    def __init__(self, size, leaf=leaf_size, flat=(), window=None):
+        self.size = size
+        self.leaf = leaf
+        self.count = -(-size // leaf)
+        self.leaves = {}  # leaf index -> digest
+        self.pending = {}  # leaf index -> [(offset in the leaf, data)]
+        self.pending_bytes = 0
+        self.dropped = set()  # leaves that are read back from the file at the end
+        self.flat = {name: hashlib.new(name) for name in flat}
+        self.flat_next = 0  # the next leaf of the flat hashes
+        self.flat_waiting = {}  # leaf index -> data of completed leaves after flat_next
+        self.flat_stalled = False
+        self.window = window or flat_window
+        self.lock = threading.Lock()
+        self.flat_lock = threading.Lock()
+
+    def _length(self, index):
+        return min(self.leaf, self.size - index * self.leaf)
+
+    def update(self, offset, data):
+        """Hash data that was written at offset of the image; pieces may come in any order and from any thread."""
+        position = 0
+        while position < len(data):
+            index = (offset + position) // self.leaf
+            start = (offset + position) - index * self.leaf
+            piece = data[position:position + self._length(index) - start]
+            position += len(piece)
+            self._add(index, start, piece)
+
+    def _add(self, index, start, piece):
+        length = self._length(index)
+        if start == 0 and len(piece) == length:
+            complete = bytes(piece)
+        else:
+            with self.lock:
+                if index in self.leaves or index in self.dropped:
+                    return
+                pieces = self.pending.setdefault(index, [])
+                pieces.append((start, bytes(piece)))
+                self.pending_bytes += len(piece)
+                complete = _assemble(pieces, length)
+                if complete is not None:
+                    del self.pending[index]
+                    self.pending_bytes -= sum(len(data) for _, data in pieces)
+                elif self.pending_bytes > pending_budget:
+                    # too many half-filled leaves (e.g. the edges of a sparse download), read these back later
+                    for dropped, dropped_pieces in list(self.pending.items()):
+                        self.dropped.add(dropped)
+                        self.pending_bytes -= sum(len(data) for _, data in dropped_pieces)
+                    self.pending.clear()
+                    return
+                else:
+                    return
+        digest = hashlib.sha256(complete).digest()
+        with self.lock:
+            self.leaves[index] = digest
+        if self.flat:
+            self._flat(index, complete)
+
+    def _flat(self, index, data):
+        with self.flat_lock:
+            if self.flat_stalled or index < self.flat_next:
+                return
+            self.flat_waiting[index] = data
+            while self.flat_next in self.flat_waiting:
+                data = self.flat_waiting.pop(self.flat_next)
+                for hasher in self.flat.values():
+                    hasher.update(data)
+                self.flat_next += 1
+            if sum(len(data) for data in self.flat_waiting.values()) > self.window:
+                # an early leaf is missing for too long, the flat hashes read the rest from the file at the end
+                self.flat_stalled = True
+                self.flat_waiting.clear()
+
+    def finish(self, path=None, ranges=None, base=None):
+        """
+        Complete the hashes and return the manifest.
+
+        Args:
+            path: the image file, leaves that were not seen complete are read from it
+            ranges: (start, end) ranges that hold data; leaves outside them are holes of zeros. None for all leaves
+            base: manifest of the earlier content of the file, when only the ranges were written into it;
+                its leaves outside the ranges are kept, except the ones invalidate() marked as stale
+
+        Returns:
+            dict: algorithm, leaf_size, size, root, leaves ({index: hex digest} without the holes) and flat
+        """
+        zero_digests = {}
+
+        def has_data(index):
+            if ranges is None:
+                return True
+            start, end = index * self.leaf, index * self.leaf + self._length(index) - 1
+            return any(range_start <= end and range_end >= start for range_start, range_end in ranges)
+
+        stale = set((base or {}).get('stale', []))
+        known = (base or {}).get('leaves', {})
+        digests = []
+        leaves = {}
+        handle = open(path, "rb") if path else None
+        try:
+            for index in range(self.count):
+                digest = self.leaves.get(index)
+                if digest is None and base is not None and index not in stale and not has_data(index) \
+                        and str(index) in known:
+                    digest = bytes.fromhex(known[str(index)])
+                elif digest is None and (index in self.pending or index in self.dropped or has_data(index)
+                                         or index in stale):
+                    if handle is None:
+                        raise Exception(f"leaf {index} of the image was never written")
+                    handle.seek(index * self.leaf)
+                    digest = hashlib.sha256(handle.read(self._length(index))).digest()
+                if digest is None:
+                    length = self._length(index)
+                    if length not in zero_digests:
+                        zero_digests[length] = hashlib.sha256(bytes(length)).digest()
+                    digest = zero_digests[length]
+                else:
+                    leaves[str(index)] = digest.hex()
+                digests.append(digest)
+
+            flat = {}
+            if self.flat:
+                if self.flat_next < self.count:
+                    if handle is None:
+                        raise Exception("the flat hash of the image misses data")
+                    handle.seek(self.flat_next * self.leaf)
+                    while True:
+                        data = handle.read(read_size)
+                        if not data:
+                            break
+                        for hasher in self.flat.values():
+                            hasher.update(data)
+                flat = {name: hasher.hexdigest() for name, hasher in self.flat.items()}
+        finally:
+            if handle is not None:
+                handle.close()
+
+        return {
+            'algorithm': 'sha256-tree',
+            'leaf_size': self.leaf,
+            'size': self.size,
+            'root': tree_root(digests),
+            'leaves': leaves,
+            'flat': flat
+        }
+
+
+def _assemble(pieces, length):
+    # the leaf when the pieces cover all its bytes, later pieces win where they overlap (a retried range)
+    covered = sorted((start, start + len(data)) for start, data in pieces)
+    reached = 0
+    for start, end in covered:
+        if start > reached:
+            return None
+        reached = max(reached, end)
+    if reached < length:
+        return None
+    leaf = bytearray(length)
+    for start, data in pieces:
+        leaf[start:start + len(data)] = data
+    return bytes(leaf)
+
+
+def tree_from_digests(size, leaf, digests):
+    """
+    A manifest from leaf digests that are known already, e.g. the checksums EBS sends with every block.
+
+    Args:
+        digests: {leaf index: digest bytes} of the leaves that hold data, the others are holes
+    """
+    zero = hashlib.sha256(bytes(leaf)).digest()
+    count = -(-size // leaf)
+    return {
+        'algorithm': 'sha256-tree',
+        'leaf_size': leaf,
+        'size': size,
+        'root': tree_root([digests.get(index, zero) for index in range(count)]),
+        'leaves': {str(index): digest.hex() for index, digest in sorted(digests.items())},
+        'flat': {}
+    }
+
+
+def compare(computed, expected):
+    """
+    Compare flat hashes (the 'flat' of a manifest, or of an upload) with the checksums the cloud published.
+
+    Args:
+        computed: {algorithm: hex digest}
+        expected: {algorithm: hex digest}, e.g. {"sha512": image.os_hash_value}
+
+    Returns:
+        list: the algorithms that matched
+
+    Raises:
+        Exception: If a checksum does not match
+    """
+    matched = []
+    for name, value in (expected or {}).items():
+        digest = computed.get(name)
+        if not value or digest is None:
+            continue
+        if digest.lower() != value.lower():
+            raise Exception(f"the {name} checksum of the image is {digest}, the cloud says {value}")
+        matched.append(name)
+    return matched
+
+
+def glance_checksums(image):
+    """The checksum Glance keeps of an image: os_hash_value (multihash) or else the md5 checksum."""
+    if getattr(image, 'os_hash_algo', None) and getattr(image, 'os_hash_value', None):
+        return {image.os_hash_algo: image.os_hash_value}
+    if getattr(image, 'checksum', None):
+        return {'md5': image.checksum}
+    return {}
+
+
+def invalidate(path, ranges):
+    """Mark the leaves of the manifest of path that overlap the (start, end) ranges as stale, after rewriting them."""
+    manifest = read_manifest(path)
+    if manifest is None:
+        return
+    leaf = manifest['leaf_size']
+    stale = set(manifest.get('stale', []))
+    for start, end in ranges:
+        stale.update(range(start // leaf, end // leaf + 1))
+    manifest['stale'] = sorted(stale)
+    temporary = manifest_path(path) + ".tmp"
+    with open(temporary, "w") as f:
+        json.dump(manifest, f)
+    os.replace(temporary, manifest_path(path))
+
+
+def write_manifest(path, manifest, verified=None):
+    """Write the manifest next to the image. Returns the path of the manifest."""
+    manifest = dict(manifest, image=os.path.basename(path), verified=verified or [])
+    temporary = manifest_path(path) + ".tmp"
+    with open(temporary, "w") as f:
+        json.dump(manifest, f)
+    os.replace(temporary, manifest_path(path))
+    return manifest_path(path)
+
+
+def read_manifest(path):
+    try:
+        with open(manifest_path(path)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def base64_to_hex(value):
+    """Azure Content-MD5 and the S3 checksums are base64, the manifests use hex."""
+    return base64.b64decode(value).hex()
+
+
+class HashingFile:
+    """
+    File object that passes every write at its position to a TreeHash, for SDK downloads that seek and write.
+    """
+
+    def __init__(self, fileobj, tree):
+        self.fileobj = fileobj
+        self.tree = tree
+
+    def write(self, data):
+        self.tree.update(self.fileobj.tell(), data)
+        return self.fileobj.write(data)
+
+    def seek(self, offset, whence=0):
+        return self.fileobj.seek(offset, whence)
+
+    def tell(self):
+        return self.fileobj.tell()
+
+    def seekable(self):
+        return True
+
+    def flush(self):
+        return self.fileobj.flush()
+
+
+class HashingReader:
+    """
+    File object that hashes everything that is read from it in order, for uploads that call read(size).
+    The hashes are in .hashes ({algorithm: hashlib object}).
+    """
+
+    def __init__(self, fileobj, algorithms=("md5", "sha512")):
+        self.fileobj = fileobj
+        self.hashes = {name: hashlib.new(name) for name in algorithms}
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        for hasher in self.hashes.values():
+            hasher.update(data)
+        return data
+
+    def hexdigests(self):
+        return {name: hasher.hexdigest() for name, hasher in self.hashes.items()}
+
+    def __iter__(self):
+        while True:
+            data = self.read(read_size)
+            if not data:
+                return
+            yield data
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
@@ -0,0 +1,291 @@
+# -------------------------------
+# Server-side orchestrator for migrations.
+# start_migration() creates a job with its own job id and runs its steps in a background thread of the engine.
+# The steps form a dependency graph: a step starts as soon as the steps it needs are completed, so work that does
+# not wait for the disk (network, storage preparation) runs next to the download and the conversion.
+# A step gets the outputs of all steps it depends on, directly or indirectly, merged into its shared_data.
+# The UI only observes the job through get_job(), so a migration keeps running when the page is closed.
+# Every step is recorded in the migration ledger, so after a restart resume_migrations() continues each
+# unfinished migration at its first incomplete step.
+# The conversion steps of all migrations share the slots of the conversion scheduler, in the order of job priority.
+# -------------------------------
+import sys
+import json
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timezone
+from contextlib import contextmanager
+
+sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/basic")
+import step_runner
+import migration_ledger
+import conversion_scheduler
+
+# the migration steps and the steps each one needs, the ids match the step elements of the processing page
+steps = [
+    {'id': 'step1', 'script': 'fetch_vm.py', 'message': 'VM found successfully!', 'needs': []},
+    {'id': 'prepare-source', 'script': 'prepare_source.py', 'message': 'Export storage ready', 'needs': ['step1']},
+    # after the fetch, so a migration does not open the browser login of the source and the destination at once
+    {'id': 'prepare-destination', 'script': 'prepare_destination.py', 'message': 'Destination storage ready', 'needs': ['step1']},
+    # the pre-copy copies the disk while the VM runs, so after the stop only the changed pages are left to download
+    {'id': 'precopy', 'script': 'precopy_vm.py', 'message': 'Pre-copy completed', 'needs': ['step1']},
+    {'id': 'step2', 'script': 'stop_vm.py', 'message': 'VM stopped successfully', 'needs': ['step1', 'precopy']},
+    # the download needs the destination storage too, because in the streaming mode it also uploads
+    {'id': 'step3', 'script': 'download_vm.py', 'message': 'Download completed', 'needs': ['step2', 'prepare-source', 'prepare-destination']},
+    # the free blocks of the file systems are zeroed, so the conversion and the upload skip them like holes
+    {'id': 'sparsify', 'script': 'sparsify_vm.py', 'message': 'Free space zeroed', 'needs': ['step3']},
+    {'id': 'step4', 'script': 'transform_vm.py', 'message': 'Format conversion completed', 'needs': ['sparsify']},
+    {'id': 'step5', 'script': 'upload_image.py', 'message': 'Upload completed successfully', 'needs': ['step4', 'prepare-destination']},
+    {'id': 'step6', 'script': 'create_network.py', 'message': 'Network resources created', 'needs': ['step1']},
+    {'id': 'step7', 'script': 'start_vm.py', 'message': 'VM is now running!', 'needs': ['step5', 'step6']}
+]
+
+_jobs = {}
+_jobs_lock = threading.Lock()
+
+
+class MigrationJob:
+    """
+    State of one migration: the status of every step and the shared_data collected so far.
+    """
+
+    def __init__(self, job_id, source, destination, vmname, priority=0):
+        self.job_id = job_id
+        self.source = source
+        self.destination = destination
+        self.vmname = vmname
+        self.priority = priority  # a higher priority gets a conversion slot first
+        self.status = 'queued'  # queued, running, completed or failed
+        self.error = None
+        self.shared_data = {'message': 'empthy'}
+        self.outputs = {}  # step id -> output of the completed step
+        self.steps = {step['id']: {'script': step['script'], 'status': 'pending', 'message': None, 'error': None}
+                      for step in steps}
+        self.created = datetime.now(timezone.utc).isoformat()
+        self.finished = None
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_ledger(cls, migration):
+        """Rebuild a job from the ledger: completed steps stay done and their outputs form the shared_data again."""
+        job = cls(migration['job_id'], migration['source'], migration['destination'], migration['vmname'],
+                  migration.get('priority') or 0)
+        job.created = migration['created']
+        job.status = migration['status']
+        job.error = migration['error']
+        job.finished = migration['finished']
+        for step in steps:
+            recorded = migration['steps'].get(step['id'])
+            if recorded and recorded['status'] == 'completed':
+                job.steps[step['id']].update({'status': 'completed', 'message': recorded['message']})
+                job.shared_data.pop('message', None)
+                if isinstance(recorded['outputs'], dict):
+                    job.outputs[step['id']] = recorded['outputs']
+                    job.shared_data.update(recorded['outputs'])
+        return job
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'job_id': self.job_id,
+                'source': self.source,
+                'destination': self.destination,
+                'vmname': self.vmname,
+                'priority': self.priority,
+                'status': self.status,
+                'error': self.error,
+                'steps': [dict(self.steps[step['id']], id=step['id']) for step in steps],
+                'shared_data': dict(self.shared_data),
+                'created': self.created,
+                'finished': self.finished
+            }
+
+
+def _set_step(job, step_id, status, message=None, error=None):
+    with job.lock:
+        job.steps[step_id].update({'status': status, 'message': message, 'error': error})
+
+
+def _ancestors(step_id):
+    # all steps a step depends on, directly or through other steps
+    needs = set()
+    for need in next(step for step in steps if step['id'] == step_id)['needs']:
+        needs.add(need)
+        needs |= _ancestors(need)
+    return needs
+
+
+def _inputs(job, step):
+    # the shared_data of a step: the outputs of the steps it depends on, in the order of the steps list
+    ancestors = _ancestors(step['id'])
+    shared_data = {'message': 'empthy'}
+    for previous in steps:
+        if previous['id'] in ancestors and previous['id'] in job.outputs:
+            shared_data.pop('message', None)
+            shared_data.update(job.outputs[previous['id']])
+    return shared_data
+
+
+def _ready(job):
+    # pending steps whose needed steps are all completed
+    with job.lock:
+        return [step for step in steps
+                if job.steps[step['id']]['status'] == 'pending'
+                and all(job.steps[need]['status'] == 'completed' for need in step['needs'])]
+
+
+def _run_step(job, step, shared_data):
+    try:
+        needs_slot = conversion_scheduler.needs_slot(step['script'], shared_data)
+        if needs_slot:
+            _set_step(job, step['id'], 'running', 'Waiting for a conversion slot...')
+            size = conversion_scheduler.conversion_size(shared_data)
+
+            @contextmanager
+            def conversion_gate():
+                # entered by the step runner once the step has its worker, so a slot is never held by a waiting step
+                with conversion_scheduler.scheduler().slot(job.job_id, step['script'], size, job.priority) as conversion:
+                    _set_step(job, step['id'], 'running', 'Processing...')
+                    yield {'conversion_processes': conversion['processes']}
+        return step_runner.run_step(step['script'], job.source, job.destination, job.vmname, shared_data, job.job_id,
+                                    gate=conversion_gate if needs_slot else None)
+    except Exception:
+        return {'success': False, 'error': traceback.format_exc()}
+
+
+def _finish_step(job, step, result):
+    """Record the result of a step. Returns the error of a failed step, or None."""
+    output = None
+    if result['success']:
+        try:
+            output = json.loads(result['output'])
+        except (TypeError, ValueError):
+            result = {'success': False, 'error': f"the step '{step['script']}' did not return valid json: {result['output']}"}
+
+    if not result['success']:
+        _set_step(job, step['id'], 'error', 'Script failed', result['error'])
+        migration_ledger.step_failed(job.job_id, step['id'], result['error'])
+        return result['error']
+
+    # Parse output and add to shared data
+    with job.lock:
+        job.shared_data.pop('message', None)
+        if isinstance(output, dict):
+            job.outputs[step['id']] = output
+            job.shared_data.update(output)
+    message = output.get('message') if isinstance(output, dict) else None
+    migration_ledger.step_completed(job.job_id, step['id'], output, message)
+    _set_step(job, step['id'], 'completed', message or step['message'])
+    return None
+
+
+def _run(job):
+    with job.lock:
+        job.status = 'running'
+    migration_ledger.set_migration_status(job.job_id, 'running')
+
+    # steps completed before a restart stay completed, the others start when their needs are met
+    error = None
+    running = {}  # future -> step
+    with ThreadPoolExecutor(max_workers=len(steps)) as executor:
+        while True:
+            if error is None:
+                for step in _ready(job):
+                    shared_data = _inputs(job, step)
+                    _set_step(job, step['id'], 'running', 'Processing...')
+                    migration_ledger.step_started(job.job_id, step['id'], step['script'], shared_data)
+                    running[executor.submit(_run_step, job, step, shared_data)] = step
+            if not running:
+                break
+            # after a failure no new steps start, the steps already running are allowed to finish
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                step = running.pop(future)
+                failure = _finish_step(job, step, future.result())
+                if error is None:
+                    error = failure
+
+    if error is None:
+        with job.lock:
+            blocked = [step['id'] for step in steps if job.steps[step['id']]['status'] != 'completed']
+        if blocked:
+            error = f"the steps {blocked} could not start, their needed steps never completed"
+
+    if error is not None:
+        migration_ledger.set_migration_status(job.job_id, 'failed', error)
+        with job.lock:
+            job.status = 'failed'
+            job.error = error
+            job.finished = datetime.now(timezone.utc).isoformat()
+        return
+
+    migration_ledger.set_migration_status(job.job_id, 'completed')
+    with job.lock:
+        job.status = 'completed'
+        job.finished = datetime.now(timezone.utc).isoformat()
+
+
+def start_migration(source, destination, vmname, priority=0):
+    """
+    Start a migration in a background thread.
+    Its conversion waits for a slot behind the conversions of migrations with a higher priority.
+
+    Returns:
+        MigrationJob: the new job, its job_id is used by the UI to follow the migration
+    """
+    with _jobs_lock:
+        job_id = datetime.now().strftime("%Y%m%d%H%M%S%f")
+        while job_id in _jobs:
+            job_id = str(int(job_id) + 1)
+        job = MigrationJob(job_id, source, destination, vmname, priority)
+        _jobs[job_id] = job
+    migration_ledger.create_migration(job_id, source, destination, vmname, priority)
+
+    threading.Thread(target=_run, args=(job,), daemon=True).start()
+    return job
+
+
+def resume_migration(job_id):
+    """
+    Continue a migration from the ledger at its first incomplete step, also one that failed before.
+
+    Returns:
+        MigrationJob: the resumed job, or None when the ledger does not know the job id
+    """
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        if job is not None and job.status in ('queued', 'running'):
+            return job
+        migration = migration_ledger.load_migration(job_id)
+        if migration is None:
+            return None
+        job = MigrationJob.from_ledger(migration)
+        job.status = 'queued'
+        job.error = None
+        job.finished = None
+        _jobs[job_id] = job
+
+    threading.Thread(target=_run, args=(job,), daemon=True).start()
+    return job
+
+
+def resume_migrations():
+    """Resume all migrations that were still running when the engine stopped."""
+    return [resume_migration(job_id) for job_id in migration_ledger.incomplete_migrations()]
+
+
+def get_job(job_id):
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+    if job is None:
+        # a migration of before the last restart, shown as the ledger remembers it
+        migration = migration_ledger.load_migration(job_id)
+        if migration is not None:
+            job = MigrationJob.from_ledger(migration)
+    return job
+
+
+def list_jobs():
+    with _jobs_lock:
+        return list(_jobs.values())
@@ -0,0 +1,232 @@
+# -------------------------------
+# Durable migration ledger in SQLite.
+# It records every migration, the inputs and outputs of each step, and the cloud artifacts the steps create
+# (snapshot ids, export task ids, S3/OBS keys, Glance image ids, staged files).
+# When the engine restarts, a migration continues at its first incomplete step with the shared_data rebuilt
+# from the completed steps, and the provider code reuses the recorded artifacts instead of creating them again.
+# The steps run in other processes, so every call opens its own short connection to the database file.
+# -------------------------------
+import sys
+import os
+import json
+import sqlite3
+from datetime import datetime, timezone
+
+sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/scripts")
+import general_parameters
+
+_schema = """
+CREATE TABLE IF NOT EXISTS migrations (
+    job_id TEXT PRIMARY KEY,
+    source TEXT,
+    destination TEXT,
+    vmname TEXT,
+    priority INTEGER DEFAULT 0,
+    status TEXT,
+    error TEXT,
+    created TEXT,
+    finished TEXT
+);
+CREATE TABLE IF NOT EXISTS steps (
+    job_id TEXT,
+    step_id TEXT,
+    script TEXT,
+    status TEXT,
+    inputs TEXT,
+    outputs TEXT,
+    message TEXT,
+    error TEXT,
+    started TEXT,
+    finished TEXT,
+    PRIMARY KEY (job_id, step_id)
+);
+CREATE TABLE IF NOT EXISTS artifacts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id TEXT,
+    step TEXT,
+    kind TEXT,
+    value TEXT,
+    created TEXT
+);
+CREATE INDEX IF NOT EXISTS artifacts_job_kind ON artifacts (job_id, kind);
+CREATE TABLE IF NOT EXISTS throughput (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    action TEXT,
+    platform TEXT,
+    bytes INTEGER,
+    seconds REAL,
+    created TEXT
+);
+"""
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+def connect(path=None):
+    path = path or general_parameters.ledger_path
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    connection = sqlite3.connect(path, timeout=30)
+    connection.row_factory = sqlite3.Row
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.executescript(_schema)
+    if 'priority' not in [row['name'] for row in connection.execute("PRAGMA table_info(migrations)")]:
+        # a ledger of before the priorities, its migrations get the default priority
+        connection.execute("ALTER TABLE migrations ADD COLUMN priority INTEGER DEFAULT 0")
+    return connection
+
+
+def _execute(query, parameters=()):
+    connection = connect()
+    try:
+        with connection:
+            return connection.execute(query, parameters).fetchall()
+    finally:
+        connection.close()
+
+
+# -------------------------------
+# migrations and steps, written by the engine
+# -------------------------------
+def create_migration(job_id, source, destination, vmname, priority=0):
+    _execute(
+        "INSERT OR IGNORE INTO migrations (job_id, source, destination, vmname, priority, status, created) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (job_id, source, destination, vmname, priority, 'queued', _now())
+    )
+
+
+def set_migration_status(job_id, status, error=None):
+    finished = _now() if status in ('completed', 'failed') else None
+    _execute("UPDATE migrations SET status = ?, error = ?, finished = ? WHERE job_id = ?", (status, error, finished, job_id))
+
+
+def step_started(job_id, step_id, script, inputs):
+    _execute(
+        "INSERT OR REPLACE INTO steps (job_id, step_id, script, status, inputs, started) VALUES (?, ?, ?, ?, ?, ?)",
+        (job_id, step_id, script, 'running', json.dumps(inputs), _now())
+    )
+
+
+def step_completed(job_id, step_id, outputs, message=None):
+    _execute(
+        "UPDATE steps SET status = ?, outputs = ?, message = ?, error = NULL, finished = ? WHERE job_id = ? AND step_id = ?",
+        ('completed', json.dumps(outputs), message, _now(), job_id, step_id)
+    )
+
+
+def step_failed(job_id, step_id, error):
+    _execute(
+        "UPDATE steps SET status = ?, error = ?, finished = ? WHERE job_id = ? AND step_id = ?",
+        ('error', error, _now(), job_id, step_id)
+    )
+
+
+def load_migration(job_id):
+    """
+    Returns:
+        dict: the migration row with 'steps': {step_id: step row with decoded inputs and outputs}, or None
+    """
+    rows = _execute("SELECT * FROM migrations WHERE job_id = ?", (job_id,))
+    if not rows:
+        return None
+    migration = dict(rows[0])
+    migration['steps'] = {}
+    for row in _execute("SELECT * FROM steps WHERE job_id = ?", (job_id,)):
+        step = dict(row)
+        step['inputs'] = json.loads(step['inputs']) if step['inputs'] else None
+        step['outputs'] = json.loads(step['outputs']) if step['outputs'] else None
+        migration['steps'][step['step_id']] = step
+    return migration
+
+
+def incomplete_migrations():
+    """Job ids of the migrations that were queued or running when the engine stopped."""
+    rows = _execute("SELECT job_id FROM migrations WHERE status IN ('queued', 'running') ORDER BY created")
+    return [row['job_id'] for row in rows]
+
+
+# -------------------------------
+# cloud artifacts, written by the provider code inside a step
+# -------------------------------
+_job_id = None  # the migration of the running step, set by its run()
+
+
+def use_job(job_id):
+    """
+    Set the migration the artifacts of the running step belong to; the steps call it first thing in run().
+    The legacy /api/run-script gives every step the id of the engine session, so there it is a job id per VM.
+    """
+    global _job_id
+    _job_id = job_id
+
+
+def current_job():
+    return _job_id
+
+
+def _step_context(job_id, step):
+    if job_id is None:
+        job_id = _job_id
+    if not job_id:
+        raise Exception("no migration to record the artifact for, the step has to call migration_ledger.use_job()")
+    if step is None:
+        step = os.path.basename(sys.argv[0]) if sys.argv and sys.argv[0] else ''
+    return job_id, step
+
+
+def record_artifact(kind, value, job_id=None, step=None):
+    """Remember a cloud resource or file created for this migration, e.g. kind='snapshot_id'."""
+    job_id, step = _step_context(job_id, step)
+    _execute(
+        "INSERT INTO artifacts (job_id, step, kind, value, created) VALUES (?, ?, ?, ?, ?)",
+        (job_id, step, kind, json.dumps(value), _now())
+    )
+
+
+def find_artifact(kind, job_id=None):
+    """
+    Returns:
+        the value last recorded with this kind for the migration, or None
+    """
+    job_id, step = _step_context(job_id, None)
+    rows = _execute(
+        "SELECT value FROM artifacts WHERE job_id = ? AND kind = ? ORDER BY id DESC LIMIT 1",
+        (job_id, kind)
+    )
+    if not rows:
+        return None
+    return json.loads(rows[0]['value'])
+
+
+def list_artifacts(job_id):
+    rows = _execute("SELECT step, kind, value, created FROM artifacts WHERE job_id = ? ORDER BY id", (job_id,))
+    return [dict(row, value=json.loads(row['value'])) for row in rows]
+
+
+# -------------------------------
+# measured throughput of the downloads, conversions and uploads, read by the format planner
+# -------------------------------
+def record_throughput(action, platform, bytes_done, seconds):
+    _execute(
+        "INSERT INTO throughput (action, platform, bytes, seconds, created) VALUES (?, ?, ?, ?, ?)",
+        (action, platform, bytes_done, seconds, _now())
+    )
+
+
+def average_throughput(action, platform, samples=10):
+    """
+    Returns:
+        bytes per second over the last samples measurements of this action on this platform, or None
+    """
+    rows = _execute(
+        "SELECT SUM(bytes) AS bytes, SUM(seconds) AS seconds FROM "
+        "(SELECT bytes, seconds FROM throughput WHERE action = ? AND platform = ? ORDER BY id DESC LIMIT ?)",
+        (action, platform, samples)
+    )
+    if not rows or not rows[0]['seconds']:
+        return None
+    return rows[0]['bytes'] / rows[0]['seconds']
@@ -0,0 +1,181 @@
+# -------------------------------
+# Upload of a disk to an Azure page blob.
+# A page blob reads every page that was never written as zeros, so only the parts of the disk that are not zero
+# have to be sent. The disk is read in blocks of 4 MiB, the largest upload_page call; inside a block the parts
+# of zero_granularity bytes that are all zero are left out, and the remaining extents are uploaded with
+# general_parameters.page_upload_connections concurrent upload_page calls.
+# With the block store on, blocks that a sibling blob in the same container already holds are copied by Azure
+# (upload_pages_from_url) instead of being sent again, see block_store.RemoteBlocks.
+# -------------------------------
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/scripts")
+import general_parameters
+sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/basic")
+import block_store
+
+page_size = 512
+block_size = 4 * 1024 * 1024  # the largest range one upload_page call accepts
+zero_granularity = 64 * 1024  # smallest all-zero part that is left out
+
+_zeros = bytes(zero_granularity)
+
+
+def aligned_size(size):
+    """A page blob has a size of whole 512 byte pages."""
+    return -(-size // page_size) * page_size
+
+
+def numbered(blocks, start=0):
+    """Give each block its offset in the disk: yields (offset, data)."""
+    offset = start
+    for data in blocks:
+        yield offset, data
+        offset += len(data)
+
+
+def file_blocks(f, progress=None):
+    """The blocks of an open disk file; the progress counts the bytes read, skipped zeros included."""
+    while True:
+        data = f.read(block_size)
+        if not data:
+            return
+        if progress is not None:
+            progress.add(len(data))
+        yield data
+
+
+def nonzero_extents(blocks, granularity=zero_granularity):
+    """
+    The parts of the disk that are not zero.
+
+    Args:
+        blocks: iterator of (offset, data) with blocks of at most block_size bytes
+        granularity: size of the parts that are checked for zeros
+
+    Returns:
+        iterator of (offset, data) with data of whole pages and at most block_size bytes
+    """
+    for offset, data in blocks:
+        if isinstance(data, block_store.RemoteBlock):
+            yield offset, data
+            continue
+        start = None
+        for position in range(0, len(data), granularity):
+            zero = data.startswith(_zeros[:len(data) - position], position)
+            if zero and start is not None:
+                yield offset + start, data[start:position]
+                start = None
+            elif not zero and start is None:
+                start = position
+        if start is not None:
+            extent = data[start:]
+            if len(extent) % page_size:
+                extent += bytes(page_size - len(extent) % page_size)
+            yield offset + start, extent
+
+
+def _send(blob_client, offset, data, remote=None):
+    # returns the bytes sent, a block the container already holds is copied by Azure
+    if isinstance(data, block_store.RemoteBlock):
+        try:
+            blob_client.upload_pages_from_url(data.url, offset=offset, length=len(data), source_offset=data.offset)
+            return 0
+        except Exception:
+            if remote is not None:
+                remote.forget(data.location)
+            data = data.data
+    blob_client.upload_page(data, offset=offset, length=len(data))
+    return len(data)
+
+
+def upload_extents(blob_client, extents, connections=None, progress=None, remote=None):
+    """
+    Upload (offset, data) extents to an existing page blob with concurrent upload_page calls.
+    At most two extents per connection are read ahead, so memory stays bounded.
+    An extent can be a block_store.RemoteBlock, which is copied from a sibling blob instead.
+
+    Returns:
+        int: the bytes uploaded
+    """
+    connections = connections or general_parameters.page_upload_connections
+    in_flight = threading.BoundedSemaphore(connections * 2)
+    failed = []
+    uploaded = [0]
+    lock = threading.Lock()
+
+    def finished(future):
+        in_flight.release()
+        if future.exception() is not None:
+            failed.append(future.exception())
+            return
+        with lock:
+            uploaded[0] += future.result()
+        if progress is not None:
+            progress.add(future.result())
+
+    with ThreadPoolExecutor(max_workers=connections) as executor:
+        for offset, data in extents:
+            if failed:
+                break
+            in_flight.acquire()
+            future = executor.submit(_send, blob_client, offset, data, remote)
+            future.add_done_callback(finished)
+
+    if failed:
+        raise failed[0]
+    return uploaded[0]
+
+
+def upload_blocks(blob_client, size, blocks, connections=None, remote=None):
+    """
+    Create the page blob at full size and upload the parts of the blocks that are not zero.
+    The blob gets the metadata upload_complete=true at the end, so a half uploaded blob is recognised.
+
+    Args:
+        blocks: iterator with the data of the disk in blocks of block_size bytes
+        remote: optional block_store.RemoteBlocks of this blob, its blocks that a sibling blob holds are copied
+
+    Returns:
+        int: the bytes uploaded
+    """
+    return upload_sparse(blob_client, size, numbered(blocks), connections, remote=remote)
+
+
+def upload_sparse(blob_client, size, blocks, connections=None, progress=None, remote=None):
+    """
+    Like upload_blocks(), for a disk that only has data in some places, e.g. the allocated clusters of a qcow2 image.
+
+    Args:
+        blocks: iterator of (offset, data) in the order of the disk, at most block_size bytes that do not cross
+            a multiple of block_size
+        progress: optional progress_events.ProgressReporter, counts the bytes uploaded
+
+    Returns:
+        int: the bytes uploaded
+    """
+    blob_client.create_page_blob(aligned_size(size))
+    if remote is not None:
+        blocks = remote.blocks(blocks)
+    uploaded = upload_extents(blob_client, nonzero_extents(blocks), connections, progress=progress, remote=remote)
+    blob_client.set_blob_metadata({'upload_complete': 'true'})
+    if remote is not None:
+        remote.commit()
+    return uploaded
+
+
+def upload_file(blob_client, path, size, connections=None, progress=None, remote=None):
+    """Upload a disk file to a new page blob with upload_blocks()."""
+    with open(path, "rb") as f:
+        return upload_blocks(blob_client, size, file_blocks(f, progress), connections, remote)
+
+
+def is_complete(blob_client):
+    """True when the blob exists and upload_file finished it."""
+    try:
+        properties = blob_client.get_blob_properties()
+    except Exception:
+        return False
+    return (properties.metadata or {}).get('upload_complete') == 'true'
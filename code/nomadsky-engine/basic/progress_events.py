@@ -0,0 +1,200 @@
+# -------------------------------
+# Progress events of long running steps (download, convert, upload).
+# A step creates a ProgressReporter and tells it how many bytes are done. At most once per interval the reporter
+# sends an event with bytes done, total bytes, current throughput and ETA to the engine (POST /api/progress).
+# The engine keeps the events per migration (unique_id) and streams them to the UI as Server-Sent Events.
+# The reporter never prints, so the JSON a step prints on stdout stays valid.
+# When a large transfer or conversion is done, its throughput is kept in the ledger for the format planner.
+# -------------------------------
+import sys
+import os
+import json
+import time
+import queue
+import threading
+import urllib.request
+from collections import deque
+
+sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/scripts")
+sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/basic")
+import general_parameters
+import migration_ledger
+
+measured_bytes = 256 * 1024 * 1024  # smaller transfers are too short to tell the throughput
+
+
+def send_event(event):
+    # delivery is best effort, a missing engine must never break a migration step
+    try:
+        request = urllib.request.Request(
+            general_parameters.engine_url + "/api/progress",
+            data=json.dumps(event).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+            method="POST"
+        )
+        urllib.request.urlopen(request, timeout=2).close()
+    except Exception:
+        pass
+
+
+class ProgressReporter:
+    """
+    Track the bytes of one transfer or conversion and publish rate-limited progress events.
+    The migration (unique_id) and step default to the arguments of the running step script.
+    """
+
+    def __init__(self, total_bytes=None, action="transfer", step=None, unique_id=None, interval=1.0, sender=None,
+                 platform=None):
+        self.total_bytes = total_bytes
+        self.action = action
+        # the platform on the other end: the source of a download, the destination of an upload
+        if platform is None:
+            if action in ("download", "precopy"):
+                platform = sys.argv[1] if len(sys.argv) > 1 else ""
+            elif action == "upload":
+                platform = sys.argv[2] if len(sys.argv) > 2 else ""
+            else:
+                platform = "local"
+        self.platform = platform
+        self.step = step or (os.path.basename(sys.argv[0]) if sys.argv and sys.argv[0] else "")
+        self.unique_id = unique_id or (sys.argv[5] if len(sys.argv) > 5 else "")
+        self.interval = interval
+        self.sender = sender or send_event
+        self.bytes_done = 0
+        self.started = time.monotonic()
+        self.last_sent = 0.0
+        self.samples = deque()  # (time, bytes_done) of the last seconds, for the current throughput
+        self.lock = threading.Lock()
+
+    def add(self, count):
+        with self.lock:
+            self.bytes_done += count
+            bytes_done = self.bytes_done
+        self.update(bytes_done)
+
+    def update(self, bytes_done, force=False):
+        now = time.monotonic()
+        with self.lock:
+            self.bytes_done = max(self.bytes_done, bytes_done)
+            self.samples.append((now, self.bytes_done))
+            while len(self.samples) > 2 and now - self.samples[0][0] > 10:
+                self.samples.popleft()
+            if not force and now - self.last_sent < self.interval:
+                return
+            self.last_sent = now
+            event = self._event(now, 'running')
+        self.sender(event)
+
+    def done(self):
+        now = time.monotonic()
+        with self.lock:
+            if self.total_bytes:
+                self.bytes_done = max(self.bytes_done, self.total_bytes)
+            self.samples.append((now, self.bytes_done))
+            event = self._event(now, 'completed')
+        self.sender(event)
+        self._measure(event['elapsed'])
+
+    def _measure(self, elapsed):
+        # best effort as well, the planner falls back to its defaults without measurements
+        if self.bytes_done < measured_bytes or elapsed <= 0:
+            return
+        try:
+            migration_ledger.record_throughput(self.action, self.platform, self.bytes_done, elapsed)
+        except Exception:
+            pass
+
+    def _event(self, now, status):
+        first_time, first_bytes = self.samples[0]
+        if now - first_time > 0:
+            throughput = (self.bytes_done - first_bytes) / (now - first_time)
+        else:
+            throughput = 0
+        eta = None
+        if self.total_bytes and throughput > 0:
+            eta = max(0, (self.total_bytes - self.bytes_done) / throughput)
+        return {
+            'unique_id': self.unique_id,
+            'step': self.step,
+            'action': self.action,
+            'status': status,
+            'bytes_done': self.bytes_done,
+            'total_bytes': self.total_bytes,
+            'throughput': throughput,  # bytes per second over the last seconds
+            'eta': eta,  # seconds
+            'elapsed': now - self.started,
+            'time': time.time()
+        }
+
+
+class ProgressFile:
+    """
+    File object wrapper that reports every read to a ProgressReporter, for SDK uploads that take a file.
+    """
+
+    def __init__(self, fileobj, reporter):
+        self.fileobj = fileobj
+        self.reporter = reporter
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.reporter.add(len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+
+# -------------------------------
+# Engine side: collect the events and hand them to the Server-Sent Events streams
+# -------------------------------
+_latest = {}  # unique_id -> {step: last event}
+_subscribers = {}  # unique_id -> [queue]
+_lock = threading.Lock()
+
+
+def publish(event):
+    unique_id = event.get('unique_id', '')
+    with _lock:
+        _latest.setdefault(unique_id, {})[event.get('step', '')] = event
+        subscribers = list(_subscribers.get(unique_id, []))
+    for events in subscribers:
+        try:
+            events.put_nowait(event)
+        except queue.Full:
+            pass  # a slow browser only misses intermediate events
+
+
+def latest(unique_id):
+    with _lock:
+        return list(_latest.get(unique_id, {}).values())
+
+
+def subscribe(unique_id):
+    events = queue.Queue(maxsize=1000)
+    with _lock:
+        _subscribers.setdefault(unique_id, []).append(events)
+    return events
+
+
+def unsubscribe(unique_id, events):
+    with _lock:
+        if events in _subscribers.get(unique_id, []):
+            _subscribers[unique_id].remove(events)
+
+
+def sse_stream(unique_id, keep_alive=15):
+    """Generator with the Server-Sent Events text for one migration: the last known events first, then live ones."""
+    events = subscribe(unique_id)
+    try:
+        for event in latest(unique_id):
+            yield f"data: {json.dumps(event)}\n\n"
+        while True:
+            try:
+                event = events.get(timeout=keep_alive)
+            except queue.Empty:
+                yield ": keep-alive\n\n"
+                continue
+            yield f"data: {json.dumps(event)}\n\n"
+    finally:
+        unsubscribe(unique_id, events)
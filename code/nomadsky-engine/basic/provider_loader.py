@@ -0,0 +1,107 @@
+# -------------------------------
+# Load the provider code (Microsoft, Amazon, Cyso, ...) side by side in one python process.
+# Every provider folder has its own config.py, downloading_vm.py, ... so the module names collide.
+# activate_provider() parks the modules of the other providers and puts the requested provider first on sys.path,
+# so "import config" and "from downloading_vm import ..." resolve to the right folder again.
+# preload() imports all provider modules and the heavy cloud SDKs once, so later steps start warm.
+# -------------------------------
+import sys
+import os
+import importlib
+
+sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/scripts")
+import general_parameters
+
+# cloud SDKs imported up front by a warm worker, missing packages are skipped
+sdk_modules = (
+    "requests",
+    "opencensus.ext.azure.log_exporter",
+    "azure.identity",
+    "azure.mgmt.compute",
+    "azure.mgmt.network",
+    "azure.mgmt.resource",
+    "azure.mgmt.storage",
+    "azure.storage.blob",
+    "boto3",
+    "novaclient.client",
+    "glanceclient.client",
+    "keystoneauth1.session",
+)
+
+_parked = {}  # provider folder -> {module name: module} of the providers that are not active
+_active = None
+
+
+def provider_path(platform):
+    folder = general_parameters.provider_folders.get(platform)
+    if folder is None:
+        raise Exception(f"the platform '{platform}' is not yet supported")
+    return os.path.join(general_parameters.code_path, folder)
+
+
+def _owner(module):
+    # return the provider folder a loaded module comes from, or None
+    path = getattr(module, "__file__", None)
+    if not path:
+        return None
+    folder = os.path.basename(os.path.dirname(os.path.abspath(path)))
+    for name in general_parameters.provider_folders.values():
+        if folder.lower() == name.lower():
+            return name
+    return None
+
+
+def activate_provider(platform):
+    """
+    Make the provider of the given platform the one that "import config" resolves to.
+
+    Returns:
+        str: the folder of the provider code that is now active
+    """
+    global _active
+    folder = general_parameters.provider_folders.get(platform)
+    path = provider_path(platform)
+
+    if folder != _active:
+        for name, module in list(sys.modules.items()):
+            owner = _owner(module)
+            if owner is not None:
+                _parked.setdefault(owner, {})[name] = module
+                del sys.modules[name]
+        sys.modules.update(_parked.pop(folder, {}))
+        _active = folder
+
+    # the scripts keep appending provider folders, only the active one may stay on the path
+    names = [name.lower() for name in general_parameters.provider_folders.values()]
+    sys.path[:] = [p for p in sys.path if os.path.basename(os.path.normpath(p)).lower() not in names]
+    sys.path.insert(0, path)
+    return path
+
+
+def preload(platforms=None):
+    """
+    Import the cloud SDKs and the modules of every provider once.
+
+    Returns:
+        dict: per platform the modules that could not be imported, with the reason
+    """
+    failed = {}
+    for module_name in sdk_modules:
+        try:
+            importlib.import_module(module_name)
+        except ImportError as e:
+            failed.setdefault("sdk", {})[module_name] = str(e)
+
+    for platform in platforms or general_parameters.provider_folders:
+        path = activate_provider(platform)
+        if not os.path.isdir(path):
+            continue
+        for file_name in sorted(os.listdir(path)):
+            if not file_name.endswith(".py"):
+                continue
+            module_name = file_name[:-3]
+            try:
+                importlib.import_module(module_name)
+            except Exception as e:
+                failed.setdefault(platform, {})[module_name] = str(e)
+    return failed
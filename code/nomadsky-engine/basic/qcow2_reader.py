@@ -0,0 +1,248 @@
+# -------------------------------
+# Reader of the allocation map and data of a qcow2 image, without qemu.
+# Cyso, Leafcloud and Huawei export qcow2. Converting that to a fixed VHD writes out the whole virtual disk, zeros
+# included, only for the upload to skip the zeros again. Qcow2Image reads the header and the L1/L2 tables instead,
+# and yields only the clusters that hold data, at their offset in the guest disk, decompressed where needed.
+# An upload to a page blob or a sparse raw file then writes just those extents straight from the qcow2 file.
+# Supported are qcow2 version 2 and 3 with deflate (and zstd, with the zstandard package) compressed clusters;
+# images with a backing file, encryption, an external data file or extended L2 entries are left to qemu-img.
+# Layout from the qcow2 specification in the qemu source tree (docs/interop/qcow2.txt).
+# -------------------------------
+import sys
+import os
+import zlib
+import struct
+import importlib.util
+
+sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/basic")
+import ranged_download
+import vhd_format
+
+magic = b"QFI\xfb"
+block_size = 4 * 1024 * 1024  # the blocks yielded are joined up to this size, the size of an Azure upload_page call
+
+_offset_mask = 0x00FFFFFFFFFFFE00  # bits 9-55: the host offset of an L2 table or a cluster
+_compressed = 1 << 62
+_zero = 1  # version 3: the cluster reads as zeros
+
+_dirty, _corrupt, _external_data, _compression_type, _extended_l2 = (1 << bit for bit in range(5))
+
+
+def is_qcow2(path):
+    with open(path, "rb") as f:
+        return f.read(4) == magic
+
+
+class Qcow2Image:
+    """
+    An open qcow2 image.
+
+    Attributes:
+        size: the virtual size of the disk in bytes
+        cluster_size: bytes per cluster
+
+    Raises:
+        Exception: If the file is no qcow2 image or uses a feature this reader does not support
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        try:
+            self._read_header()
+        except Exception:
+            self.file.close()
+            raise
+
+    def _read_header(self):
+        header = self.file.read(112)
+        if header[:4] != magic:
+            raise Exception(f"'{self.path}' is not a qcow2 image")
+        (self.version, backing_file_offset, _, cluster_bits, self.size, crypt_method, self.l1_size,
+         self.l1_table_offset) = struct.unpack(">IQIIQIIQ", header[4:48])
+        self.cluster_bits = cluster_bits
+        self.cluster_size = 1 << cluster_bits
+        self.compression = "deflate"
+        incompatible = 0
+        if self.version >= 3:
+            incompatible = struct.unpack(">Q", header[72:80])[0]
+            header_length = struct.unpack(">I", header[100:104])[0]
+            if incompatible & _compression_type and header_length > 104:
+                self.compression = {0: "deflate", 1: "zstd"}.get(header[104], f"type {header[104]}")
+        if backing_file_offset:
+            raise Exception(f"'{self.path}' has a backing file, qemu-img has to merge it")
+        if crypt_method:
+            raise Exception(f"'{self.path}' is encrypted")
+        if incompatible & (_corrupt | _external_data | _extended_l2) or incompatible >> 5:
+            raise Exception(f"'{self.path}' uses qcow2 features this reader does not support ({incompatible:#x})")
+        if self.compression not in ("deflate", "zstd"):
+            raise Exception(f"'{self.path}' uses the unknown compression {self.compression}")
+        if self.compression == "zstd" and importlib.util.find_spec("zstandard") is None:
+            # only needed for zstd images, it is imported when the first compressed cluster is read
+            raise Exception(f"'{self.path}' is zstd compressed, that needs the zstandard package")
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _read(self, offset, length):
+        self.file.seek(offset)
+        data = self.file.read(length)
+        if len(data) != length:
+            raise Exception(f"'{self.path}' ends before offset {offset + length}, the image is truncated")
+        return data
+
+    def clusters(self):
+        """
+        The clusters that hold data, in the order of the guest disk; unallocated and zero clusters are left out.
+
+        Returns:
+            iterator of (guest offset, L2 entry)
+        """
+        entries_per_table = self.cluster_size // 8
+        l1 = struct.unpack(f">{self.l1_size}Q", self._read(self.l1_table_offset, self.l1_size * 8))
+        for l1_index, l1_entry in enumerate(l1):
+            table_offset = l1_entry & _offset_mask
+            if not table_offset:
+                continue
+            table = struct.unpack(f">{entries_per_table}Q", self._read(table_offset, self.cluster_size))
+            first = l1_index * entries_per_table
+            for l2_index, entry in enumerate(table):
+                guest = (first + l2_index) * self.cluster_size
+                if guest >= self.size:
+                    return
+                if entry & _compressed or (entry & _offset_mask and not entry & _zero):
+                    yield guest, entry
+
+    def extents(self):
+        """
+        The parts of the guest disk that hold data, neighbouring clusters joined.
+
+        Returns:
+            list of (guest offset, length)
+        """
+        extents = []
+        for guest, _ in self.clusters():
+            length = min(self.cluster_size, self.size - guest)
+            if extents and extents[-1][0] + extents[-1][1] == guest:
+                extents[-1] = (extents[-1][0], extents[-1][1] + length)
+            else:
+                extents.append((guest, length))
+        return extents
+
+    def allocated_bytes(self):
+        return sum(length for _, length in self.extents())
+
+    def _decompress(self, entry):
+        shift = 62 - (self.cluster_bits - 8)
+        host = entry & ((1 << shift) - 1)
+        sectors = ((entry >> shift) & ((1 << (self.cluster_bits - 8)) - 1)) + 1
+        # the stored length is rounded up to sectors, the end of the file can come first
+        self.file.seek(host)
+        data = self.file.read(sectors * 512 - (host & 511))
+        if self.compression == "zstd":
+            import zstandard
+            return zstandard.ZstdDecompressor().decompressobj().decompress(data)[:self.cluster_size]
+        return zlib.decompressobj(-12).decompress(data, self.cluster_size)
+
+    def _pieces(self):
+        # the data of the clusters; clusters next to each other in the guest and in the file are read at once,
+        # a piece never crosses a boundary of block_size
+        run = None  # [guest offset, host offset, length]
+
+        def read_run(guest, host, length):
+            position = 0
+            while position < length:
+                count = min(length - position, block_size - (guest + position) % block_size)
+                yield guest + position, self._read(host + position, count)
+                position += count
+
+        for guest, entry in self.clusters():
+            length = min(self.cluster_size, self.size - guest)
+            if entry & _compressed:
+                if run:
+                    yield from read_run(*run)
+                    run = None
+                yield guest, self._decompress(entry)[:length]
+                continue
+            host = entry & _offset_mask
+            if run and run[0] + run[2] == guest and run[1] + run[2] == host:
+                run[2] += length
+            else:
+                if run:
+                    yield from read_run(*run)
+                run = [guest, host, length]
+        if run:
+            yield from read_run(*run)
+
+    def blocks(self):
+        """
+        The data of the allocated clusters, joined into blocks of at most block_size bytes that never cross a
+        multiple of block_size, so a fully allocated block comes as one piece.
+
+        Returns:
+            iterator of (guest offset, data)
+        """
+        start, parts, end = None, [], None
+        for offset, data in self._pieces():
+            if parts and (offset != end or offset // block_size != start // block_size):
+                yield start, b"".join(parts)
+                parts = []
+            if not parts:
+                start = offset
+            parts.append(data)
+            end = offset + len(data)
+        if parts:
+            yield start, b"".join(parts)
+
+    def fixed_vhd(self):
+        """
+        The image as a fixed VHD for a page blob: the allocated blocks and the footer after the disk of whole MiB.
+
+        Returns:
+            tuple: (size of the VHD in bytes, iterator of (offset, data))
+        """
+        disk_size = vhd_format.aligned_size(self.size)
+
+        def blocks():
+            yield from self.blocks()
+            yield disk_size, vhd_format.build_footer(disk_size)
+
+        return disk_size + vhd_format.footer_size, blocks()
+
+    def to_raw(self, output_path, progress=None):
+        """
+        Write the disk as a sparse raw image, only the allocated clusters are written.
+
+        Args:
+            progress: optional progress_events.ProgressReporter, counts the bytes written
+
+        Returns:
+            int: the bytes written
+        """
+        written = 0
+        open(output_path, "wb").close()
+        ranged_download.make_sparse(output_path)
+        os.truncate(output_path, self.size)
+        with open(output_path, "r+b") as f:
+            for offset, data in self.blocks():
+                f.seek(offset)
+                f.write(data)
+                written += len(data)
+                if progress is not None:
+                    progress.add(len(data))
+        return written
+
+
+def supported(path):
+    """True when path is a qcow2 image that Qcow2Image can read."""
+    try:
+        with Qcow2Image(path):
+            return True
+    except Exception:
+        return False
@@ -0,0 +1,340 @@
+# -------------------------------
+# Writer of qcow2 images with compressed clusters, for destinations that import qcow2 (Cyso, Leafcloud, Huawei).
+# Glance takes the image file as it is, so a qcow2 with deflate (or zstd) compressed clusters is what crosses the
+# link. qemu-img convert -c compresses on one core; write() compresses the clusters in batches on a process pool,
+# one process per core, and writes them in the order of the disk. Zero clusters are left out.
+# Compression only pays when the link is slower than the cores: convert() compresses a sample of the disk first and
+# compares the time to compress and upload the compressed image with the time to upload it uncompressed, at the
+# upload throughput measured on earlier migrations. When compression does not pay, the clusters are written as they are.
+# The image is a qcow2 version 3 with 64 KiB clusters and 16 bit refcounts, layout from the qcow2 specification in
+# the qemu source tree (docs/interop/qcow2.txt).
+# -------------------------------
+import sys
+import os
+import time
+import zlib
+import struct
+import itertools
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/scripts")
+sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/basic")
+import general_parameters
+import ranged_download
+import vhd_format
+import qcow2_reader
+import vmdk_stream
+
+cluster_bits = 16
+cluster_size = 1 << cluster_bits
+batch_clusters = 64  # clusters per task of the process pool, 4 MiB
+sample_bytes = 32 * 1024 * 1024  # data compressed up front to decide whether compression pays
+read_size = 4 * 1024 * 1024
+
+_header = ">4sIQIIQIIQQIIQQQQII"  # the 104 bytes of a version 3 header
+_copied = 1 << 63  # the cluster or L2 table has refcount 1
+_compressed = 1 << 62
+_compression_type = 1 << 3  # incompatible feature: the compression type byte after the header
+_refcount_order = 4  # 16 bit refcounts
+_zeros = bytes(cluster_size)
+
+
+def _compress(data, compression, level):
+    if compression == "zstd":
+        import zstandard
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -12)  # raw deflate with a 4 KiB window, as qemu writes it
+    return compressor.compress(data) + compressor.flush()
+
+
+def _compress_batch(batch, compression, level):
+    # runs in a pool process; a cluster that does not get smaller is stored as it is
+    clusters = []
+    for guest, data in batch:
+        packed = _compress(data, compression, level)
+        if len(packed) < cluster_size:
+            clusters.append((guest, packed, True))
+        else:
+            clusters.append((guest, data, False))
+    return clusters
+
+
+def clusters(extents, size):
+    """
+    The clusters of the disk that hold data, from extents in the order of the disk.
+
+    Returns:
+        iterator of (guest offset, cluster_size bytes)
+
+    Raises:
+        Exception: If an extent goes back to a cluster before the current one
+    """
+    current, buffer = None, None
+    for offset, data in extents:
+        position = 0
+        while position < len(data):
+            guest = offset + position
+            start = guest - guest % cluster_size
+            if start != current:
+                if current is not None:
+                    if start < current:
+                        raise Exception(f"the extents go back from {current} to {start}, they must be in disk order")
+                    if buffer != _zeros:
+                        yield current, bytes(buffer)
+                current, buffer = start, bytearray(cluster_size)
+            count = min(len(data) - position, start + cluster_size - guest)
+            buffer[guest - start:guest - start + count] = data[position:position + count]
+            position += count
+    if current is not None and current < size and buffer != _zeros:
+        yield current, bytes(buffer)
+
+
+class _Refcounts:
+    # refcount of every host cluster, grown as the file grows
+
+    def __init__(self):
+        self.counts = array('H')
+
+    def add(self, offset, length):
+        first, last = offset >> cluster_bits, (offset + length - 1) >> cluster_bits
+        if last >= len(self.counts):
+            self.counts.extend(itertools.repeat(0, last + 1 - len(self.counts) + 4096))
+        for index in range(first, last + 1):
+            self.counts[index] += 1
+
+    def block(self, index, entries):
+        block = self.counts[index * entries:(index + 1) * entries]
+        block.extend(itertools.repeat(0, entries - len(block)))
+        if sys.byteorder == "little":
+            block.byteswap()
+        return block.tobytes()
+
+
+def write(output_path, size, clusters, compression="zlib", level=6, processes=None, progress=None):
+    """
+    Write a qcow2 image of a disk of size bytes.
+
+    Args:
+        clusters: iterator of (guest offset, cluster_size bytes) in the order of the disk, see clusters()
+        compression: "zlib" or "zstd", None writes the clusters uncompressed; an item of clusters can also come
+            compressed already, as (guest offset, data, True)
+        processes: processes of the pool, default general_parameters.qcow2_compress_processes or every core
+        progress: optional progress_events.ProgressReporter, updated with the guest offset reached
+
+    Returns:
+        dict: allocated (bytes of data clusters), compressed (clusters stored compressed) and size of the file
+    """
+    entries = cluster_size // 8  # of an L1/L2/refcount table
+    refcount_entries = cluster_size * 8 // (1 << _refcount_order)
+    l1_size = max(1, -(-size // (entries * cluster_size)))
+    l1_offset = cluster_size
+    data_start = l1_offset + -(-l1_size * 8 // cluster_size) * cluster_size
+    refcounts = _Refcounts()
+    refcounts.add(0, data_start)  # header and L1 table
+    l2_tables = {}
+    stats = {'allocated': 0, 'compressed': 0}
+    processes = processes or getattr(general_parameters, 'qcow2_compress_processes', None) or os.cpu_count() or 1
+
+    def stored(items):
+        # (guest offset, data, compressed) in the order of the disk
+        if not compression:
+            for item in items:
+                yield item if len(item) == 3 else (item[0], item[1], False)
+            return
+        pending = deque()
+        batch = []
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            for item in items:
+                if len(item) == 3:
+                    # compressed already (the sample), everything before it has to be written first
+                    while pending:
+                        yield from pending.popleft().result()
+                    if batch:
+                        yield from _compress_batch(batch, compression, level)
+                        batch = []
+                    yield item
+                    continue
+                batch.append(item)
+                if len(batch) >= batch_clusters:
+                    pending.append(pool.submit(_compress_batch, batch, compression, level))
+                    batch = []
+                    # two batches per process in flight, so the reading and the pool keep each other busy
+                    if len(pending) >= processes * 2:
+                        yield from pending.popleft().result()
+            if batch:
+                pending.append(pool.submit(_compress_batch, batch, compression, level))
+            while pending:
+                yield from pending.popleft().result()
+
+    open(output_path, "wb").close()
+    ranged_download.make_sparse(output_path)
+    with open(output_path, "r+b") as f:
+        position = data_start
+        for guest, data, packed in stored(clusters):
+            if packed:
+                # a compressed cluster starts at any byte, the entry holds the sectors it spans after the first
+                sectors = ((position + len(data) - 1) >> 9) - (position >> 9)
+                entry = _compressed | sectors << (62 - (cluster_bits - 8)) | position
+                stats['compressed'] += 1
+            else:
+                position = -(-position // cluster_size) * cluster_size
+                entry = _copied | position
+            f.seek(position)
+            f.write(data)
+            refcounts.add(position, len(data))
+            position += len(data)
+            stats['allocated'] += cluster_size
+            table = l2_tables.setdefault(guest // (entries * cluster_size), array('Q', bytes(cluster_size)))
+            table[guest // cluster_size % entries] = entry
+            if progress is not None:
+                progress.update(guest)
+
+        # the L2 tables, then the refcount table and blocks after everything else
+        position = -(-position // cluster_size) * cluster_size
+        l1 = array('Q', bytes(l1_size * 8))
+        for index in sorted(l2_tables):
+            table = l2_tables[index]
+            if sys.byteorder == "little":
+                table.byteswap()
+            f.seek(position)
+            f.write(table.tobytes())
+            refcounts.add(position, cluster_size)
+            l1[index] = _copied | position
+            position += cluster_size
+        used = position // cluster_size
+        blocks, table_clusters = 0, 0
+        while True:
+            # the refcount structures count themselves as well
+            needed = -(-(used + blocks + table_clusters) // refcount_entries)
+            needed_table = -(-needed * 8 // cluster_size)
+            if (needed, needed_table) == (blocks, table_clusters):
+                break
+            blocks, table_clusters = needed, needed_table
+        table_offset = position
+        refcounts.add(table_offset, (table_clusters + blocks) * cluster_size)
+        block_offsets = [table_offset + (table_clusters + index) * cluster_size for index in range(blocks)]
+        f.seek(table_offset)
+        f.write(struct.pack(f">{blocks}Q", *block_offsets))
+        for index, offset in enumerate(block_offsets):
+            f.seek(offset)
+            f.write(refcounts.block(index, refcount_entries))
+        end = table_offset + (table_clusters + blocks) * cluster_size
+
+        if sys.byteorder == "little":
+            l1.byteswap()
+        f.seek(l1_offset)
+        f.write(l1.tobytes())
+        incompatible, header_length, extra = 0, struct.calcsize(_header), b""
+        if compression == "zstd":
+            incompatible, header_length, extra = _compression_type, header_length + 8, bytes([1]) + bytes(7)
+        f.seek(0)
+        f.write(struct.pack(_header, qcow2_reader.magic, 3, 0, 0, cluster_bits, size, 0, l1_size, l1_offset,
+                            table_offset, table_clusters, 0, 0, incompatible, 0, 0, _refcount_order,
+                            header_length) + extra)
+        f.truncate(end)
+    stats['size'] = end
+    return stats
+
+
+def readable(path, disk_format):
+    """True when convert() can read path: raw, fixed VHD, qcow2 the reader supports or a streamOptimized VMDK."""
+    if disk_format in ("raw", "vhd"):
+        return True
+    if disk_format == "qcow2":
+        return qcow2_reader.supported(path)
+    if disk_format == "vmdk":
+        return vmdk_stream.is_stream_optimized(path)
+    return False
+
+
+def _file_extents(path, size):
+    with open(path, "rb") as f:
+        offset = 0
+        while offset < size:
+            data = f.read(min(read_size, size - offset))
+            if not data:
+                return
+            yield offset, data
+            offset += len(data)
+
+
+def _qcow2_extents(path):
+    with qcow2_reader.Qcow2Image(path) as image:
+        yield from image.blocks()
+
+
+def _vmdk_extents(path):
+    with open(path, "rb") as f:
+        yield from vmdk_stream.extents(f)
+
+
+def source(path, disk_format):
+    """
+    Returns:
+        tuple: (virtual size of the disk, iterator of (guest offset, data) in the order of the disk)
+    """
+    if disk_format == "qcow2":
+        with qcow2_reader.Qcow2Image(path) as image:
+            size = image.size
+        return size, _qcow2_extents(path)
+    if disk_format == "vmdk":
+        with open(path, "rb") as f:
+            size = vmdk_stream.read_header(f)['capacity']
+        return size, _vmdk_extents(path)
+    size = os.path.getsize(path)
+    if disk_format == "vhd":
+        size -= vhd_format.footer_size
+    return size, _file_extents(path, size)
+
+
+def worth_compressing(ratio, compress_speed, processes, upload_speed):
+    """
+    True when compressing and uploading the smaller image takes less time than uploading it uncompressed.
+
+    Args:
+        ratio: compressed bytes per byte of data, from a sample
+        compress_speed: bytes per second one process compresses
+        upload_speed: bytes per second of the upload
+    """
+    if ratio >= 1 or compress_speed <= 0:
+        return False
+    return 1 / (compress_speed * processes) + ratio / upload_speed < 1 / upload_speed
+
+
+def convert(input_path, output_path, input_format, compression="zlib", upload_speed=None, processes=None,
+            progress=None):
+    """
+    Write input_path as a qcow2 image, compressed when a sample shows that it makes the upload faster.
+
+    Args:
+        upload_speed: bytes per second of the upload to the destination, default general_parameters.planner_bandwidth
+
+    Returns:
+        dict: the stats of write(), the compression used (None when it did not pay), the sample ratio and the
+        compression and upload speeds it was decided on
+    """
+    processes = processes or getattr(general_parameters, 'qcow2_compress_processes', None) or os.cpu_count() or 1
+    upload_speed = upload_speed or general_parameters.planner_bandwidth
+    size, extents = source(input_path, input_format)
+    data = clusters(extents, size)
+
+    # compress the first clusters here, measuring ratio and speed of one process
+    sample = list(itertools.islice(data, sample_bytes // cluster_size))
+    started = time.monotonic()
+    packed = _compress_batch(sample, compression, 6) if compression else []
+    elapsed = max(time.monotonic() - started, 1e-6)
+    sample_size = len(sample) * cluster_size
+    ratio = sum(len(item[1]) for item in packed) / sample_size if packed else 1.0
+    compress_speed = sample_size / elapsed if packed else 0
+    if compression and worth_compressing(ratio, compress_speed, processes, upload_speed):
+        used = compression
+        head = packed
+    else:
+        used = None
+        head = sample
+    stats = write(output_path, size, itertools.chain(head, data), used, processes=processes, progress=progress)
+    stats.update(compression=used, sample_ratio=ratio, compress_speed=compress_speed * processes,
+                 upload_speed=upload_speed)
+    return stats
@@ -0,0 +1,172 @@
+# -------------------------------
+# qemu-img convert with the options picked for the disks it runs on.
+# By default qemu-img converts with 8 coroutines that write in order, through the cache of Windows, and a 100 GB
+# image then mostly waits. options() chooses per conversion:
+#   -m   coroutines: 16 on an SSD (the maximum of qemu-img), 4 on a spinning disk that would only seek more
+#   -W   out-of-order writes, not on a spinning disk and not together with compression (qemu-img refuses that)
+#   -t/-T none  bypass the host cache for images that do not fit in it anyway, so the convert does not push out
+#               the memory of the other migrations
+#   -S   the run of zeros that becomes a hole: the cluster size of qcow2/vmdk/vhdx, 4 KiB for raw, and 0 for a
+#        fixed VHD that Azure needs written out completely
+# The media of a path is asked once from Windows (Get-PhysicalDisk) or Linux (/sys/block/.../rotational).
+# Every option can be fixed in general_parameters.py, None lets options() choose it.
+# -------------------------------
+import sys
+import os
+import re
+import subprocess
+import functools
+
+sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/scripts")
+sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/basic")
+import general_parameters
+import progress_events
+
+max_coroutines = 16  # qemu-img refuses more
+cache_bypass_size = 4 * 1024**3  # smaller images are left to the host cache, they are read again by the upload
+cluster_formats = ("qcow2", "vmdk", "vhdx")
+
+
+def _setting(name):
+    return getattr(general_parameters, name, None)
+
+
+@functools.lru_cache(maxsize=None)
+def _media_of_device(device):
+    if os.name == "nt":
+        command = (f"(Get-PhysicalDisk | Where-Object DeviceId -eq "
+                   f"(Get-Partition -DriveLetter {device}).DiskNumber).MediaType")
+        try:
+            output = subprocess.run(["powershell", "-NoProfile", "-Command", command],
+                                    capture_output=True, text=True, timeout=30).stdout.strip().lower()
+        except (OSError, subprocess.SubprocessError):
+            return "unknown"
+        return {"ssd": "ssd", "hdd": "hdd"}.get(output, "unknown")
+    try:
+        with open(f"/sys/class/block/{device}/queue/rotational") as f:
+            return "hdd" if f.read().strip() == "1" else "ssd"
+    except OSError:
+        return "unknown"
+
+
+def media(path):
+    """The kind of disk path is on: "ssd", "hdd" or "unknown" (e.g. a network share)."""
+    path = os.path.abspath(path)
+    if os.name == "nt":
+        drive = os.path.splitdrive(path)[0].rstrip(":")
+        return _media_of_device(drive.upper()) if len(drive) == 1 else "unknown"
+    try:
+        device = os.stat(path if os.path.exists(path) else os.path.dirname(path)).st_dev
+        # a partition (sda1) reports rotational through its disk (sda)
+        name = os.path.basename(os.path.realpath(f"/sys/dev/block/{os.major(device)}:{os.minor(device)}"))
+        if not os.path.exists(f"/sys/class/block/{name}/queue/rotational"):
+            name = os.path.basename(os.path.dirname(os.path.realpath(f"/sys/class/block/{name}")))
+        return _media_of_device(name)
+    except OSError:
+        return "unknown"
+
+
+def options(input_path, output_path, output_format, compressed=False):
+    """
+    The tuning options of a conversion.
+
+    Returns:
+        dict: coroutines, out_of_order, cache_bypass, sparse_size (bytes) and the media of input and output
+    """
+    source_media = media(input_path)
+    target_media = media(output_path)
+    spinning = "hdd" in (source_media, target_media)
+
+    coroutines = _setting('qemu_coroutines')
+    if coroutines is None:
+        coroutines = 4 if spinning else max_coroutines
+    out_of_order = _setting('qemu_out_of_order')
+    if out_of_order is None:
+        out_of_order = not spinning
+    if compressed:
+        out_of_order = False
+    cache_bypass = _setting('qemu_cache_bypass')
+    if cache_bypass is None:
+        cache_bypass = os.path.getsize(input_path) >= cache_bypass_size
+    sparse_size = _setting('qemu_sparse_size')
+    if sparse_size is None:
+        if output_format == "vpc":
+            sparse_size = 0
+        elif output_format in cluster_formats:
+            sparse_size = 64 * 1024
+        else:
+            sparse_size = 4096
+    return {
+        'coroutines': min(int(coroutines), max_coroutines),
+        'out_of_order': bool(out_of_order),
+        'cache_bypass': bool(cache_bypass),
+        'sparse_size': sparse_size,
+        'source_media': source_media,
+        'target_media': target_media
+    }
+
+
+def command(qemu_path, input_path, output_path, output_format, target_options=None, compressed=False, tuning=None):
+    """The qemu-img convert command line, tuning is the result of options()."""
+    tuning = tuning or options(input_path, output_path, output_format, compressed)
+    arguments = [qemu_path, "convert", "-p", "-O", output_format, "-m", str(tuning['coroutines'])]
+    if tuning['out_of_order']:
+        arguments.append("-W")
+    if tuning['cache_bypass']:
+        arguments += ["-t", "none", "-T", "none"]
+    arguments += ["-S", str(tuning['sparse_size'])]
+    if compressed:
+        arguments.append("-c")
+    if target_options:
+        arguments += ["-o", target_options]
+    return arguments + [input_path, output_path]
+
+
+def run_with_progress(arguments, total_bytes, action="convert"):
+    """
+    Run qemu-img with -p and turn the "    (12.34/100%)" it prints into progress events of total_bytes.
+
+    Raises:
+        Exception: If qemu-img fails, with its messages
+    """
+    progress = progress_events.ProgressReporter(total_bytes=total_bytes, action=action)
+    process = subprocess.Popen(arguments, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = b""
+    messages = b""
+    while True:
+        data = process.stdout.read1(256)
+        if not data:
+            break
+        output += data
+        parts = re.split(rb"[\r\n]", output)
+        output = parts.pop()
+        for part in parts:
+            found = re.search(rb"\((\d+(?:\.\d+)?)/100%\)", part)
+            if found:
+                progress.update(int(progress.total_bytes * float(found.group(1)) / 100))
+            elif part.strip():
+                messages += part + b"\n"
+    if process.wait() != 0:
+        raise Exception(f"qemu-img {arguments[1]} failed: {(messages + output).decode(errors='replace')}")
+    progress.done()
+
+
+def convert(qemu_path, input_path, output_path, output_format, target_options=None, compressed=False):
+    """
+    Convert input_path to output_format with the tuning of options().
+
+    Returns:
+        dict: the options that were used
+    """
+    tuning = options(input_path, output_path, output_format, compressed)
+    try:
+        run_with_progress(command(qemu_path, input_path, output_path, output_format, target_options, compressed,
+                                  tuning), os.path.getsize(input_path))
+    except Exception:
+        if not tuning['cache_bypass']:
+            raise
+        # some file systems (e.g. a network share) refuse unbuffered io, convert through the host cache then
+        tuning['cache_bypass'] = False
+        run_with_progress(command(qemu_path, input_path, output_path, output_format, target_options, compressed,
+                                  tuning), os.path.getsize(input_path))
+    return tuning
@@ -0,0 +1,262 @@
+# -------------------------------
+# Parallel download of one large object (Azure SAS url, Glance image file) over several HTTP connections.
+# The object is split into ranges of general_parameters.download_range_size bytes. The ranges are fetched with
+# ranged GETs on general_parameters.download_connections threads, every thread with its own pooled session,
+# and each range is written at its own offset in the output file.
+# A range that fails is retried on its own; the other ranges are kept. The finished ranges are written to
+# "<output_path>.ranges", so a download that was interrupted continues with the missing ranges only.
+# When the caller knows which parts of the object hold data (e.g. the page ranges of an Azure page blob), only
+# those parts are fetched and the output file is sparse: the parts in between stay holes that read as zeros.
+# With existing=True the ranges are written into a file that is already there, e.g. the changed pages of a disk
+# over an earlier copy of it.
+# The bytes are hashed into an integrity.TreeHash while they are written, and the manifest is stored next to the
+# file; with expected checksums of the source the flat hashes are compared too.
+# -------------------------------
+import sys
+import os
+import json
+import time
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+
+sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/scripts")
+import general_parameters
+sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/basic")
+import integrity
+
+chunk_size = 1024 * 1024  # bytes read from the response at a time
+
+_local = threading.local()
+
+
+def request_headers(headers):
+    # headers can be a function, so a token is fetched again when a long transfer reconnects
+    if callable(headers):
+        return dict(headers())
+    return dict(headers or {})
+
+
+def _session():
+    # one session per thread, so each connection stays open for the next range
+    if getattr(_local, "session", None) is None:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=1)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _local.session = session
+    return _local.session
+
+
+def remote_size(url, headers=None):
+    """Size in bytes of the object behind the url, from a HEAD request or else from a one byte ranged GET."""
+    response = requests.head(url, headers=request_headers(headers), timeout=60, allow_redirects=True)
+    if response.ok and response.headers.get("Content-Length"):
+        return int(response.headers["Content-Length"])
+    range_headers = request_headers(headers)
+    range_headers["Range"] = "bytes=0-0"
+    with requests.get(url, headers=range_headers, stream=True, timeout=60) as response:
+        response.raise_for_status()
+        return int(response.headers["Content-Range"].split("/")[-1])
+
+
+def remote_checksums(url, headers=None):
+    """The Content-MD5 of the object behind the url as {'md5': hex digest}, empty when the server has none."""
+    response = requests.head(url, headers=request_headers(headers), timeout=60, allow_redirects=True)
+    if response.ok and response.headers.get("Content-MD5"):
+        return {'md5': integrity.base64_to_hex(response.headers["Content-MD5"])}
+    return {}
+
+
+def split_ranges(size, range_size):
+    """The (start, end) byte ranges of an object, end included like in a Range header."""
+    return [(start, min(start + range_size, size) - 1) for start in range(0, size, range_size)]
+
+
+def merge_ranges(ranges, gap=1024 * 1024):
+    """
+    Sort (start, end) ranges and join the ones that overlap or lie less than gap bytes apart,
+    a few zeros more are cheaper than thousands of small requests.
+    """
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1 + gap:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def _pieces(ranges, range_size):
+    # the allocated ranges cut into pieces of at most range_size bytes
+    pieces = []
+    for start, end in ranges:
+        pieces += [(piece_start, min(piece_start + range_size, end + 1) - 1)
+                   for piece_start in range(start, end + 1, range_size)]
+    return pieces
+
+
+def make_sparse(path):
+    """Mark a file as sparse, so the ranges that are never written take no disk space (NTFS needs the flag)."""
+    if os.name == "nt":
+        subprocess.run(["fsutil", "sparse", "setflag", path], capture_output=True)
+    # other file systems leave the unwritten parts of a truncated file as holes by themselves
+
+
+def state_path(output_path):
+    return output_path + ".ranges"
+
+
+def is_partial(output_path):
+    """True when a download to output_path was started but not finished."""
+    return os.path.exists(state_path(output_path))
+
+
+def _load_state(output_path, size, range_size):
+    try:
+        with open(state_path(output_path)) as f:
+            state = json.load(f)
+        if state['size'] == size and state['range_size'] == range_size and os.path.exists(output_path):
+            return set(state['done'])
+    except (OSError, ValueError, KeyError):
+        pass
+    return set()
+
+
+def _save_state(output_path, size, range_size, done):
+    temporary = state_path(output_path) + ".tmp"
+    with open(temporary, "w") as f:
+        json.dump({'size': size, 'range_size': range_size, 'done': sorted(done)}, f)
+    os.replace(temporary, state_path(output_path))
+
+
+def zero_ranges(output_path, ranges):
+    """Overwrite (start, end) ranges of an existing file with zeros, e.g. the pages that were cleared on the source."""
+    zeros = bytes(chunk_size)
+    integrity.invalidate(output_path, ranges)
+    with open(output_path, "r+b") as f:
+        for start, end in ranges:
+            f.seek(start)
+            remaining = end + 1 - start
+            while remaining > 0:
+                f.write(zeros[:min(remaining, chunk_size)])
+                remaining -= chunk_size
+
+
+def fetch_range(url, output_path, start, end, headers=None, progress=None, tree=None):
+    """Download bytes start..end (included) of the url and write them at the same offset in output_path."""
+    range_headers = request_headers(headers)
+    range_headers["Range"] = f"bytes={start}-{end}"
+    position = start
+    with _session().get(url, headers=range_headers, stream=True, timeout=60) as response:
+        response.raise_for_status()
+        if response.status_code != 206:
+            # a server without Range support sends the whole object, only usable when that is the range
+            if start != 0 or int(response.headers.get("Content-Length", -1)) != end + 1:
+                raise Exception(f"the server ignored the range {start}-{end} (status {response.status_code})")
+        with open(output_path, "r+b") as f:
+            f.seek(start)
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                if chunk:
+                    f.write(chunk[:end + 1 - position])
+                    if tree is not None:
+                        tree.update(position, chunk[:end + 1 - position])
+                    position += len(chunk)
+                    if progress is not None:
+                        progress.add(len(chunk))
+    if position <= end:
+        raise requests.exceptions.ChunkedEncodingError(f"range {start}-{end} ended at {position}")
+
+
+def download(url, output_path, size=None, headers=None, connections=None, range_size=None,
+             max_retries=5, retry_wait=10, progress=None, ranges=None, existing=False, expected=None):
+    """
+    Download the url to output_path with parallel ranged GETs.
+
+    Args:
+        url: the object to download, the server must support Range requests
+        output_path: the file to write, created with the full size up front
+        size: size of the object, asked from the server when None
+        headers: dict or function returning a dict with extra request headers (e.g. a token)
+        connections: number of parallel connections, default general_parameters.download_connections
+        range_size: bytes per range, default general_parameters.download_range_size
+        max_retries: rounds in which the failed ranges are tried again
+        progress: optional progress_events.ProgressReporter
+        ranges: (start, end) ranges that hold data, the rest of the file stays a hole; None for the whole object
+        existing: write the ranges into the existing output file, the rest of the file is kept as it is
+        expected: {algorithm: hex digest} of the whole object published by the source, compared at the end
+
+    Returns:
+        int: the size of the downloaded object
+    """
+    connections = connections or general_parameters.download_connections
+    range_size = range_size or general_parameters.download_range_size
+    if size is None:
+        size = remote_size(url, headers)
+
+    if ranges is None:
+        pieces = split_ranges(size, range_size)
+    else:
+        pieces = _pieces(merge_ranges(ranges), range_size)
+
+    done = _load_state(output_path, size, range_size)
+    if not done:
+        # the ranges are written at their offsets, so the file gets its full size first
+        if not existing:
+            open(output_path, "wb").close()
+            if ranges is not None:
+                make_sparse(output_path)
+        os.truncate(output_path, size)
+        _save_state(output_path, size, range_size, done)
+
+    if progress is not None:
+        progress.total_bytes = sum(end + 1 - start for start, end in pieces)
+        progress.update(sum(end + 1 - start for start, end in pieces if start in done))
+
+    # the ranges of an existing file that are not fetched again are read back for the manifest at the end
+    # the ranges finish out of order, the flat hashes hold as many of them as can be in flight
+    tree = integrity.TreeHash(size, flat=tuple(name for name, value in (expected or {}).items() if value),
+                              window=integrity.in_flight_window(connections, range_size))
+
+    missing = [(start, end) for start, end in pieces if start not in done]
+    for attempt in range(max_retries + 1):
+        failed = []
+        with ThreadPoolExecutor(max_workers=connections) as executor:
+            futures = {executor.submit(fetch_range, url, output_path, start, end, headers, progress, tree): (start, end)
+                       for start, end in missing}
+            for future in as_completed(futures):
+                start, end = futures[future]
+                try:
+                    future.result()
+                except (requests.exceptions.RequestException, IOError) as e:
+                    failed.append((start, end, e))
+                    continue
+                done.add(start)
+                _save_state(output_path, size, range_size, done)
+        if not failed:
+            break
+        if attempt == max_retries:
+            raise Exception(f"{len(failed)} ranges failed after {max_retries} retries, last error: {failed[-1][2]}")
+        # only the failed ranges are fetched again; their partial bytes are counted again by the progress
+        missing = [(start, end) for start, end, _ in sorted(failed)]
+        time.sleep(retry_wait)
+
+    base = integrity.read_manifest(output_path) if existing else None
+    if base is not None and (base['leaf_size'] != tree.leaf or 'root' not in base):
+        base = None
+    if existing and base is None:
+        manifest = tree.finish(output_path)  # nothing known about the rest of the file, it is read once
+    else:
+        manifest = tree.finish(output_path, None if ranges is None else pieces, base)
+    try:
+        verified = integrity.compare(manifest['flat'], expected)
+    except Exception:
+        # a corrupt download must not be taken for a finished one
+        os.remove(output_path)
+        os.remove(state_path(output_path))
+        raise
+    integrity.write_manifest(output_path, manifest, verified)
+    os.remove(state_path(output_path))
+    return size
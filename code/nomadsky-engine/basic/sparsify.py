@@ -0,0 +1,530 @@
+# -------------------------------
+# Zero the free space of the file systems in a staged disk image.
+# A file system does not clear the blocks it frees, so a long-lived server carries gigabytes of old data in its free
+# space, and every zero-skipping transfer (page blob upload, qemu-img -S, the block store) still sends them.
+# free_ranges() finds the partitions (MBR, extended partitions or GPT) and reads the allocation maps of
+# ext2/3/4 (block bitmaps), XFS (free space btrees) and NTFS ($Bitmap); the free parts that are not zero already
+# are then overwritten with zeros in place. A raw image and a fixed VHD are handled this way; other formats go
+# through virt-sparsify --in-place when libguestfs is installed.
+# A file system that was not cleanly unmounted (journal to replay, dirty volume, NTFS $LogFile or XFS log not clean)
+# and a hibernated Windows volume are left alone, because their allocation maps on disk can be behind the journal or
+# the memory. Unknown partitions (LVM, swap, ...) are skipped.
+# -------------------------------
+import sys
+import os
+import re
+import math
+import shutil
+import struct
+import subprocess
+
+sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/basic")
+import vhd_format
+
+sector_size = 512
+chunk_size = 4 * 1024 * 1024
+minimum_range = 64 * 1024  # smaller free ranges are not worth a write, the uploads skip zeros from 64 KiB
+
+_zeros = bytes(chunk_size)
+
+
+def _read(f, offset, length):
+    f.seek(offset)
+    data = f.read(length)
+    if len(data) != length:
+        raise Exception(f"the image ends before offset {offset + length}")
+    return data
+
+
+def _free_bytes_of_bitmap(bitmap, units, unit_size, base):
+    """
+    The free ranges of an allocation bitmap with one bit per unit (lowest bit first), only whole free bytes of the
+    bitmap are taken, a partly used byte counts as used.
+
+    Returns:
+        list of (byte offset, length)
+    """
+    bitmap = bitmap[:units // 8]
+    return [(base + match.start() * 8 * unit_size, (match.end() - match.start()) * 8 * unit_size)
+            for match in re.finditer(rb"\x00+", bitmap)]
+
+
+# -------------------------------
+# partitions
+# -------------------------------
+def _whole_disk_file_system(f):
+    first = _read(f, 0, 2048)
+    return first[3:11] == b"NTFS    " or first[:4] == b"XFSB" or first[1080:1082] == b"\x53\xef"
+
+
+def partitions(f, size):
+    """
+    The partitions of the disk, or the whole disk when it holds a file system without partition table.
+
+    Returns:
+        list of (start, length) in bytes
+    """
+    if _whole_disk_file_system(f):
+        return [(0, size)]
+    mbr = _read(f, 0, sector_size)
+    if mbr[510:512] != b"\x55\xaa":
+        return []
+    entries = [struct.unpack("<4xB3xII", mbr[446 + 16 * i:462 + 16 * i]) for i in range(4)]
+    if any(partition_type == 0xEE for partition_type, _, _ in entries):
+        return _gpt_partitions(f, size)
+    found = []
+    for partition_type, first_lba, sectors in entries:
+        if partition_type in (0x05, 0x0F, 0x85):
+            found += _logical_partitions(f, first_lba)
+        elif partition_type and sectors:
+            found.append((first_lba * sector_size, sectors * sector_size))
+    return [(start, min(length, size - start)) for start, length in found if start < size]
+
+
+def _logical_partitions(f, extended_lba):
+    # a chain of extended boot records, each with one logical partition and a link to the next record
+    found = []
+    record_lba = extended_lba
+    for _ in range(128):
+        record = _read(f, record_lba * sector_size, sector_size)
+        if record[510:512] != b"\x55\xaa":
+            break
+        partition_type, first_lba, sectors = struct.unpack("<4xB3xII", record[446:462])
+        if partition_type and sectors:
+            found.append(((record_lba + first_lba) * sector_size, sectors * sector_size))
+        next_type, next_lba, _ = struct.unpack("<4xB3xII", record[462:478])
+        if not next_type or not next_lba:
+            break
+        record_lba = extended_lba + next_lba
+    return found
+
+
+def _gpt_partitions(f, size):
+    header = _read(f, sector_size, sector_size)
+    if header[:8] != b"EFI PART":
+        return []
+    entries_lba, count, entry_size = struct.unpack("<QII", header[72:88])
+    table = _read(f, entries_lba * sector_size, count * entry_size)
+    found = []
+    for index in range(count):
+        entry = table[index * entry_size:(index + 1) * entry_size]
+        if entry[:16] == bytes(16):
+            continue
+        first_lba, last_lba = struct.unpack("<QQ", entry[32:48])
+        found.append((first_lba * sector_size, (last_lba - first_lba + 1) * sector_size))
+    return [(start, min(length, size - start)) for start, length in found if start < size]
+
+
+# -------------------------------
+# file systems, each returns None when the partition is not that file system or is not safe to touch
+# -------------------------------
+def ext_free(f, start, length):
+    """Free ranges of an ext2/3/4 file system from the block bitmaps of its groups."""
+    sb = _read(f, start + 1024, 1024)
+    if sb[56:58] != b"\x53\xef":
+        return None
+    blocks, first_data_block, log_block_size, blocks_per_group = struct.unpack("<I12xII4xI", sb[4:36])
+    state = struct.unpack("<H", sb[58:60])[0]
+    incompat = struct.unpack("<I", sb[96:100])[0]
+    if incompat & 0x4 or not state & 0x1:
+        return None  # the journal needs a replay or the file system has errors
+    if incompat & 0x10:
+        return None  # meta_bg places the group descriptors elsewhere
+    if struct.unpack("<I", sb[100:104])[0] & 0x200:
+        return None  # bigalloc: the bitmaps count clusters of blocks
+    block_size = 1024 << log_block_size
+    descriptor_size = 32
+    if incompat & 0x80:  # 64bit
+        blocks += struct.unpack("<I", sb[336:340])[0] << 32
+        descriptor_size = struct.unpack("<H", sb[254:256])[0] or 64
+    if blocks * block_size > length or not blocks_per_group:
+        return None
+    groups = math.ceil((blocks - first_data_block) / blocks_per_group)
+    table = _read(f, start + (first_data_block + 1) * block_size, groups * descriptor_size)
+    free = []
+    for group in range(groups):
+        descriptor = table[group * descriptor_size:(group + 1) * descriptor_size]
+        bitmap_block = struct.unpack("<I", descriptor[0:4])[0]
+        if descriptor_size >= 64:
+            bitmap_block += struct.unpack("<I", descriptor[32:36])[0] << 32
+        flags = struct.unpack("<H", descriptor[18:20])[0]
+        if flags & 0x2 or not bitmap_block or bitmap_block >= blocks:
+            continue  # block_uninit: the group never held data, its bitmap is not written
+        first_block = first_data_block + group * blocks_per_group
+        units = min(blocks_per_group, blocks - first_block)
+        bitmap = _read(f, start + bitmap_block * block_size, block_size)
+        free += _free_bytes_of_bitmap(bitmap, units, block_size, start + first_block * block_size)
+    return free
+
+
+def _ntfs_fixup(data, magic):
+    record = bytearray(data)
+    if record[:4] != magic:
+        return None
+    # the last two bytes of every 512 byte stride were swapped for the update sequence number
+    usa_offset, usa_count = struct.unpack("<HH", record[4:8])
+    usn = record[usa_offset:usa_offset + 2]
+    for index in range(1, usa_count):
+        position = index * 512 - 2
+        if position + 2 > len(record) or record[position:position + 2] != usn:
+            return None
+        record[position:position + 2] = record[usa_offset + 2 * index:usa_offset + 2 * index + 2]
+    return bytes(record)
+
+
+def _ntfs_record(f, offset, record_size):
+    return _ntfs_fixup(_read(f, offset, record_size), b"FILE")
+
+
+def _ntfs_attribute(record, attribute_type):
+    position = struct.unpack("<H", record[20:22])[0]
+    while position + 8 <= len(record):
+        found_type, attribute_length = struct.unpack("<II", record[position:position + 8])
+        if found_type == 0xFFFFFFFF or attribute_length == 0:
+            return None
+        if found_type == attribute_type:
+            return record[position:position + attribute_length]
+        position += attribute_length
+    return None
+
+
+def _ntfs_runs(attribute):
+    # the data runs of a non-resident attribute: (first cluster or None for a sparse run, clusters)
+    position = struct.unpack("<H", attribute[32:34])[0]
+    runs = []
+    cluster = 0
+    while position < len(attribute) and attribute[position]:
+        length_size, offset_size = attribute[position] & 0x0F, attribute[position] >> 4
+        count = int.from_bytes(attribute[position + 1:position + 1 + length_size], "little")
+        if offset_size:
+            cluster += int.from_bytes(attribute[position + 1 + length_size:position + 1 + length_size + offset_size],
+                                      "little", signed=True)
+            runs.append((cluster, count))
+        else:
+            runs.append((None, count))
+        position += 1 + length_size + offset_size
+    return runs
+
+
+def _ntfs_data(f, start, cluster_size, attribute, length=None):
+    # the first length bytes (default all) of the value of a resident or non-resident attribute
+    if not attribute[8]:
+        value_length, value_offset = struct.unpack("<IH", attribute[16:22])
+        return attribute[value_offset:value_offset + value_length][:length]
+    data_size = struct.unpack("<Q", attribute[48:56])[0]
+    length = data_size if length is None else min(length, data_size)
+    data = b""
+    for cluster, count in _ntfs_runs(attribute):
+        if len(data) >= length:
+            break
+        count = min(count, -(-(length - len(data)) // cluster_size))
+        if cluster is None:
+            data += bytes(count * cluster_size)
+        else:
+            data += _read(f, start + cluster * cluster_size, count * cluster_size)
+    return data[:length]
+
+
+def _ntfs_log_clean(f, start, cluster_size, logfile):
+    """
+    True when the restart area of $LogFile says the volume was shut down cleanly (the test of ntfs-3g): no log
+    client in use, or the volume-is-clean flag. A log that was reset (all 0xFF) is clean, a chkdsk page is not.
+    """
+    data = _ntfs_attribute(logfile, 0x80) if logfile else None
+    if data is None:
+        return False
+    page_size = struct.unpack("<I", _ntfs_data(f, start, cluster_size, data, 24)[16:20])[0]
+    if page_size < 512 or page_size & (page_size - 1):
+        page_size = 4096
+    head = _ntfs_data(f, start, cluster_size, data, 2 * page_size)
+    if head == b"\xff" * len(head):
+        return True
+    newest = None
+    for page in (head[:page_size], head[page_size:2 * page_size]):
+        if page[:4] == b"CHKD":
+            return False
+        page = _ntfs_fixup(page, b"RSTR")
+        if page is None:
+            continue
+        area = page[struct.unpack("<H", page[24:26])[0]:]
+        current_lsn, _, _, in_use, flags = struct.unpack("<QHHHH", area[:16])
+        if newest is None or current_lsn > newest[0]:
+            newest = (current_lsn, in_use, flags)
+    if newest is None:
+        return False
+    _, in_use, flags = newest
+    return in_use == 0xFFFF or bool(flags & 0x0002)
+
+
+def _ntfs_hibernated(f, start, cluster_size, mft_runs, record_size, root):
+    """
+    True when the root directory holds a hiberfil.sys that starts with "hibr" (or "HIBR", fast startup): Windows
+    resumes from it with the volume as it was in memory, so its free space on disk is not free.
+    """
+    index_root = _ntfs_attribute(root, 0x90) if root else None
+    if index_root is None:
+        raise Exception("the root directory of the NTFS volume cannot be read")
+    value = _ntfs_data(f, start, cluster_size, index_root)
+    block_size = struct.unpack("<I", value[8:12])[0]
+    nodes = [value[16:]]  # the index node header of the root and its entries
+    allocation = _ntfs_attribute(root, 0xA0)
+    if allocation is not None:
+        blocks = _ntfs_data(f, start, cluster_size, allocation)
+        for position in range(0, len(blocks) - block_size + 1, block_size):
+            block = _ntfs_fixup(blocks[position:position + block_size], b"INDX")
+            if block is not None:
+                nodes.append(block[24:])
+    for node in nodes:
+        entries_offset, index_length = struct.unpack("<II", node[0:8])
+        position = entries_offset
+        while position + 16 <= min(index_length, len(node)):
+            reference, entry_length, key_length, flags = struct.unpack("<QHHI", node[position:position + 16])
+            if flags & 0x2 or not entry_length:
+                break  # the last entry holds no name
+            key = node[position + 16:position + 16 + key_length]
+            name = key[66:66 + 2 * key[64]].decode("utf-16-le", "replace")
+            if name.lower() == "hiberfil.sys":
+                number = reference & 0xFFFFFFFFFFFF
+                record = _ntfs_record(f, _ntfs_offset(start, cluster_size, mft_runs, number * record_size), record_size)
+                data = _ntfs_attribute(record, 0x80) if record else None
+                if data is None:
+                    raise Exception("the record of hiberfil.sys cannot be read")
+                return _ntfs_data(f, start, cluster_size, data, 4).lower() == b"hibr"
+            position += entry_length
+    return False
+
+
+def _ntfs_offset(start, cluster_size, runs, position):
+    # the byte offset on the disk of a position in the value of a non-resident attribute
+    for cluster, count in runs:
+        if position < count * cluster_size:
+            if cluster is None:
+                raise Exception("the position is in a sparse run")
+            return start + cluster * cluster_size + position
+        position -= count * cluster_size
+    raise Exception("the position is after the data runs")
+
+
+def ntfs_free(f, start, length):
+    """
+    Free ranges of an NTFS volume from its $Bitmap; a volume that is dirty, has a $LogFile to replay or a
+    hibernated Windows is left alone, as ntfs-3g refuses to mount it read-write.
+    """
+    boot = _read(f, start, sector_size)
+    if boot[3:11] != b"NTFS    ":
+        return None
+    bytes_per_sector, sectors_per_cluster = struct.unpack("<HB", boot[11:14])
+    if sectors_per_cluster > 0x80:
+        sectors_per_cluster = 1 << (256 - sectors_per_cluster)
+    total_sectors, mft_cluster = struct.unpack("<QQ", boot[40:56])
+    clusters_per_record = struct.unpack("<b", boot[64:65])[0]
+    cluster_size = bytes_per_sector * sectors_per_cluster
+    record_size = clusters_per_record * cluster_size if clusters_per_record > 0 else 1 << -clusters_per_record
+    if not cluster_size or total_sectors * bytes_per_sector > length:
+        return None
+    mft = start + mft_cluster * cluster_size
+
+    # $Volume (record 3): a dirty volume waits for chkdsk, its bitmap can be wrong
+    volume = _ntfs_record(f, mft + 3 * record_size, record_size)
+    information = _ntfs_attribute(volume, 0x70) if volume else None
+    if information is None or information[8]:
+        return None
+    value_offset = struct.unpack("<H", information[20:22])[0]
+    if struct.unpack("<H", information[value_offset + 10:value_offset + 12])[0] & 0x0001:
+        return None
+
+    # $LogFile (record 2): transactions still to replay can change the bitmap
+    if not _ntfs_log_clean(f, start, cluster_size, _ntfs_record(f, mft + 2 * record_size, record_size)):
+        return None
+
+    # hiberfil.sys: a hibernated Windows writes its memory back over the volume when it resumes
+    mft_record = _ntfs_record(f, mft, record_size)
+    mft_data = _ntfs_attribute(mft_record, 0x80) if mft_record else None
+    if mft_data is None or not mft_data[8]:
+        return None
+    root = _ntfs_record(f, mft + 5 * record_size, record_size)
+    if _ntfs_hibernated(f, start, cluster_size, _ntfs_runs(mft_data), record_size, root):
+        return None
+
+    # $Bitmap (record 6): one bit per cluster, in the runs of its unnamed $DATA attribute
+    bitmap_record = _ntfs_record(f, mft + 6 * record_size, record_size)
+    data = _ntfs_attribute(bitmap_record, 0x80) if bitmap_record else None
+    if data is None or not data[8] or struct.unpack("<Q", data[16:24])[0] != 0:
+        return None  # resident or split over records through an attribute list
+    data_size = struct.unpack("<Q", data[48:56])[0]
+    bitmap = _ntfs_data(f, start, cluster_size, data)
+    clusters = total_sectors // sectors_per_cluster
+    if len(bitmap) < min(data_size, clusters // 8):
+        return None
+    return _free_bytes_of_bitmap(bitmap, clusters, cluster_size, start)
+
+
+def _xfs_log_clean(f, log_offset, log_length):
+    # the newest log record must be an unmount record with the tail of the log on itself
+    blocks = log_length // sector_size
+
+    def block_data(block):
+        return _read(f, log_offset + (block % blocks) * sector_size, sector_size)
+
+    def cycle(block):
+        data = block_data(block)
+        # a record header has the cycle after its magic, every other block starts with the cycle
+        return struct.unpack(">I", data[4:8] if data[:4] == b"\xfe\xed\xba\xbe" else data[:4])[0]
+
+    # the blocks before the head have the cycle of the first block, the blocks after it one cycle less
+    first_cycle = cycle(0)
+    low, high = 1, blocks
+    while low < high:
+        middle = (low + high) // 2
+        if cycle(middle) == first_cycle:
+            low = middle + 1
+        else:
+            high = middle
+    head = low % blocks
+    for back in range(1, min(blocks, 2048) + 1):
+        header = block_data(head - back)
+        if header[:4] != b"\xfe\xed\xba\xbe":
+            continue
+        version, _, lsn, tail_lsn = struct.unpack(">IIQQ", header[8:32])
+        logops = struct.unpack(">I", header[40:44])[0]
+        header_blocks = 1
+        if version & 2:
+            header_blocks = max(1, math.ceil(struct.unpack(">I", header[320:324])[0] / 32768))
+        operation = block_data(head - back + header_blocks)
+        return logops == 1 and lsn == tail_lsn and bool(operation[9] & 0x20)
+    return False
+
+
+def xfs_free(f, start, length):
+    """Free ranges of an XFS file system from the free space by block btree of every allocation group."""
+    sb = _read(f, start, sector_size)
+    if sb[:4] != b"XFSB":
+        return None
+    block_size, data_blocks = struct.unpack(">IQ", sb[4:16])
+    log_start = struct.unpack(">Q", sb[48:56])[0]
+    ag_blocks, ag_count = struct.unpack(">II", sb[84:92])
+    log_blocks = struct.unpack(">I", sb[96:100])[0]
+    version, sector = struct.unpack(">HH", sb[100:104])
+    ag_block_log = sb[124]
+    if data_blocks * block_size > length or not log_start or sb[126]:
+        return None  # too large, an external log, or mkfs did not finish
+    log_offset = start + ((log_start >> ag_block_log) * ag_blocks + (log_start & ((1 << ag_block_log) - 1))) * block_size
+    if not _xfs_log_clean(f, log_offset, log_blocks * block_size):
+        return None
+
+    version5 = (version & 0xF) == 5
+    header_size = 56 if version5 else 16
+    leaf_magic = b"AB3B" if version5 else b"ABTB"
+    max_records = (block_size - header_size) // 12
+    free = []
+    for ag in range(ag_count):
+        ag_start = start + ag * ag_blocks * block_size
+        agf = _read(f, ag_start + sector, sector_size)
+        if agf[:4] != b"XAGF":
+            return None
+        ag_length, root = struct.unpack(">I", agf[12:16])[0], struct.unpack(">I", agf[16:20])[0]
+        levels = struct.unpack(">I", agf[28:32])[0]
+        pending = [(root, levels - 1)]
+        while pending:
+            block, level = pending.pop()
+            if block >= ag_length:
+                return None
+            node = _read(f, ag_start + block * block_size, block_size)
+            found_level, records = struct.unpack(">HH", node[4:8])
+            if node[:4] != leaf_magic or found_level != level:
+                return None
+            if level == 0:
+                for index in range(records):
+                    first, count = struct.unpack(">II", node[header_size + 8 * index:header_size + 8 * index + 8])
+                    if first + count > ag_length:
+                        return None
+                    free.append((ag_start + first * block_size, count * block_size))
+            else:
+                pointers = header_size + max_records * 8
+                pending += [(struct.unpack(">I", node[pointers + 4 * index:pointers + 4 * index + 4])[0], level - 1)
+                            for index in range(records)]
+    return free
+
+
+file_systems = (("ext", ext_free), ("xfs", xfs_free), ("ntfs", ntfs_free))
+
+
+def free_ranges(f, size):
+    """
+    The free space of every file system in the disk that can be read and is clean.
+
+    Returns:
+        tuple: (list of (offset, length), list of dicts with start, file_system and free_bytes per partition)
+    """
+    ranges = []
+    report = []
+    for start, length in partitions(f, size):
+        for name, function in file_systems:
+            try:
+                free = function(f, start, length)
+            except Exception:
+                free = None
+            if free is not None:
+                free = [(offset, count) for offset, count in free if count >= minimum_range]
+                ranges += free
+                report.append({'start': start, 'file_system': name, 'free_bytes': sum(count for _, count in free)})
+                break
+    return ranges, report
+
+
+def zero_ranges(f, ranges, progress=None):
+    """
+    Overwrite the ranges with zeros where they are not zero already.
+
+    Returns:
+        int: the bytes that were written
+    """
+    written = 0
+    for offset, length in sorted(ranges):
+        position = offset
+        while position < offset + length:
+            count = min(chunk_size, offset + length - position)
+            f.seek(position)
+            if f.read(count) != _zeros[:count]:
+                f.seek(position)
+                f.write(_zeros[:count])
+                written += count
+            position += count
+            if progress is not None:
+                progress.add(count)
+    return written
+
+
+def sparsify(path, progress=None):
+    """
+    Zero the free space of the file systems in the image at path, in place.
+
+    Args:
+        progress: optional progress_events.ProgressReporter, its total is set to the free bytes found
+
+    Returns:
+        dict: message, file_systems (see free_ranges), free_bytes and zeroed_bytes
+    """
+    disk_format = vhd_format.detect_format(path)
+    if disk_format not in ("raw", "vhd"):
+        if not shutil.which("virt-sparsify"):
+            return {'message': f"a '{disk_format}' image is only sparsified with virt-sparsify, which is not installed",
+                    'zeroed_bytes': 0}
+        completed = subprocess.run(["virt-sparsify", "--in-place", path], capture_output=True, text=True)
+        if completed.returncode != 0:
+            raise Exception(f"virt-sparsify failed: {completed.stderr}")
+        return {'message': f"the '{disk_format}' image was sparsified with virt-sparsify", 'zeroed_bytes': None}
+
+    size = os.path.getsize(path) - (vhd_format.footer_size if disk_format == "vhd" else 0)
+    with open(path, "r+b") as f:
+        ranges, report = free_ranges(f, size)
+        free = sum(length for _, length in ranges)
+        if progress is not None:
+            progress.total_bytes = free
+        zeroed = zero_ranges(f, ranges, progress)
+    return {
+        'message': f"{len(report)} file system(s) found, {zeroed} bytes of free space zeroed",
+        'file_systems': report,
+        'free_bytes': free,
+        'zeroed_bytes': zeroed
+    }
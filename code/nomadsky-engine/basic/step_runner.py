@@ -0,0 +1,204 @@
+# -------------------------------
+# Run one migration step (scripts/*.py) for the engine.
+# Two modes, chosen with general_parameters.step_runner:
+#   "subprocess": a new python process per step, fully isolated (the original way of working).
+#   "worker": the step is sent to a warm step_worker.py process that keeps the cloud SDKs imported.
+# Both modes return the same dict: {'success': True, 'output': '<json>'} or {'success': False, 'error': '...'}
+# -------------------------------
+import sys
+import os
+import json
+import queue
+import subprocess
+import threading
+from contextlib import nullcontext
+
+sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/scripts")
+import general_parameters
+
+scripts_path = os.path.join(general_parameters.code_path, "nomadsky-engine", "scripts")
+worker_path = os.path.join(general_parameters.code_path, "nomadsky-engine", "basic", "step_worker.py")
+
+
+def step_timeout(script):
+    """Seconds a step may run before it is stopped, None waits as long as it takes."""
+    return general_parameters.step_timeouts.get(script, general_parameters.step_timeout)
+
+
+def run_subprocess(script, source, destination, vmname, shared_data, unique_id):
+    script_path = os.path.join(scripts_path, script)
+    try:
+        result = subprocess.run(
+            ['python', script_path, source, destination, vmname, json.dumps(shared_data), unique_id],
+            capture_output=True,
+            text=True,
+            check=True,
+            timeout=step_timeout(script)
+        )
+        return {'success': True, 'output': result.stdout}
+    except subprocess.CalledProcessError as e:
+        return {'success': False, 'error': e.stderr}
+    except subprocess.TimeoutExpired:
+        return {'success': False, 'error': f"the step '{script}' did not finish within {step_timeout(script)} seconds"}
+
+
+class StepWorker:
+    """
+    One warm step_worker.py process. Requests are answered one at a time;
+    when the process died it is started again on the next request.
+    """
+
+    def __init__(self):
+        self.process = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        # stderr is shared with the engine, so prints of the provider code end up in the engine console
+        self.process = subprocess.Popen(
+            ['python', worker_path],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+            bufsize=1
+        )
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def run(self, script, source, destination, vmname, shared_data, unique_id):
+        request = {
+            'script': script,
+            'source': source,
+            'destination': destination,
+            'vmname': vmname,
+            'shared_data': shared_data,
+            'unique_id': unique_id
+        }
+        with self.lock:
+            if not self.alive():
+                self.start()
+            try:
+                self.process.stdin.write(json.dumps(request) + "\n")
+                self.process.stdin.flush()
+                answer = self._read_answer(step_timeout(script))
+            except (BrokenPipeError, OSError):
+                answer = ''
+            if answer is None:
+                # a hung step would keep this worker forever, the process is killed and started again on the next step
+                self.process.kill()
+                self.process.wait()
+                self.process = None
+                return {'success': False, 'error': f"the step '{script}' did not finish within {step_timeout(script)} seconds, its worker was stopped"}
+            if not answer:
+                code = self.process.poll()
+                self.process = None
+                return {'success': False, 'error': f"the step worker stopped while running '{script}' (exit code {code})"}
+            return json.loads(answer)
+
+    def _read_answer(self, timeout):
+        # the line of the answer, '' when the process stopped, None after the timeout
+        answers = queue.Queue()
+        stdout = self.process.stdout
+        threading.Thread(target=lambda: answers.put(stdout.readline()), daemon=True).start()
+        try:
+            return answers.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def stop(self):
+        with self.lock:
+            if self.alive():
+                self.process.stdin.close()
+                self.process.wait(timeout=10)
+            self.process = None
+
+
+class WorkerPool:
+    """
+    Warm step workers; every step borrows a free worker for its duration.
+    size workers are started up front, when all are busy another one is added, up to maximum (None: no limit),
+    so the steps of several migrations that run at the same time do not queue behind each other.
+    """
+
+    def __init__(self, size, maximum=None):
+        self.workers = [StepWorker() for _ in range(max(1, size))]
+        self.maximum = maximum
+        self.free = queue.Queue()
+        self.lock = threading.Lock()
+        for worker in self.workers:
+            self.free.put(worker)
+
+    def borrow(self):
+        try:
+            return self.free.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if self.maximum is None or len(self.workers) < self.maximum:
+                worker = StepWorker()  # started by its first run
+                self.workers.append(worker)
+                return worker
+        return self.free.get()
+
+    def start(self):
+        with self.lock:
+            workers = list(self.workers)
+        for worker in workers:
+            with worker.lock:
+                if not worker.alive():
+                    worker.start()
+
+    def run(self, script, source, destination, vmname, shared_data, unique_id, gate=None):
+        worker = self.borrow()
+        try:
+            # the gate (a conversion slot) is only waited for with a worker in hand, so a step that gets through
+            # it starts right away
+            with gate() if gate else nullcontext({}) as extra:
+                return worker.run(script, source, destination, vmname, dict(shared_data, **extra), unique_id)
+        finally:
+            self.free.put(worker)
+
+    def stop(self):
+        with self.lock:
+            workers = list(self.workers)
+        for worker in workers:
+            worker.stop()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def worker_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = WorkerPool(general_parameters.step_workers, general_parameters.step_workers_max)
+        return _pool
+
+
+def start_workers():
+    """Start the warm workers up front, so also the first step does not wait for the imports."""
+    if general_parameters.step_runner == "worker":
+        worker_pool().start()
+
+
+def run_step(script, source, destination, vmname, shared_data, unique_id, mode=None, gate=None):
+    """
+    Run one step script with the given mode, or the mode from general_parameters.
+
+    Args:
+        gate: optional function returning a context manager that is entered right before the step starts (after
+            a worker is borrowed) and gives a dict that is added to shared_data
+
+    Returns:
+        dict: {'success': True, 'output': '<json printed by the step>'} or {'success': False, 'error': '<stderr>'}
+    """
+    mode = mode or general_parameters.step_runner
+    if mode == "worker":
+        return worker_pool().run(script, source, destination, vmname, shared_data, unique_id, gate)
+    elif mode == "subprocess":
+        with gate() if gate else nullcontext({}) as extra:
+            return run_subprocess(script, source, destination, vmname, dict(shared_data, **extra), unique_id)
+    else:
+        raise Exception(f"unknown step runner mode: '{mode}'")
@@ -0,0 +1,94 @@
+# -------------------------------
+# Long-lived worker that runs the migration steps (scripts/*.py) as function calls.
+# The engine starts it once with "python step_worker.py" and sends one JSON request per line on stdin:
+#   {"script": "download_vm.py", "source": ..., "destination": ..., "vmname": ..., "shared_data": {...}, "unique_id": ...}
+# For every request one JSON line is written back on stdout, in the same format as /api/run-script returns:
+#   {"success": true, "output": "<json of the step result>"}  or  {"success": false, "error": "<traceback>"}
+# Cloud SDKs and provider modules stay imported between requests, so only the first step pays the import time.
+# -------------------------------
+import sys
+import os
+import json
+import importlib
+import traceback
+
+sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/scripts")
+sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/basic")
+import general_parameters
+import provider_loader
+import migration_ledger
+
+scripts_path = os.path.join(general_parameters.code_path, "nomadsky-engine", "scripts")
+
+# which platform's provider code a step uses, None when the step has no provider code
+step_platform = {
+    "fetch_vm.py": "source",
+    "prepare_source.py": "source",
+    "prepare_destination.py": "destination",
+    "precopy_vm.py": "source",
+    "stop_vm.py": "source",
+    "download_vm.py": "source",
+    "sparsify_vm.py": None,
+    "transform_vm.py": None,
+    "upload_image.py": "destination",
+    "create_network.py": "destination",
+    "start_vm.py": "destination",
+}
+
+
+def run_request(request):
+    script = request.get('script', '')
+    source = request.get('source')
+    destination = request.get('destination')
+    vmname = (request.get('vmname') or '').lower()
+    shared_data = request.get('shared_data') or {}
+    unique_id = request.get('unique_id', '')
+
+    if script not in step_platform:
+        raise Exception(f"the step '{script}' is not known by the step worker")
+
+    # the provider code reads its arguments from sys.argv, exactly like in the subprocess mode
+    script_path = os.path.join(scripts_path, script)
+    sys.argv = [script_path, source, destination, vmname, json.dumps(shared_data), unique_id]
+
+    # the step sets its own migration, nothing of the previous request carries over
+    migration_ledger.use_job(None)
+
+    platform = step_platform[script]
+    if platform == "source":
+        provider_loader.activate_provider(source)
+    elif platform == "destination":
+        provider_loader.activate_provider(destination)
+
+    step = importlib.import_module(script[:-3])
+    return step.run(source, destination, vmname, shared_data, unique_id)
+
+
+def serve():
+    # anything the steps print would corrupt the answers, so only a copy of the stdout pipe carries the protocol;
+    # fd 1 itself goes to stderr, also for the processes a step starts (qemu-img, process pools) that inherit it
+    sys.stdout.flush()
+    protocol = os.fdopen(os.dup(1), "w", buffering=1)
+    os.dup2(2, 1)
+    sys.stdout = sys.stderr
+
+    failed = provider_loader.preload()
+    for platform, modules in failed.items():
+        for module_name, reason in modules.items():
+            print(f"step worker: '{module_name}' not preloaded for {platform}: {reason}")
+
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+            result = run_request(request)
+            response = {'success': True, 'output': json.dumps(result)}
+        except Exception:
+            response = {'success': False, 'error': traceback.format_exc()}
+        protocol.write(json.dumps(response) + "\n")
+        protocol.flush()
+
+
+if __name__ == "__main__":
+    serve()
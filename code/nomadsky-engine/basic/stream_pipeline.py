@@ -0,0 +1,285 @@
+# -------------------------------
+# Streaming transfer of a disk: source reader -> optional converter -> destination uploader.
+# Every stage runs in its own thread and the stages are connected by bounded queues, so the disk flows from the
+# source cloud to the destination cloud without being staged in C:\Temp. Memory use is at most
+# general_parameters.stream_buffer_chunks chunks per queue.
+# download_vm.py uses stream_disk() when general_parameters.transfer_mode is "stream" and can_stream() finds a way
+# to convert the formats of the source and destination on the fly; otherwise the staged steps run as before.
+# -------------------------------
+import sys
+import time
+import hashlib
+import queue
+import importlib
+import threading
+
+import requests
+
+sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/scripts")
+sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/basic")
+import general_parameters
+import provider_loader
+import progress_events
+import ranged_download
+import vhd_format
+import integrity
+
+chunk_size = 4 * 1024 * 1024  # 4 MiB, the largest page an Azure page blob accepts in one call
+
+# the provider functions that open a source disk and upload a destination disk as a stream
+source_readers = {
+    "azure": ("downloading_vm", "open_disk_source"),
+    "cyso": ("downloading_vm", "open_image_source"),
+    "leaf": ("downloading_vm", "open_image_source"),
+}
+destination_writers = {
+    "azure": ("upload_disk", "upload_stream"),
+    "cyso": ("upload_disk", "uploading_stream"),
+    "leaf": ("upload_disk", "uploading_stream"),
+}
+
+
+# -------------------------------
+# reading
+# -------------------------------
+remote_size = ranged_download.remote_size
+
+
+def http_chunks(url, size, headers=None, start=0, max_retries=200, retry_wait=10):
+    """
+    Read bytes start..size of the url with ranged GETs, in chunks of chunk_size.
+    A broken connection continues at the current position, like the staged downloads do.
+    """
+    position = start
+    while position < size:
+        request_headers = ranged_download.request_headers(headers)
+        request_headers["Range"] = f"bytes={position}-{size - 1}"
+        try:
+            with requests.get(url, headers=request_headers, stream=True, timeout=60) as response:
+                response.raise_for_status()
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    if chunk:
+                        position += len(chunk)
+                        yield chunk
+        except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError):
+            max_retries -= 1
+            if max_retries <= 0:
+                raise Exception("Max retries exceeded")
+            time.sleep(retry_wait)
+    if position != size:
+        raise Exception(f"the source returned {position} bytes instead of {size}")
+
+
+class ChunkReader:
+    """
+    File object over a chunk iterator, for SDK uploads that call read(size).
+    """
+
+    def __init__(self, chunks, size=None):
+        self.chunks = iter(chunks)
+        self.size = size
+        self.buffer = b""
+        self.position = 0
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buffer += chunk
+        if size < 0:
+            data, self.buffer = self.buffer, b""
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        self.position += len(data)
+        return data
+
+    def tell(self):
+        return self.position
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        while True:
+            data = self.read(chunk_size)
+            if not data:
+                return
+            yield data
+
+
+def aligned_chunks(chunks, size):
+    """Regroup chunks into blocks of exactly size bytes, only the last one can be shorter."""
+    buffer = b""
+    for chunk in chunks:
+        buffer += chunk
+        while len(buffer) >= size:
+            yield buffer[:size]
+            buffer = buffer[size:]
+    if buffer:
+        yield buffer
+
+
+# -------------------------------
+# the pipeline
+# -------------------------------
+_end = object()
+
+
+class _Failure:
+    def __init__(self, error):
+        self.error = error
+
+
+def _pump(chunks, buffer, stop):
+    # runs one stage in its own thread and hands its chunks to the next stage
+    def put(item):
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    try:
+        for chunk in chunks:
+            if not put(chunk):
+                return
+        put(_end)
+    except BaseException as error:
+        put(_Failure(error))
+
+
+def _drain(buffer):
+    while True:
+        item = buffer.get()
+        if item is _end:
+            return
+        if isinstance(item, _Failure):
+            raise item.error
+        yield item
+
+
+def run_pipeline(chunks, sink, converter=None, buffer_chunks=None):
+    """
+    Connect a reader, an optional converter and a sink with bounded queues.
+
+    Args:
+        chunks: iterator with the bytes of the source
+        sink: function that consumes an iterator of chunks, its return value is returned
+        converter: function from an iterator of chunks to an iterator of chunks, None for a pure relay
+        buffer_chunks: chunks a queue holds before the stage in front of it waits
+
+    Returns:
+        the result of the sink
+    """
+    buffer_chunks = buffer_chunks or general_parameters.stream_buffer_chunks
+    stop = threading.Event()
+    threads = []
+
+    def stage(stage_chunks):
+        buffer = queue.Queue(maxsize=buffer_chunks)
+        thread = threading.Thread(target=_pump, args=(stage_chunks, buffer, stop), daemon=True)
+        thread.start()
+        threads.append(thread)
+        return _drain(buffer)
+
+    stream = stage(chunks)
+    if converter is not None:
+        stream = stage(converter(stream))
+    try:
+        return sink(stream)
+    finally:
+        # a failing sink must not leave the reader waiting on a full queue
+        stop.set()
+        for thread in threads:
+            thread.join(timeout=5)
+
+
+# -------------------------------
+# streaming a disk from the source cloud to the destination cloud
+# -------------------------------
+def stream_plan(source_format, destination):
+    """
+    How a disk of source_format reaches the destination as a stream.
+
+    Returns:
+        tuple: (converter or None, format of the uploaded disk, size function), or None when it can only be staged
+    """
+    imports = general_parameters.preferred_type[destination]["import"]
+    if source_format in imports:
+        return None, source_format, lambda size: size
+    if source_format == "vhd" and "raw" in imports:
+        return vhd_format.vhd_to_raw, "raw", lambda size: size - vhd_format.footer_size
+    if source_format == "raw" and "vhd" in imports:
+        return vhd_format.raw_to_vhd, "vhd", lambda size: vhd_format.aligned_size(size) + vhd_format.footer_size
+    return None
+
+
+def can_stream(source, destination, exportdisktype):
+    return source in source_readers and destination in destination_writers \
+        and stream_plan(exportdisktype, destination) is not None
+
+
+def _provider_function(platform, functions):
+    module_name, function_name = functions[platform]
+    provider_loader.activate_provider(platform)
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+def stream_disk(source, destination, vmname, shared_data):
+    """
+    Stream the OS disk from the source to the destination.
+
+    Returns:
+        dict: the result of the destination upload, with 'streamed': True, the formats of the stream, the tree hash
+        root of the uploaded bytes and the source checksums that matched
+    """
+    disk = _provider_function(source, source_readers)(shared_data)
+    plan = stream_plan(disk['disktype'], destination)
+    if plan is None:
+        raise Exception(f"a '{disk['disktype']}' disk from '{source}' can not be streamed to '{destination}'")
+    converter, disktype, target_size = plan
+    size = target_size(disk['size'])
+
+    upload = _provider_function(destination, destination_writers)
+    progress = progress_events.ProgressReporter(total_bytes=size, action="stream")
+
+    # the uploaded bytes go through a tree hash, the source bytes through the checksum the source publishes
+    tree = integrity.TreeHash(size)
+    checksums = disk.get('checksums') or {}
+    source_hashes = {name: hashlib.new(name) for name in checksums}
+
+    def counted(chunks):
+        position = 0
+        for chunk in chunks:
+            progress.add(len(chunk))
+            tree.update(position, chunk)
+            position += len(chunk)
+            yield chunk
+
+    def hashed(chunks):
+        for chunk in chunks:
+            for hasher in source_hashes.values():
+                hasher.update(chunk)
+            yield chunk
+
+    chunks = hashed(http_chunks(disk['url'], disk['size'], headers=disk.get('headers')))
+    if converter is None:
+        convert = None
+    else:
+        convert = lambda stream: converter(stream, disk['size'])
+    result = run_pipeline(chunks, lambda stream: upload(shared_data, counted(stream), size, disktype), convert)
+    progress.done()
+    verified = integrity.compare({name: hasher.hexdigest() for name, hasher in source_hashes.items()}, checksums)
+
+    result.update({
+        'message': f"VM '{vmname}' streamed from '{source}' to '{destination}' as {disktype}!",
+        'streamed': True,
+        'exportdisktype': disk['disktype'],
+        'importdisktype': disktype,
+        'integrity_root': tree.finish()['root'],
+        'verified': result.get('verified', []) + [f"source {name}" for name in verified]
+    })
+    return result
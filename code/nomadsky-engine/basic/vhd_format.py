@@ -0,0 +1,183 @@
+# -------------------------------
+# The 512 byte footer of a fixed VHD.
+# A fixed VHD is the raw disk followed by this footer, so a raw disk becomes a VHD by appending the footer
+# and a VHD becomes raw by leaving it off. That is what lets the streaming mode convert between the two on the fly.
+# Layout and geometry follow the Microsoft "Virtual Hard Disk Image Format Specification".
+# -------------------------------
+import os
+import struct
+import time
+import uuid
+
+footer_size = 512
+vhd_epoch = 946684800  # 2000-01-01 00:00:00 UTC, the VHD timestamps count from here
+mib = 1024 * 1024
+
+# cookie, features, version, data offset, timestamp, creator application, creator version, creator host os,
+# original size, current size, geometry (cylinders, heads, sectors), disk type, checksum, unique id, saved state
+_layout = ">8sIIQI4sI4sQQHBBII16sB427x"
+
+
+def _checksum(footer):
+    # one's complement of the sum of all bytes, the checksum field itself counted as zero
+    data = footer[:64] + b"\0\0\0\0" + footer[68:]
+    return ~sum(data) & 0xFFFFFFFF
+
+
+def _geometry(size):
+    # CHS geometry from the specification, Azure checks it against the size
+    sectors = min(size // 512, 65535 * 16 * 255)
+    if sectors >= 65535 * 16 * 63:
+        sectors_per_track = 255
+        heads = 16
+        cylinder_times_heads = sectors // sectors_per_track
+    else:
+        sectors_per_track = 17
+        cylinder_times_heads = sectors // sectors_per_track
+        heads = max((cylinder_times_heads + 1023) // 1024, 4)
+        if cylinder_times_heads >= heads * 1024 or heads > 16:
+            sectors_per_track = 31
+            heads = 16
+            cylinder_times_heads = sectors // sectors_per_track
+        if cylinder_times_heads >= heads * 1024:
+            sectors_per_track = 63
+            heads = 16
+            cylinder_times_heads = sectors // sectors_per_track
+    return cylinder_times_heads // heads, heads, sectors_per_track
+
+
+def build_footer(size, unique_id=None):
+    """
+    Footer of a fixed VHD with a raw disk of the given size in bytes.
+
+    Returns:
+        bytes: the 512 byte footer
+    """
+    cylinders, heads, sectors = _geometry(size)
+    footer = struct.pack(
+        _layout,
+        b"conectix", 2, 0x00010000, 0xFFFFFFFFFFFFFFFF, int(time.time()) - vhd_epoch,
+        b"nmsk", 0x00010000, b"Wi2k", size, size, cylinders, heads, sectors, 2, 0,
+        (unique_id or uuid.uuid4()).bytes, 0
+    )
+    return footer[:64] + struct.pack(">I", _checksum(footer)) + footer[68:]
+
+
+def parse_footer(footer):
+    """
+    Read a VHD footer.
+
+    Returns:
+        dict: current_size, disk_type (2 fixed, 3 dynamic, 4 differencing) and whether the checksum is valid,
+        or None when the data is not a VHD footer
+    """
+    if len(footer) < footer_size or footer[:8] != b"conectix":
+        return None
+    values = struct.unpack(_layout, footer[:footer_size])
+    return {
+        'original_size': values[8],
+        'current_size': values[9],
+        'disk_type': values[13],
+        'checksum_valid': values[14] == _checksum(footer[:footer_size])
+    }
+
+
+def aligned_size(size, alignment=mib):
+    """Azure only accepts VHDs with a virtual size of whole MiB."""
+    return -(-size // alignment) * alignment
+
+
+def raw_to_vhd(chunks, size):
+    """
+    Turn the chunks of a raw disk of the given size into the chunks of a fixed VHD:
+    the disk padded with zeros to whole MiB and the footer appended.
+    """
+    target = aligned_size(size)
+    for chunk in chunks:
+        yield chunk
+    padding = target - size
+    while padding > 0:
+        count = min(padding, mib)
+        yield b"\0" * count
+        padding -= count
+    yield build_footer(target)
+
+
+def vhd_to_raw(chunks, size):
+    """Turn the chunks of a fixed VHD of the given size (footer included) into the chunks of the raw disk."""
+    remaining = size - footer_size
+    for chunk in chunks:
+        if remaining <= 0:
+            continue  # the footer
+        if len(chunk) > remaining:
+            chunk = chunk[:remaining]
+        remaining -= len(chunk)
+        yield chunk
+
+
+# -------------------------------
+# files on disk
+# -------------------------------
+def detect_format(path):
+    """
+    The format of an image from its magic bytes, whatever its name or label says.
+
+    Returns:
+        str: "qcow2", "vmdk", "vhdx", "vhd" (fixed), "vpc" (dynamic or differencing VHD) or "raw"
+    """
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        header = f.read(footer_size)
+        if header[:4] == b"QFI\xfb":
+            return "qcow2"
+        if header[:4] == b"KDMV" or header.startswith(b"# Disk DescriptorFile"):
+            return "vmdk"
+        if header[:8] == b"vhdxfile":
+            return "vhdx"
+        if header[:8] == b"conectix":
+            return "vpc"  # a dynamic VHD starts with a copy of its footer
+        if size >= footer_size:
+            f.seek(size - footer_size)
+            footer = parse_footer(f.read(footer_size))
+            if footer and footer['disk_type'] == 2 and footer['current_size'] == size - footer_size:
+                return "vhd"
+    return "raw"
+
+
+def raw_to_vhd_in_place(path):
+    """
+    Make the raw image at path a fixed VHD without copying it: extend it to whole MiB and append the footer.
+    A fixed VHD that is not whole MiB is realigned the same way, one that is whole MiB is left as it is.
+
+    Returns:
+        tuple: (the virtual size of the VHD, True when the file was changed)
+    """
+    if detect_format(path) == "vhd":
+        size = os.path.getsize(path) - footer_size
+        if size == aligned_size(size):
+            return size, False
+        os.truncate(path, size)
+    size = os.path.getsize(path)
+    target = aligned_size(size)
+    with open(path, "r+b") as f:
+        f.truncate(target)  # the padding reads as zeros
+        f.seek(target)
+        f.write(build_footer(target))
+    return target, True
+
+
+def vhd_to_raw_in_place(path):
+    """
+    Make the fixed VHD at path a raw image by cutting off its footer.
+
+    Returns:
+        tuple: (the size of the raw image, True when the file was changed)
+
+    Raises:
+        Exception: If path is not a fixed VHD
+    """
+    if detect_format(path) != "vhd":
+        raise Exception(f"'{path}' is not a fixed VHD")
+    size = os.path.getsize(path) - footer_size
+    os.truncate(path, size)
+    return size, True
@@ -0,0 +1,189 @@
+# -------------------------------
+# Decoder of streamOptimized VMDK images, the format of a GCP image export (disk_image_format="vmdk").
+# Such an image is a stream of grains (64 KiB of the disk by default), each deflate compressed behind a marker with
+# its position on the disk, with grain tables in between. grains() reads the markers in one pass without seeking,
+# so it also works on a download that is still coming in. The grains are inflated in batches on a process pool,
+# one process per core, and extents() gives the raw data back in the order of the stream, so the next stage
+# (a sparse raw file, a page blob upload) gets its extents in order while all cores decompress.
+# The decoder can be sized with general_parameters.vmdk_decode_processes, None uses every core.
+# Layout from the VMware "Virtual Disk Format 5.0" specification.
+# -------------------------------
+import sys
+import os
+import zlib
+import struct
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/scripts")
+sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/basic")
+import general_parameters
+import ranged_download
+
+sector_size = 512
+magic = b"KDMV"
+batch_bytes = 4 * 1024 * 1024  # compressed bytes per task of the process pool, a task per grain costs more than it saves
+
+# magic, version, flags, capacity, grain size, descriptor offset, descriptor size, grain table entries,
+# redundant grain directory, grain directory, overhead (all in sectors), unclean shutdown, line end check, compression
+_header = "<4sIIQQQQIQQQB4sH"
+_compressed_grains = 1 << 16
+_markers = 1 << 17
+_deflate = 1
+
+_end_of_stream, _grain_table, _grain_directory, _footer = 0, 1, 2, 3
+
+
+def read_header(fileobj):
+    """
+    The sparse extent header at the start of the image.
+
+    Returns:
+        dict: capacity (bytes), grain_size (bytes), overhead (bytes), flags and compression
+
+    Raises:
+        Exception: If the data is no sparse VMDK extent
+    """
+    data = fileobj.read(sector_size)
+    if data[:4] != magic:
+        raise Exception("the image is not a sparse VMDK extent")
+    values = struct.unpack(_header, data[:struct.calcsize(_header)])
+    return {
+        'version': values[1],
+        'flags': values[2],
+        'capacity': values[3] * sector_size,
+        'grain_size': values[4] * sector_size,
+        'overhead': values[10] * sector_size,
+        'compression': values[13]
+    }
+
+
+def is_stream_optimized(path):
+    """True when path is a VMDK with compressed grains behind markers, the kind grains() decodes."""
+    try:
+        with open(path, "rb") as f:
+            header = read_header(f)
+    except Exception:
+        return False
+    return header['flags'] & _compressed_grains and header['flags'] & _markers and header['compression'] == _deflate
+
+
+def _read_exactly(fileobj, length):
+    data = fileobj.read(length)
+    while len(data) < length:
+        more = fileobj.read(length - len(data))
+        if not more:
+            raise Exception("the VMDK stream ends in the middle of a grain")
+        data += more
+    return data
+
+
+def grains(fileobj, header=None):
+    """
+    Read the compressed grains of a streamOptimized VMDK in one pass, fileobj is positioned after the header.
+
+    Returns:
+        iterator of (offset on the disk in bytes, compressed data)
+    """
+    header = header or read_header(fileobj)
+    _read_exactly(fileobj, header['overhead'] - sector_size)  # descriptor and the rest of the overhead
+    while True:
+        sector = fileobj.read(sector_size)
+        if len(sector) < sector_size:
+            return  # a stream without end-of-stream marker ends with the file
+        value, size = struct.unpack("<QI", sector[:12])
+        if size:
+            # a grain marker: the sector of the disk, then the compressed grain padded to whole sectors
+            padded = -(-(12 + size) // sector_size) * sector_size
+            data = sector[12:] + _read_exactly(fileobj, padded - sector_size)
+            yield value * sector_size, data[:size]
+            continue
+        marker_type = struct.unpack("<I", sector[12:16])[0]
+        if marker_type == _end_of_stream:
+            return
+        # a grain table, the grain directory or the footer: value sectors of metadata the grains do not need
+        _read_exactly(fileobj, value * sector_size)
+
+
+def _inflate(batch):
+    # runs in a pool process
+    return [(offset, zlib.decompress(data)) for offset, data in batch]
+
+
+def _batches(grains):
+    batch = []
+    size = 0
+    for offset, data in grains:
+        batch.append((offset, data))
+        size += len(data)
+        if size >= batch_bytes:
+            yield batch
+            batch = []
+            size = 0
+    if batch:
+        yield batch
+
+
+def extents(fileobj, processes=None):
+    """
+    The raw data of a streamOptimized VMDK, inflated on a process pool and given back in the order of the stream.
+    Grains next to each other on the disk are joined into one extent per batch.
+
+    Args:
+        processes: processes of the pool, default general_parameters.vmdk_decode_processes or every core
+
+    Returns:
+        iterator of (offset on the disk in bytes, data)
+    """
+    header = read_header(fileobj)
+    capacity = header['capacity']
+    processes = processes or getattr(general_parameters, 'vmdk_decode_processes', None) or os.cpu_count() or 1
+    pending = deque()
+
+    def joined(batch):
+        start, parts, end = None, [], None
+        for offset, data in batch:
+            data = data[:max(0, capacity - offset)]
+            if parts and offset != end:
+                yield start, b"".join(parts)
+                parts = []
+            if not parts:
+                start = offset
+            parts.append(data)
+            end = offset + len(data)
+        if parts:
+            yield start, b"".join(parts)
+
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        # two batches per process in flight, so the reading and the pool keep each other busy with bounded memory
+        for batch in _batches(grains(fileobj, header)):
+            pending.append(pool.submit(_inflate, batch))
+            if len(pending) >= processes * 2:
+                yield from joined(pending.popleft().result())
+        while pending:
+            yield from joined(pending.popleft().result())
+
+
+def to_raw(path, output_path, processes=None, progress=None):
+    """
+    Write a streamOptimized VMDK as a sparse raw image, only the grains in the stream are written.
+
+    Args:
+        progress: optional progress_events.ProgressReporter, counts the bytes of the VMDK read
+
+    Returns:
+        int: the size of the raw image
+    """
+    with open(path, "rb") as f:
+        capacity = read_header(f)['capacity']
+        f.seek(0)
+        open(output_path, "wb").close()
+        ranged_download.make_sparse(output_path)
+        os.truncate(output_path, capacity)
+        with open(output_path, "r+b") as output:
+            for offset, data in extents(f, processes):
+                output.seek(offset)
+                output.write(data)
+                if progress is not None:
+                    progress.update(f.tell())
+    return capacity
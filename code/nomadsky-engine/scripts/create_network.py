@@ -5,63 +5,70 @@ from opencensus.ext.azure.log_exporter import AzureLogHandler
 import logging
 
 
-# Get arguments
-source = sys.argv[1]
-destination = sys.argv[2]
-vmname = sys.argv[3].lower()
-shareddata_json = sys.argv[4]
-shared_data = json.loads(shareddata_json)
-unique_id = sys.argv[5]
-
-
-if destination == 'azure':
-      # Azure SDK code to find VM
-      sys.path.append(r"C:/projects/digitalnomadsky/code/Microsoft")
-      import config
-      from create_networking import create_network
-          
-      try:
-            nic = create_network(shared_data)
-            result = {
-             'message': f"the vnet and nic are succesfully created in '{destination}'!",
-             'nic_id' : nic
-             }
-            print(json.dumps(result))
-      except IndexError:
-        raise Exception(f" the vnet and/nic are not created.")
-
-elif destination == 'cyso':
-         result = {
-             'message': "no need to create anything"  }
-         print(json.dumps(result))
-elif destination == 'leaf':
-         result = {
-             'message': "no need to create anything"  }
-         print(json.dumps(result))
-
-
-elif destination == 'aws':
-   a='empty'
-   #     # AWS boto3 code to find VM
-   # etc.
-
-
-# Setup logger
-logger = logging.getLogger(__name__)
-logger.addHandler(AzureLogHandler(connection_string="InstrumentationKey=bde21699-fbec-4be5-93ce-ee81109b211f"))
-logger.setLevel(logging.INFO)
-
-# Prepare JSON data
-times = datetime.now(timezone.utc)
-data = {
-    "unique_id": unique_id,
-    "step": "create-network",
-    "time": times,
-    "message": f"VM network created in '{destination}'"
-}
-
-# Send as custom log
-logger.info(data)
+def run(source, destination, vmname, shared_data, unique_id):
+    if destination == 'azure':
+          # Azure SDK code to find VM
+          sys.path.append(r"C:/projects/digitalnomadsky/code/Microsoft")
+          import config
+          from create_networking import create_network
+
+          try:
+                nic = create_network(shared_data)
+                result = {
+                 'message': f"the vnet and nic are succesfully created in '{destination}'!",
+                 'nic_id' : nic
+                 }
+          except IndexError:
+            raise Exception(f" the vnet and/nic are not created.")
+
+    elif destination == 'cyso':
+             result = {
+                 'message': "no need to create anything"  }
+    elif destination == 'leaf':
+             result = {
+                 'message': "no need to create anything"  }
+
+
+    elif destination == 'aws':
+       a='empty'
+       #     # AWS boto3 code to find VM
+       # etc.
+       raise Exception(f"{destination} is not yet supported")
+    else:
+       raise Exception(f"{destination} is not yet supported")
+
+
+    # Setup logger
+    logger = logging.getLogger(__name__)
+    if not logger.handlers:
+        logger.addHandler(AzureLogHandler(connection_string="InstrumentationKey=bde21699-fbec-4be5-93ce-ee81109b211f"))
+    logger.setLevel(logging.INFO)
+
+    # Prepare JSON data
+    times = datetime.now(timezone.utc)
+    data = {
+        "unique_id": unique_id,
+        "step": "create-network",
+        "time": times,
+        "message": f"VM network created in '{destination}'"
+    }
+
+    # Send as custom log
+    logger.info(data)
+    return result
+
+
+if __name__ == "__main__":
+    # Get arguments
+    source = sys.argv[1]
+    destination = sys.argv[2]
+    vmname = sys.argv[3].lower()
+    shareddata_json = sys.argv[4]
+    shared_data = json.loads(shareddata_json)
+    unique_id = sys.argv[5]
+
+    result = run(source, destination, vmname, shared_data, unique_id)
+    print(json.dumps(result))
 
 
 #from helpers import my_function
@@ -1,92 +1,136 @@
 import sys
+import os
 import json
 from datetime import datetime, timezone
 from opencensus.ext.azure.log_exporter import AzureLogHandler
 import logging
 
+sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/scripts")
+sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/basic")
+import general_parameters
+import stream_pipeline
+import block_store
+import artifact_cache
+import migration_ledger
 
-# Get arguments
-source = sys.argv[1]
-destination = sys.argv[2]
-vmname = sys.argv[3].lower()
-shareddata_json = sys.argv[4]
-shared_data = json.loads(shareddata_json)
-unique_id = sys.argv[5]
-
-if source == 'azure':
-      # Azure SDK code to find VM
-      sys.path.append(r"C:/projects/digitalnomadsky/code/Microsoft")
-      import config
-      from downloading_vm import download_vm
-      try:
-            result = download_vm(shared_data)
-            print(json.dumps(result))
-      except IndexError:
-        raise Exception(f" VM could not be downloaded: '{shared_data}' ")
-
-elif source == 'cyso':
-      # cyso SDK code to find VM
-      sys.path.append(r"C:/projects/digitalnomadsky/code/Cyso")
-      import config
-      from downloading_vm import export_os_disk
-      try:
-            result = export_os_disk(vmname)
-            print(json.dumps(result))
-      except IndexError:
-        raise Exception(f" VM could not be downloaded: '{shared_data}' ")
-
-elif source == 'leaf':
-      # leaf SDK code to find VM
-      sys.path.append(r"C:/projects/digitalnomadsky/code/Leafcloud")
-      import config
-      from downloading_vm import export_os_disk
-      try:
-            result = export_os_disk(vmname)
-            print(json.dumps(result))
-      except IndexError:
-        raise Exception(f" VM could not be downloaded: '{shared_data}' ")
-
-elif source == 'aws':
-      # AWS SDK code to download VM
-      sys.path.append(r"C:/projects/digitalnomadsky/code/Amazon")
-      import config
-      from downloading_vm import  download_aws_osdisk
-      try:
-            result =  download_aws_osdisk(shared_data)
-            print(json.dumps(result))
-      except IndexError:
-        raise Exception(f" VM could not be downloaded: '{shared_data}' ")
-elif source == 'huawei':
-      # huawei SDK code to download VM
-      sys.path.append(r"C:/projects/digitalnomadsky/code/Huawei")
-      import config
-      from downloading_image import  download_huawei_vm
-      try:
-            result =  download_huawei_vm(shared_data)
-            print(json.dumps(result))
-      except IndexError:
-        raise Exception(f" VM could not be downloaded: '{shared_data}' ")
-
-else:
-        raise Exception(f" the source platform is not yet supported")
-      
-
-# Setup logger
-logger = logging.getLogger(__name__)
-logger.addHandler(AzureLogHandler(connection_string="InstrumentationKey=bde21699-fbec-4be5-93ce-ee81109b211f"))
-logger.setLevel(logging.INFO)
-
-# Prepare JSON data
-times = datetime.now(timezone.utc)
-data = {
-    "unique_id": unique_id,
-    "step": "download-vm",
-    "time": times,
-    "message": f"VM downloaded from '{source}'"
-}
-
-# Send as custom log
-logger.info(data)
+
+def run(source, destination, vmname, shared_data, unique_id):
+    migration_ledger.use_job(shared_data.get('job_id') or unique_id)
+    exportdisktype = shared_data.get('exportdisktype', '')
+    resource_id = shared_data.get('resource_id', '')
+    # a warm copy (in shared_data or in the ledger of a resumed migration) still has the delta after the stop to sync
+    precopied = artifact_cache.precopy_pending(shared_data)
+    cached_path = None
+    if not precopied:
+          # the same disk of this VM downloaded by an earlier run, checked on size and integrity manifest
+          cached_path = artifact_cache.lookup(source, vmname, resource_id, exportdisktype)
+    if not cached_path:
+          # make room on the staging disk before the download starts, not halfway through it
+          artifact_cache.reserve(artifact_cache.expected_bytes(shared_data), r"C:\Temp\osdisk")
+
+    if cached_path:
+          result = {
+              'message': f"VM '{vmname}' OS disk found in the download cache!",
+              'output_path': cached_path,
+              'cached': True
+              }
+
+    elif general_parameters.transfer_mode == "stream" and not precopied \
+            and stream_pipeline.can_stream(source, destination, exportdisktype):
+          # the disk goes straight to the destination, transform and upload have nothing left to do
+          result = stream_pipeline.stream_disk(source, destination, vmname, shared_data)
+
+    elif source == 'azure':
+          # Azure SDK code to find VM
+          sys.path.append(r"C:/projects/digitalnomadsky/code/Microsoft")
+          import config
+          from downloading_vm import download_vm
+          try:
+                result = download_vm(shared_data)
+          except IndexError:
+            raise Exception(f" VM could not be downloaded: '{shared_data}' ")
+
+    elif source == 'cyso':
+          # cyso SDK code to find VM
+          sys.path.append(r"C:/projects/digitalnomadsky/code/Cyso")
+          import config
+          from downloading_vm import export_os_disk
+          try:
+                result = export_os_disk(vmname)
+          except IndexError:
+            raise Exception(f" VM could not be downloaded: '{shared_data}' ")
+
+    elif source == 'leaf':
+          # leaf SDK code to find VM
+          sys.path.append(r"C:/projects/digitalnomadsky/code/Leafcloud")
+          import config
+          from downloading_vm import export_os_disk
+          try:
+                result = export_os_disk(vmname)
+          except IndexError:
+            raise Exception(f" VM could not be downloaded: '{shared_data}' ")
+
+    elif source == 'aws':
+          # AWS SDK code to download VM
+          sys.path.append(r"C:/projects/digitalnomadsky/code/Amazon")
+          import config
+          from downloading_vm import  download_aws_osdisk
+          try:
+                result =  download_aws_osdisk(shared_data)
+          except IndexError:
+            raise Exception(f" VM could not be downloaded: '{shared_data}' ")
+    elif source == 'huawei':
+          # huawei SDK code to download VM
+          sys.path.append(r"C:/projects/digitalnomadsky/code/Huawei")
+          import config
+          from downloading_image import  download_huawei_vm
+          try:
+                result =  download_huawei_vm(shared_data)
+          except IndexError:
+            raise Exception(f" VM could not be downloaded: '{shared_data}' ")
+
+    else:
+            raise Exception(f" the source platform is not yet supported")
+
+    if not result.get('cached') and os.path.exists(result.get('output_path', '')):
+          artifact_cache.register(result['output_path'], source, vmname, resource_id, exportdisktype)
+
+    if block_store.enabled() and not result.get('cached') and not result.get('streamed') \
+            and os.path.exists(result.get('output_path', '')):
+          # the disk is kept as blocks, the blocks a sibling VM already brought in take no extra space
+          result.update(block_store.store_image(result['output_path']))
+
+    # Setup logger
+    logger = logging.getLogger(__name__)
+    if not logger.handlers:
+        logger.addHandler(AzureLogHandler(connection_string="InstrumentationKey=bde21699-fbec-4be5-93ce-ee81109b211f"))
+    logger.setLevel(logging.INFO)
+
+    # Prepare JSON data
+    times = datetime.now(timezone.utc)
+    data = {
+        "unique_id": unique_id,
+        "step": "download-vm",
+        "time": times,
+        "message": f"VM downloaded from '{source}'"
+    }
+
+    # Send as custom log
+    logger.info(data)
+    return result
+
+
+if __name__ == "__main__":
+    # Get arguments
+    source = sys.argv[1]
+    destination = sys.argv[2]
+    vmname = sys.argv[3].lower()
+    shareddata_json = sys.argv[4]
+    shared_data = json.loads(shareddata_json)
+    unique_id = sys.argv[5]
+
+    result = run(source, destination, vmname, shared_data, unique_id)
+    print(json.dumps(result))
 
 
 #from helpers import my_function
@@ -5,109 +5,114 @@ from datetime import datetime, timezone
 from opencensus.ext.azure.log_exporter import AzureLogHandler
 import logging
 
-# Get arguments
-source = sys.argv[1]
-destination = sys.argv[2]
-vmname = sys.argv[3].lower()
-unique_id = sys.argv[5]
-
-
-if source == 'azure':
-      # Azure SDK code to find VM
-      sys.path.append(r"C:/projects/digitalnomadsky/code/Microsoft")
-      import config
-      from fetching_vm import fetch_vm
-          
-      try:
-            result = fetch_vm(vmname)
-      except IndexError:
-        raise Exception('something went wrong, the vm is not found in Azure!')   
-
-elif source == 'cyso':
-      # cyso openstack SDK code to find VM
-      sys.path.append(r"C:/projects/digitalnomadsky/code/Cyso")
-      import config
-      from fetching_vm import fetch_vm
-      try:
-            result = fetch_vm(vmname)
-      except IndexError:
-        raise Exception('something went wrong, the vm is not found in Cyso Cloud!')  
-
-elif source == 'leaf':
-      # leaf openstack SDK code to find VM
-      sys.path.append(r"C:/projects/digitalnomadsky/code/Leafcloud")
-      import config
-      from fetching_vm import fetch_vm
-      try:
-            result = fetch_vm(vmname)
-      except IndexError:
-        raise Exception('something went wrong, the vm is not found in Leaf.Cloud!')  
-
-elif source == 'aws':
-      # Amazon SDK code to find VM
-      sys.path.append(r"C:/projects/digitalnomadsky/code/Amazon")
-      import config
-      from fetching_vm import search_ec2_instance
-          
-      try:
-            result = search_ec2_instance(vmname)
-      except IndexError:
-        raise Exception('something went wrong, the vm is not found in AWS!')  
-
-elif source == 'huawei':
-      # huawei SDK code to find VM
-      sys.path.append(r"C:/projects/digitalnomadsky/code/Huawei")
-      import config
-      from fetching_vm import search_huawei_vm
-          
-      try:
-            result = search_huawei_vm(vmname)
-      except IndexError:
-        raise Exception('something went wrong, the vm is not found in Huawei Cloud!')  
-else:
-      raise Exception('something went wrong, the source cloud platform is not supported!')  
+sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/scripts")
+sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/basic")
+import artifact_cache
+import format_planner
 
 
 # -----
 #Find optimal disktypeformat
 # ------
 
-sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/scripts")
-import general_parameters 
-
-def find_best_format(source_platform, destination_platform):
-    source_exports = general_parameters.preferred_type[source_platform]["export"]
-    destination_imports = general_parameters.preferred_type[destination_platform]["import"]
-
-    # Try to find a matching format
-    for fmt in source_exports:
-        if fmt in destination_imports:
-            return fmt, fmt
-    # Fallback: first export + first impor
-    return source_exports[0], destination_imports[0]
-    
-exportdisktype,importdisktype = find_best_format(source,destination)
-result["exportdisktype"]= exportdisktype
-result["importdisktype"]= importdisktype 
-print(json.dumps(result)) 
-
-#---------------------
-#logs for research purpose
-#----------------------
-# Setup logger
-logger = logging.getLogger(__name__)
-logger.addHandler(AzureLogHandler(connection_string="InstrumentationKey=bde21699-fbec-4be5-93ce-ee81109b211f"))
-logger.setLevel(logging.INFO)
-
-# Prepare JSON data
-data = {
-    "unique_id": unique_id,
-    "step": "fetch-vm",
-    "message": f"VM found in '{source}'"
-}
-
-# Send as custom log
-logger.info(data)
+def find_best_format(source_platform, destination_platform, disk_size=0):
+    # the cheapest chain of download, conversions and upload, see format_planner
+    plan = format_planner.plan(source_platform, destination_platform, disk_size)
+    return plan['export'], plan['import'], plan
+
+
+def run(source, destination, vmname, shared_data, unique_id):
+    if source == 'azure':
+          # Azure SDK code to find VM
+          sys.path.append(r"C:/projects/digitalnomadsky/code/Microsoft")
+          import config
+          from fetching_vm import fetch_vm
+
+          try:
+                result = fetch_vm(vmname)
+          except IndexError:
+            raise Exception('something went wrong, the vm is not found in Azure!')
+
+    elif source == 'cyso':
+          # cyso openstack SDK code to find VM
+          sys.path.append(r"C:/projects/digitalnomadsky/code/Cyso")
+          import config
+          from fetching_vm import fetch_vm
+          try:
+                result = fetch_vm(vmname)
+          except IndexError:
+            raise Exception('something went wrong, the vm is not found in Cyso Cloud!')
+
+    elif source == 'leaf':
+          # leaf openstack SDK code to find VM
+          sys.path.append(r"C:/projects/digitalnomadsky/code/Leafcloud")
+          import config
+          from fetching_vm import fetch_vm
+          try:
+                result = fetch_vm(vmname)
+          except IndexError:
+            raise Exception('something went wrong, the vm is not found in Leaf.Cloud!')
+
+    elif source == 'aws':
+          # Amazon SDK code to find VM
+          sys.path.append(r"C:/projects/digitalnomadsky/code/Amazon")
+          import config
+          from fetching_vm import search_ec2_instance
+
+          try:
+                result = search_ec2_instance(vmname)
+          except IndexError:
+            raise Exception('something went wrong, the vm is not found in AWS!')
+
+    elif source == 'huawei':
+          # huawei SDK code to find VM
+          sys.path.append(r"C:/projects/digitalnomadsky/code/Huawei")
+          import config
+          from fetching_vm import search_huawei_vm
+
+          try:
+                result = search_huawei_vm(vmname)
+          except IndexError:
+            raise Exception('something went wrong, the vm is not found in Huawei Cloud!')
+    else:
+          raise Exception('something went wrong, the source cloud platform is not supported!')
+
+    exportdisktype,importdisktype,plan = find_best_format(source,destination,artifact_cache.expected_bytes(result))
+    result["exportdisktype"]= exportdisktype
+    result["importdisktype"]= importdisktype
+    result["format_plan"]= plan
+
+    #---------------------
+    #logs for research purpose
+    #----------------------
+    # Setup logger
+    logger = logging.getLogger(__name__)
+    if not logger.handlers:
+        logger.addHandler(AzureLogHandler(connection_string="InstrumentationKey=bde21699-fbec-4be5-93ce-ee81109b211f"))
+    logger.setLevel(logging.INFO)
+
+    # Prepare JSON data
+    data = {
+        "unique_id": unique_id,
+        "step": "fetch-vm",
+        "message": f"VM found in '{source}'",
+        "format_plan": plan['reason']
+    }
+
+    # Send as custom log
+    logger.info(data)
+    return result
+
+
+if __name__ == "__main__":
+    # Get arguments
+    source = sys.argv[1]
+    destination = sys.argv[2]
+    vmname = sys.argv[3].lower()
+    unique_id = sys.argv[5]
+
+    result = run(source, destination, vmname, {}, unique_id)
+    print(json.dumps(result))
 
 
 
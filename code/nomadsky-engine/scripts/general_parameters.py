@@ -79,8 +79,8 @@ preferred_type = {
         "export": ("vhd", "vmdk", "qcow2", "raw")
     }, 
     "ecofed": {
-        "import": ("raw"),
-        "export": ("raw")
+        "import": ("raw",),
+        "export": ("raw",)
     },
     "cyso": {
         "import": ("qcow2", "iso" ,"ova", "raw", "vmdk", "vdi", "ami", "ari", "aki", "docker"),
@@ -91,3 +91,48 @@ preferred_type = {
         "export": ("qcow2", "leafuit")
     }
 }
+
+
+#Engine settings
+code_path = r"C:/projects/digitalnomadsky/code"  # root folder of the cloned repository
+
+# folder with the provider code for every platform name used by the UI
+provider_folders = {
+    "azure": "Microsoft",
+    "aws": "Amazon",
+    "cyso": "Cyso",
+    "leaf": "Leafcloud",
+    "huawei": "Huawei",
+    "gcp": "Google"
+}
+
+step_runner = "worker"  # "worker" runs the steps in warm python processes, "subprocess" starts a new python process per step
+step_workers = 3  # number of warm worker processes started with the engine, independent steps of a migration run at the same time
+step_workers_max = None  # more workers are started when all are busy (several migrations at once), up to this number; None does not limit them
+step_timeout = 12 * 3600  # seconds a step may run before it is stopped (its warm worker is killed), None waits as long as it takes
+step_timeouts = {"fetch_vm.py": 1800, "stop_vm.py": 1800, "start_vm.py": 1800}  # per step script, instead of step_timeout
+engine_url = "http://localhost:5000"  # the steps send their progress events to the engine on this url
+ledger_path = r"C:/Temp/nomadsky-ledger.db"  # SQLite ledger with the state of every migration, used to resume after a restart
+transfer_mode = "staged"  # "staged" downloads, converts and uploads through files in C:\Temp, "stream" sends the disk straight from source to destination when the formats allow it
+stream_buffer_chunks = 16  # chunks of 4 MiB buffered between the stages of a streaming transfer
+download_connections = 8  # parallel HTTP connections of one disk download
+download_range_size = 64 * 1024 * 1024  # bytes fetched per ranged GET of a parallel download
+page_upload_connections = 16  # concurrent upload_page calls of an Azure page blob upload
+block_store = False  # True keeps the downloaded disks as deduplicated blocks and lets the uploads copy blocks a sibling VM already sent
+block_store_path = r"C:/Temp/nomadsky-blocks"  # folder of the block store and its index
+artifact_cache_path = r"C:/Temp/nomadsky-cache.db"  # index of the downloaded and converted disks in C:\Temp, so a repeated run reuses them
+artifact_cache_budget = 500 * 1024**3  # bytes the cached disks may take together, the least recently used ones are deleted beyond it
+artifact_cache_max_age = 24 * 3600  # seconds a cached disk is reused, an older one is downloaded again
+qemu_coroutines = None  # parallel coroutines of qemu-img convert (-m), None picks 16 on SSDs and 4 on spinning disks
+qemu_out_of_order = None  # out-of-order writes of qemu-img convert (-W), None allows them unless a disk is spinning
+qemu_cache_bypass = None  # convert without the host cache (-t none -T none), None does it for images of 4 GiB and more
+qemu_sparse_size = None  # bytes of zeros qemu-img convert leaves as a hole (-S), None picks it from the target format
+vmdk_decode_processes = None  # processes that inflate the grains of a streamOptimized VMDK (GCP export), None uses every core
+sparsify = False  # True zeroes the free space of the ext4, xfs and NTFS file systems in the downloaded disk before it is converted and uploaded
+planner_bandwidth = 50 * 1024**2  # bytes per second of a download or upload the format planner assumes until one was measured
+planner_convert_throughput = 200 * 1024**2  # bytes per second of a local conversion the format planner assumes until one was measured
+planner_allocated_fraction = 0.5  # part of a disk the format planner assumes to hold data
+qcow2_compression = None  # "zlib" or "zstd" writes the qcow2 for a destination that imports it with compressed clusters, when the upload is slower than compressing; None leaves it to qemu-img
+qcow2_compress_processes = None  # processes that compress the clusters of a qcow2, None uses every core
+conversion_slots = None  # conversions of all migrations that run at the same time, None sizes it from the cores and the bandwidth of the staging disk
+staging_disk_bandwidth = None  # bytes per second of the disk of C:\Temp, None assumes it from the kind of disk (SSD or spinning)
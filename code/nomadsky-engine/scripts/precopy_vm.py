@@ -0,0 +1,65 @@
+import sys
+import json
+from datetime import datetime, timezone
+from opencensus.ext.azure.log_exporter import AzureLogHandler
+import logging
+
+sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/basic")
+import migration_ledger
+
+
+def run(source, destination, vmname, shared_data, unique_id):
+    migration_ledger.use_job(shared_data.get('job_id') or unique_id)
+    if source == 'azure':
+          # Azure SDK code to copy a snapshot of the running VM
+          sys.path.append(r"C:/projects/digitalnomadsky/code/Microsoft")
+          import config
+          from downloading_vm import precopy_disk
+          result = precopy_disk(shared_data)
+
+    elif source == 'aws':
+          # AWS SDK code to read a snapshot of the running instance
+          sys.path.append(r"C:/projects/digitalnomadsky/code/Amazon")
+          import config
+          from downloading_vm import precopy_aws_osdisk
+          result = precopy_aws_osdisk(shared_data)
+
+    elif source in ('cyso', 'leaf', 'huawei'):
+             result = {
+                 'message': "no pre-copy, the disk is downloaded after the VM stopped"  }
+
+    else:
+            raise Exception(f" the source platform is not yet supported")
+
+
+    # Setup logger
+    logger = logging.getLogger(__name__)
+    if not logger.handlers:
+        logger.addHandler(AzureLogHandler(connection_string="InstrumentationKey=bde21699-fbec-4be5-93ce-ee81109b211f"))
+    logger.setLevel(logging.INFO)
+
+    # Prepare JSON data
+    times = datetime.now(timezone.utc)
+    data = {
+        "unique_id": unique_id,
+        "step": "precopy",
+        "time": times,
+        "message": f"disk pre-copied from '{source}'"
+    }
+
+    # Send as custom log
+    logger.info(data)
+    return result
+
+
+if __name__ == "__main__":
+    # Get arguments
+    source = sys.argv[1]
+    destination = sys.argv[2]
+    vmname = sys.argv[3].lower()
+    shareddata_json = sys.argv[4]
+    shared_data = json.loads(shareddata_json)
+    unique_id = sys.argv[5]
+
+    result = run(source, destination, vmname, shared_data, unique_id)
+    print(json.dumps(result))
@@ -0,0 +1,53 @@
+import sys
+import json
+from datetime import datetime, timezone
+from opencensus.ext.azure.log_exporter import AzureLogHandler
+import logging
+
+
+def run(source, destination, vmname, shared_data, unique_id):
+    if destination == 'azure':
+          # Azure SDK code to create the storage account and container of the upload
+          sys.path.append(r"C:/projects/digitalnomadsky/code/Microsoft")
+          import config
+          from upload_disk import prepare_storage
+          result = prepare_storage(shared_data)
+          result['message'] = f"the storage account and container are ready in '{destination}'!"
+
+    else:
+             # the other destinations create their storage in the upload step
+             result = {
+                 'message': "no need to prepare anything"  }
+
+
+    # Setup logger
+    logger = logging.getLogger(__name__)
+    if not logger.handlers:
+        logger.addHandler(AzureLogHandler(connection_string="InstrumentationKey=bde21699-fbec-4be5-93ce-ee81109b211f"))
+    logger.setLevel(logging.INFO)
+
+    # Prepare JSON data
+    times = datetime.now(timezone.utc)
+    data = {
+        "unique_id": unique_id,
+        "step": "prepare-destination",
+        "time": times,
+        "message": f"destination storage prepared in '{destination}'"
+    }
+
+    # Send as custom log
+    logger.info(data)
+    return result
+
+
+if __name__ == "__main__":
+    # Get arguments
+    source = sys.argv[1]
+    destination = sys.argv[2]
+    vmname = sys.argv[3].lower()
+    shareddata_json = sys.argv[4]
+    shared_data = json.loads(shareddata_json)
+    unique_id = sys.argv[5]
+
+    result = run(source, destination, vmname, shared_data, unique_id)
+    print(json.dumps(result))
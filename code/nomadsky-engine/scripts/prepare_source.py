@@ -0,0 +1,54 @@
+import sys
+import json
+from datetime import datetime, timezone
+from opencensus.ext.azure.log_exporter import AzureLogHandler
+import logging
+
+
+def run(source, destination, vmname, shared_data, unique_id):
+    if source == 'aws':
+          # AWS SDK code to check the S3 bucket of the export
+          sys.path.append(r"C:/projects/digitalnomadsky/code/Amazon")
+          import config
+          from downloading_vm import prepare_export_bucket
+          result = prepare_export_bucket(shared_data)
+
+    elif source in ('azure', 'cyso', 'leaf', 'huawei'):
+             result = {
+                 'message': "no need to prepare anything"  }
+
+    else:
+            raise Exception(f" the source platform is not yet supported")
+
+
+    # Setup logger
+    logger = logging.getLogger(__name__)
+    if not logger.handlers:
+        logger.addHandler(AzureLogHandler(connection_string="InstrumentationKey=bde21699-fbec-4be5-93ce-ee81109b211f"))
+    logger.setLevel(logging.INFO)
+
+    # Prepare JSON data
+    times = datetime.now(timezone.utc)
+    data = {
+        "unique_id": unique_id,
+        "step": "prepare-source",
+        "time": times,
+        "message": f"export storage prepared in '{source}'"
+    }
+
+    # Send as custom log
+    logger.info(data)
+    return result
+
+
+if __name__ == "__main__":
+    # Get arguments
+    source = sys.argv[1]
+    destination = sys.argv[2]
+    vmname = sys.argv[3].lower()
+    shareddata_json = sys.argv[4]
+    shared_data = json.loads(shareddata_json)
+    unique_id = sys.argv[5]
+
+    result = run(source, destination, vmname, shared_data, unique_id)
+    print(json.dumps(result))
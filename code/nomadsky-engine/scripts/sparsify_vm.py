@@ -0,0 +1,80 @@
+import sys
+import os
+import json
+from datetime import datetime, timezone
+from opencensus.ext.azure.log_exporter import AzureLogHandler
+import logging
+
+sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/scripts")
+sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/basic")
+import general_parameters
+import progress_events
+import sparsify
+import integrity
+import block_store
+import artifact_cache
+import migration_ledger
+
+
+def run(source, destination, vmname, shared_data, unique_id):
+    migration_ledger.use_job(shared_data.get('job_id') or unique_id)
+    input_path = shared_data.get('output_path', '')
+
+    if not general_parameters.sparsify:
+            result = {
+                 'message': "sparsifying is off, the free space of the disk is sent as it is",
+                 }
+    elif shared_data.get('streamed'):
+            result = {
+                 'message': f"the disk was streamed to '{destination}', there is no staged disk to sparsify",
+                 }
+    else:
+            if block_store.enabled():
+                block_store.checkout(input_path)
+            progress = progress_events.ProgressReporter(action="sparsify")
+            result = sparsify.sparsify(input_path, progress)
+            progress.done()
+
+            if result['zeroed_bytes'] != 0:
+                # the disk changed: its manifest is stale and the cache and the block store get the new content
+                if os.path.exists(integrity.manifest_path(input_path)):
+                    os.remove(integrity.manifest_path(input_path))
+                artifact_cache.register(input_path, source, vmname, shared_data.get('resource_id', ''),
+                                        shared_data.get('exportdisktype', ''))
+                if block_store.enabled():
+                    result.update(block_store.store_image(input_path))
+            elif block_store.enabled():
+                block_store.checkin(input_path)
+
+
+    # Setup logger
+    logger = logging.getLogger(__name__)
+    if not logger.handlers:
+        logger.addHandler(AzureLogHandler(connection_string="InstrumentationKey=bde21699-fbec-4be5-93ce-ee81109b211f"))
+    logger.setLevel(logging.INFO)
+
+    # Prepare JSON data
+    times = datetime.now(timezone.utc)
+    data = {
+        "unique_id": unique_id,
+        "step": "sparsify",
+        "time": times,
+        "message": f"free space of the disk of '{vmname}' zeroed"
+    }
+
+    # Send as custom log
+    logger.info(data)
+    return result
+
+
+if __name__ == "__main__":
+    # Get arguments
+    source = sys.argv[1]
+    destination = sys.argv[2]
+    vmname = sys.argv[3].lower()
+    shareddata_json = sys.argv[4]
+    shared_data = json.loads(shareddata_json)
+    unique_id = sys.argv[5]
+
+    result = run(source, destination, vmname, shared_data, unique_id)
+    print(json.dumps(result))
@@ -1,61 +1,211 @@
 import sys
 import os
-import subprocess
 import json
 from datetime import datetime, timezone
 from opencensus.ext.azure.log_exporter import AzureLogHandler
 import logging
 import math
 
-
-# Get arguments
-source = sys.argv[1]
-destination = sys.argv[2]
-vmname = sys.argv[3].lower()
-shareddata_json = sys.argv[4]
-shared_data = json.loads(shareddata_json)
-exportdisktype = shared_data.get('exportdisktype', '')
-importdisktype = shared_data.get('importdisktype', '')
-input_path = shared_data.get('output_path', '')
-unique_id = sys.argv[5]
-qemu_path = r"C:\Program Files\qemu\qemu-img.exe"
-output_path = fr"C:\temp\osdisk-{vmname}.{importdisktype}"
-subformat="subformat=dynamic"
-
-
-if exportdisktype == importdisktype:
-        result = {
-             'message': f"the diskfile type is already '{importdisktype}' so no need to transform type!", 
-             }
-else:
-            #Do qemu to convert the current disk(export) to the outputformat (importdisktype).
-            if importdisktype == "vhd":
-                importdisktype = "vpc"
-                subformat = "subformat=fixed"  
-
-            if os.path.exists(qemu_path):
-                subprocess.run([qemu_path, "convert", "-O", importdisktype, "-o", subformat, input_path, output_path], check=True)
-                result = {
-                        'message': f"the diskfiletype has been converted to a format accepted by your destination cloud provider: '{exportdisktype}'!",
-                        'output_path' : output_path
-                        }
-            else: 
-                raise Exception(f"the tool QEMU is not found. you should install QEMU manually at the following path: {qemu_path}!")
-
-print(json.dumps(result))
-        
-                            
-
-
-            ### For Azure the file format should be a real number in MB. For now Qemu the resize does not work, please help. 
-            #if destination == "azure":
-            #        ossize= os.path.getsize(output_path)
-            #        newsize = math.ceil(ossize/ (1024 * 1024))
-            #        #subprocess.run([qemu_path, "resize", output_path, "+1M"], check=True)   fail in qemu windows
-            #        #f"{newsize}M"
-        
-            #subprocess.run([qemu_path, "convert", "-O", importdisktype, output_path, output_disk_path], check=True)
-
+sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/scripts")
+sys.path.append(r"C:/projects/digitalnomadsky/code/nomadsky-engine/basic")
+import general_parameters
+import qemu_convert
+import block_store
+import artifact_cache
+import vhd_format
+import integrity
+import qcow2_reader
+import vmdk_stream
+import qcow2_writer
+import format_planner
+import progress_events
+import migration_ledger
+
+
+def run(source, destination, vmname, shared_data, unique_id):
+    migration_ledger.use_job(shared_data.get('job_id') or unique_id)
+    exportdisktype = shared_data.get('exportdisktype', '')
+    importdisktype = shared_data.get('importdisktype', '')
+    input_path = shared_data.get('output_path', '')
+    qemu_path = r"C:\Program Files\qemu\qemu-img.exe"
+    output_path = fr"C:\temp\osdisk-{vmname}.{importdisktype}"
+    subformat="subformat=dynamic"
+
+    hops = (shared_data.get('format_plan') or {}).get('hops') or []
+    if len(hops) > 1 and not shared_data.get('streamed'):
+        # the format planner found a chain of conversions cheaper than the direct one, each hop is transformed in turn
+        hop_data = dict(shared_data, format_plan=None)
+        messages = []
+        for hop_from, hop_to, method in hops:
+            hop_data.update(exportdisktype=hop_from, importdisktype=hop_to)
+            hop_result = run(source, destination, vmname, hop_data, unique_id)
+            hop_data['output_path'] = hop_result.get('output_path', hop_data['output_path'])
+            messages.append(hop_result['message'])
+        return dict(hop_result, output_path=hop_data['output_path'], message=" ".join(messages))
+
+
+    if shared_data.get('streamed'):
+            result = {
+                 'message': f"the disk was streamed to '{destination}' as '{importdisktype}', no need to transform type!",
+                 }
+    elif exportdisktype == importdisktype and not os.path.exists(input_path):
+            # the disk is in the block store, its label is all there is to go by without a checkout
+            result = {
+                 'message': f"the diskfile type is already '{importdisktype}' so no need to transform type!",
+                 }
+    else:
+                if block_store.enabled():
+                    block_store.checkout(input_path)
+                # the magic bytes tell what the file is, the label of the source platform can be wrong (e.g. a raw EBS read)
+                actualdisktype = vhd_format.detect_format(input_path)
+                resource_id = shared_data.get('resource_id', '')
+
+                if actualdisktype == importdisktype and importdisktype != "vhd":
+                    if block_store.enabled():
+                        block_store.checkin(input_path)
+                    result = {
+                         'message': f"the diskfile type is already '{importdisktype}' so no need to transform type!",
+                         }
+                elif actualdisktype in ("raw", "vhd") and importdisktype in ("raw", "vhd"):
+                    # a fixed VHD is the raw disk plus a footer: append or cut it off in place, padded to whole MiB for Azure
+                    if importdisktype == "vhd":
+                        _, changed = vhd_format.raw_to_vhd_in_place(input_path)
+                    else:
+                        _, changed = vhd_format.vhd_to_raw_in_place(input_path)
+                    if changed:
+                        if block_store.enabled():
+                            block_store.release(input_path)  # the stored blocks are of the disk before the footer changed
+                        if os.path.exists(integrity.manifest_path(input_path)):
+                            os.remove(integrity.manifest_path(input_path))
+                        artifact_cache.register(input_path, source, vmname, resource_id, importdisktype, kind="converted")
+                        result = {
+                                'message': f"the diskfile has been converted in place from '{actualdisktype}' to '{importdisktype}'!",
+                                'output_path' : input_path
+                                }
+                    else:
+                        # already a fixed VHD of whole MiB: the download, its blocks and its manifest stay as they are
+                        if block_store.enabled():
+                            block_store.checkin(input_path)
+                        result = {
+                                'message': f"the diskfile type is already '{importdisktype}' so no need to transform type!",
+                                'output_path' : input_path
+                                }
+                elif actualdisktype == "qcow2" and importdisktype in ("raw", "vhd") and qcow2_reader.supported(input_path):
+                    if destination == "azure" and importdisktype == "vhd":
+                        # the page blob upload reads the allocated clusters straight from the qcow2, no VHD on disk
+                        result = {
+                                'message': f"the qcow2 disk is uploaded as '{importdisktype}' straight from its allocated clusters, no need to transform type!",
+                                'output_path' : input_path
+                                }
+                    else:
+                        # only the allocated clusters are written, the rest of the raw disk stays a hole
+                        with qcow2_reader.Qcow2Image(input_path) as image:
+                            artifact_cache.reserve(image.allocated_bytes(), output_path)
+                            image.to_raw(output_path)
+                        if importdisktype == "vhd":
+                            vhd_format.raw_to_vhd_in_place(output_path)
+                        if block_store.enabled():
+                            block_store.checkin(input_path)
+                        artifact_cache.register(output_path, source, vmname, resource_id, importdisktype, kind="converted", parent=input_path)
+                        result = {
+                                'message': f"the qcow2 disk has been written as a sparse '{importdisktype}'!",
+                                'output_path' : output_path
+                                }
+                elif actualdisktype == "vmdk" and importdisktype in ("raw", "vhd") and vmdk_stream.is_stream_optimized(input_path):
+                    # a GCP export: its grains are inflated on every core and written into a sparse raw disk
+                    artifact_cache.reserve(os.path.getsize(input_path), output_path)
+                    progress = progress_events.ProgressReporter(total_bytes=os.path.getsize(input_path), action="convert")
+                    vmdk_stream.to_raw(input_path, output_path, processes=shared_data.get('conversion_processes'), progress=progress)
+                    progress.done()
+                    if importdisktype == "vhd":
+                        vhd_format.raw_to_vhd_in_place(output_path)
+                    if block_store.enabled():
+                        block_store.checkin(input_path)
+                    artifact_cache.register(output_path, source, vmname, resource_id, importdisktype, kind="converted", parent=input_path)
+                    result = {
+                            'message': f"the streamOptimized vmdk has been decoded to a sparse '{importdisktype}'!",
+                            'output_path' : output_path
+                            }
+                elif importdisktype == "qcow2" and general_parameters.qcow2_compression and qcow2_writer.readable(input_path, actualdisktype):
+                    # the clusters are compressed on every core, unless a sample shows the upload is faster than that
+                    upload_speed, _ = format_planner.measured_throughput("upload", destination, general_parameters.planner_bandwidth)
+                    artifact_cache.reserve(os.path.getsize(input_path), output_path)
+                    progress = progress_events.ProgressReporter(total_bytes=qcow2_writer.source(input_path, actualdisktype)[0], action="convert")
+                    stats = qcow2_writer.convert(input_path, output_path, actualdisktype, general_parameters.qcow2_compression,
+                                                 upload_speed=upload_speed, processes=shared_data.get('conversion_processes'),
+                                                 progress=progress)
+                    progress.done()
+                    if block_store.enabled():
+                        block_store.checkin(input_path)
+                    artifact_cache.register(output_path, source, vmname, resource_id, importdisktype, kind="converted", parent=input_path)
+                    result = {
+                            'message': f"the diskfile has been written as qcow2 ({stats['compression'] or 'uncompressed'}) for your destination cloud provider!",
+                            'output_path' : output_path,
+                            'compression' : stats
+                            }
+                else:
+                    #Do qemu to convert the current disk(export) to the outputformat (importdisktype).
+                    if importdisktype == "vhd":
+                        importdisktype = "vpc"
+                        subformat = "subformat=fixed,force_size=on"
+
+                    cached_path = artifact_cache.lookup(source, vmname, resource_id, importdisktype, kind="converted", parent=input_path)
+                    if cached_path:
+                        # an earlier run converted this same download already
+                        if block_store.enabled():
+                            block_store.checkin(input_path)
+                        result = {
+                                'message': f"the converted disk of this download was found in the cache: '{importdisktype}'!",
+                                'output_path' : cached_path,
+                                'cached' : True
+                                }
+                    elif os.path.exists(qemu_path):
+                        artifact_cache.reserve(os.path.getsize(input_path), output_path)
+                        # coroutines, out-of-order writes, cache bypass and sparse size chosen for the disks of this machine
+                        tuning = qemu_convert.convert(qemu_path, input_path, output_path, importdisktype, subformat)
+                        if block_store.enabled():
+                            block_store.checkin(input_path)
+                        if importdisktype == "vpc":
+                            vhd_format.raw_to_vhd_in_place(output_path)  # realign to whole MiB when qemu rounded to its geometry
+                        artifact_cache.register(output_path, source, vmname, resource_id, importdisktype, kind="converted", parent=input_path)
+                        result = {
+                                'message': f"the diskfiletype has been converted to a format accepted by your destination cloud provider: '{exportdisktype}'!",
+                                'output_path' : output_path,
+                                'convert_options' : tuning
+                                }
+                    else:
+                        raise Exception(f"the tool QEMU is not found. you should install QEMU manually at the following path: {qemu_path}!")
+
+
+    # Setup logger
+    logger = logging.getLogger(__name__)
+    if not logger.handlers:
+        logger.addHandler(AzureLogHandler(connection_string="InstrumentationKey=bde21699-fbec-4be5-93ce-ee81109b211f"))
+    logger.setLevel(logging.INFO)
+
+    # Prepare JSON data
+    data = {
+        "unique_id": unique_id,
+        "step": "transform",
+        "message": f"VM disk transformed to format from '{destination}'"
+    }
+
+    # Send as custom log
+    logger.info(data)
+    return result
+
+
+if __name__ == "__main__":
+    # Get arguments
+    source = sys.argv[1]
+    destination = sys.argv[2]
+    vmname = sys.argv[3].lower()
+    shareddata_json = sys.argv[4]
+    shared_data = json.loads(shareddata_json)
+    unique_id = sys.argv[5]
+
+    result = run(source, destination, vmname, shared_data, unique_id)
+    print(json.dumps(result))
 
 
 
@@ -72,22 +222,3 @@ print(json.dumps(result))
 
 #from helpers import my_function
 #result = my_function(5)
-
-   
-
-
-
-# Setup logger
-logger = logging.getLogger(__name__)
-logger.addHandler(AzureLogHandler(connection_string="InstrumentationKey=bde21699-fbec-4be5-93ce-ee81109b211f"))
-logger.setLevel(logging.INFO)
-
-# Prepare JSON data
-data = {
-    "unique_id": unique_id,
-    "step": "transform",
-    "message": f"VM disk transformed to format from '{destination}'"
-}
-
-# Send as custom log
-logger.info(data)
@@ -0,0 +1,70 @@
+# -------------------------------
+# Benchmark of the S3 export download: boto3 download_fileobj with its default transfer profile (through
+# integrity.HashingFile) against downloading_vm.download_export() with the profile of Amazon/config.py, against the
+# local S3 stand-in with a latency per request and a bandwidth per connection. Run from code/nomadsky-engine:
+#   python tests/benchmark_s3_download.py [size in MiB] [latency in seconds] [MiB/s per connection]
+# -------------------------------
+import os
+import sys
+import time
+import tempfile
+
+engine_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(engine_path, "basic"))
+sys.path.insert(0, os.path.join(engine_path, "scripts"))
+sys.path.insert(0, os.path.join(os.path.dirname(engine_path), "Amazon"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import boto3
+from boto3.s3.transfer import TransferConfig
+import config
+import downloading_vm
+import integrity
+from s3_stand_in import S3StandIn
+
+
+def boto3_default(client, size, path):
+    transfer = TransferConfig()
+    tree = integrity.TreeHash(size, flat=("md5",), window=integrity.in_flight_window(
+        transfer.max_request_concurrency, transfer.multipart_chunksize))
+    with open(path, "wb") as f:
+        client.download_fileobj("exports", "disk.vhd", integrity.HashingFile(f, tree), Config=transfer)
+    tree.finish(path)
+
+
+def config_profile(client, size, path):
+    downloading_vm.download_export(client, "exports", "disk.vhd", path)
+
+
+def main():
+    size = int(float(sys.argv[1]) * 1024**2) if len(sys.argv) > 1 else 1024**3
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.03
+    bandwidth = float(sys.argv[3]) * 1024**2 if len(sys.argv) > 3 else 20 * 1024**2
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+    server = S3StandIn({("exports", "disk.vhd"): os.urandom(size)}, latency=latency, bandwidth=bandwidth)
+    config.s3_endpoint_url = server.url
+    path = os.path.join(tempfile.gettempdir(), "s3-benchmark.vhd")
+    profiles = [
+        ("boto3 default", boto3_default, boto3.Session().client("s3", region_name="eu-west-1", endpoint_url=server.url),
+         TransferConfig()),
+        ("config.py profile", config_profile, downloading_vm.s3_client(boto3.Session(), "eu-west-1"),
+         downloading_vm.s3_transfer_config(size)),
+    ]
+    print(f"{size / 1024**2:.0f} MiB, {latency * 1000:.0f} ms per request, {bandwidth / 1024**2:.0f} MiB/s per connection")
+    try:
+        for name, download, client, transfer_config in profiles:
+            started = time.monotonic()
+            download(client, size, path)
+            seconds = time.monotonic() - started
+            print(f"{name:18} {seconds:7.1f} s {size / seconds / 1024**2:7.1f} MiB/s "
+                  f"(parts of {transfer_config.multipart_chunksize / 1024**2:.0f} MiB, "
+                  f"{transfer_config.max_request_concurrency} at a time)")
+            for suffix in ("", ".integrity.json"):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+    finally:
+        server.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,24 @@
+# -------------------------------
+# The engine modules import each other through sys.path (the C:/projects/... paths of a Windows install),
+# so the tests put the basic and scripts folders of this checkout on sys.path first.
+# Every test gets its own ledger, artifact cache and block store in a temporary folder.
+# -------------------------------
+import os
+import sys
+
+import pytest
+
+engine_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(engine_path, "basic"))
+sys.path.insert(0, os.path.join(engine_path, "scripts"))
+
+import general_parameters
+
+
+@pytest.fixture(autouse=True)
+def engine_state(tmp_path, monkeypatch):
+    monkeypatch.setattr(general_parameters, "ledger_path", str(tmp_path / "ledger.db"))
+    monkeypatch.setattr(general_parameters, "artifact_cache_path", str(tmp_path / "cache.db"))
+    monkeypatch.setattr(general_parameters, "block_store_path", str(tmp_path / "blocks"))
+    monkeypatch.setattr(general_parameters, "engine_url", "http://127.0.0.1:9")  # progress events go nowhere
+    return tmp_path
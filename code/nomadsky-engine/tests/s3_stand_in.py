@@ -0,0 +1,120 @@
+# -------------------------------
+# A local stand-in for the S3 GetObject and HeadObject calls of an export download, for tests and benchmarks.
+# Objects are served path style (http://127.0.0.1:<port>/<bucket>/<key>) with Range support and the MD5 ETag of a
+# single part upload. latency is added to every request and bandwidth (bytes per second) limits every connection,
+# the way one connection to S3 is limited, so the transfer profile makes a difference here as it does against AWS.
+# With fail_after set, every GET after that many answered ones fails with a 500, like a connection that dropped.
+# HEAD of a bucket and DELETE of an object are answered too, for the bucket check and the cleanup of an export.
+# -------------------------------
+import time
+import hashlib
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class S3StandIn:
+
+    def __init__(self, objects, latency=0.0, bandwidth=None):
+        self.objects = objects  # {(bucket, key): bytes}
+        self.etags = {name: hashlib.md5(data).hexdigest() for name, data in objects.items()}
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.requests = []
+        self.fail_after = None
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _object(self):
+                bucket, _, key = self.path.split("?")[0].lstrip("/").partition("/")
+                self.etag = server.etags.get((bucket, key))
+                return server.objects.get((bucket, key))
+
+            def _not_found(self, body=True):
+                error = b"<Error><Code>NoSuchKey</Code><Message>not found</Message></Error>"
+                self.send_response(404)
+                self.send_header("Content-Type", "application/xml")
+                self.send_header("Content-Length", str(len(error) if body else 0))
+                self.end_headers()
+                if body:
+                    self.wfile.write(error)
+
+            def _headers(self, data):
+                self.send_header("ETag", f'"{self.etag}"')
+                self.send_header("Accept-Ranges", "bytes")
+                self.send_header("Last-Modified", "Thu, 01 Oct 2026 00:00:00 GMT")
+
+            def do_HEAD(self):
+                data = self._object()
+                bucket, _, key = self.path.split("?")[0].lstrip("/").partition("/")
+                if data is None and not key and any(name[0] == bucket for name in server.objects):
+                    self.send_response(200)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                if data is None:
+                    return self._not_found(body=False)
+                self.send_response(200)
+                self._headers(data)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+
+            def do_GET(self):
+                data = self._object()
+                if data is None:
+                    return self._not_found()
+                with server.lock:
+                    server.active += 1
+                    server.max_active = max(server.max_active, server.active)
+                try:
+                    time.sleep(server.latency)
+                    if server.fail_after is not None and len(server.requests) >= server.fail_after:
+                        self.send_response(500)
+                        self.send_header("Content-Length", "0")
+                        self.end_headers()
+                        return
+                    header = self.headers.get("Range")
+                    if header:
+                        start, end = header.split("=")[1].split("-")
+                        start, end = int(start), min(int(end or len(data) - 1), len(data) - 1)
+                        self.send_response(206)
+                        self.send_header("Content-Range", f"bytes {start}-{end}/{len(data)}")
+                    else:
+                        start, end = 0, len(data) - 1
+                        self.send_response(200)
+                    with server.lock:
+                        server.requests.append((start, end))
+                    body = memoryview(data)[start:end + 1]
+                    self._headers(data)
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    piece = 256 * 1024
+                    for position in range(0, len(body), piece):
+                        self.wfile.write(body[position:position + piece])
+                        if server.bandwidth:
+                            time.sleep(min(piece, len(body) - position) / server.bandwidth)
+                finally:
+                    with server.lock:
+                        server.active -= 1
+
+            def do_DELETE(self):
+                bucket, _, key = self.path.split("?")[0].lstrip("/").partition("/")
+                server.objects.pop((bucket, key), None)
+                self.send_response(204)
+                self.end_headers()
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,91 @@
+import os
+import sqlite3
+import time
+
+import pytest
+
+import artifact_cache
+import general_parameters
+import integrity
+import migration_ledger
+
+
+@pytest.fixture
+def cached_disk(tmp_path):
+    migration_ledger.use_job("job-1")
+    path = str(tmp_path / "web01.vhd")
+    with open(path, "wb") as f:
+        f.write(os.urandom(64 * 1024))
+    artifact_cache.register(path, "azure", "web01", "vm-1", "vhd")
+    return path
+
+
+def lookup():
+    return artifact_cache.lookup("azure", "web01", "vm-1", "vhd")
+
+
+def test_lookup_finds_the_registered_disk(cached_disk):
+    assert lookup() == cached_disk
+    assert artifact_cache.valid(cached_disk)
+
+
+@pytest.mark.parametrize("kind", artifact_cache.precopy_artifacts)
+def test_lookup_is_bypassed_while_a_precopy_is_pending(cached_disk, kind):
+    migration_ledger.record_artifact(kind, "snapshot-1")
+    assert artifact_cache.precopy_pending()
+    assert lookup() is None
+    # the delta is applied, the pre-copy is cleared from the ledger
+    migration_ledger.record_artifact(kind, None)
+    assert not artifact_cache.precopy_pending()
+    assert lookup() == cached_disk
+
+
+def test_precopy_in_shared_data(cached_disk):
+    assert artifact_cache.precopy_pending({'precopy_snapshot_id': "snap-1"})
+    assert not artifact_cache.precopy_pending({'message': "empthy"})
+
+
+def rewrite(path, data):
+    # the file is changed in place later on, with the same size
+    stat = os.stat(path)
+    with open(path, "r+b") as f:
+        f.write(data)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+
+def test_changed_file_of_the_same_size_is_not_valid(cached_disk):
+    rewrite(cached_disk, os.urandom(4096))
+    assert os.path.getsize(cached_disk) == 64 * 1024
+    assert not artifact_cache.valid(cached_disk)
+    assert lookup() is None
+
+
+def test_converted_artifact_is_hashed_when_registered(cached_disk, tmp_path):
+    converted = str(tmp_path / "web01.qcow2")
+    with open(converted, "wb") as f:
+        f.write(os.urandom(32 * 1024))
+    assert integrity.read_manifest(converted) is None
+    artifact_cache.register(converted, "azure", "web01", "vm-1", "qcow2", kind="converted", parent=cached_disk)
+    assert integrity.read_manifest(converted)['root']
+    assert artifact_cache.lookup("azure", "web01", "vm-1", "qcow2", kind="converted", parent=cached_disk) == converted
+    # without its manifest, or changed in place, it is converted again
+    rewrite(converted, os.urandom(4096))
+    assert artifact_cache.lookup("azure", "web01", "vm-1", "qcow2", kind="converted", parent=cached_disk) is None
+    artifact_cache.register(converted, "azure", "web01", "vm-1", "qcow2", kind="converted", parent=cached_disk)
+    os.remove(integrity.manifest_path(converted))
+    assert not artifact_cache.valid(converted)
+
+
+def test_cache_of_an_earlier_version_is_not_trusted(tmp_path):
+    connection = sqlite3.connect(general_parameters.artifact_cache_path)
+    connection.execute("CREATE TABLE artifacts (path TEXT PRIMARY KEY, key TEXT, kind TEXT, parent TEXT, "
+                       "size INTEGER, root TEXT, job_id TEXT, created REAL, last_used REAL)")
+    path = str(tmp_path / "old.vhd")
+    with open(path, "wb") as f:
+        f.write(bytes(1024))
+    connection.execute("INSERT INTO artifacts VALUES (?, ?, 'download', NULL, 1024, NULL, '', ?, ?)",
+                       (path, artifact_cache.cache_key("azure", "old", "vm-2", "vhd"), time.time(), time.time()))
+    connection.commit()
+    connection.close()
+    assert not artifact_cache.valid(path)
+    assert artifact_cache.lookup("azure", "old", "vm-2", "vhd") is None
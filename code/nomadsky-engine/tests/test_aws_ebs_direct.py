@@ -0,0 +1,235 @@
+# EBS direct reads against moto, a local stand-in for the EBS and EC2 APIs
+import os
+import sys
+import base64
+import logging
+import hashlib
+
+import pytest
+
+moto = pytest.importorskip("moto")
+boto3 = pytest.importorskip("boto3")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "Amazon"))
+import ebs_direct
+import migration_ledger
+
+region = "eu-west-1"
+
+
+@pytest.fixture
+def aws(monkeypatch):
+    for name, value in (("AWS_ACCESS_KEY_ID", "testing"), ("AWS_SECRET_ACCESS_KEY", "testing"),
+                        ("AWS_DEFAULT_REGION", region)):
+        monkeypatch.setenv(name, value)
+    with moto.mock_aws():
+        yield boto3.Session(region_name=region)
+
+
+def make_snapshot(session, blocks, volume_gib=1):
+    """A completed snapshot with the given {block index: data}."""
+    client = session.client("ebs")
+    snapshot_id = client.start_snapshot(VolumeSize=volume_gib)['SnapshotId']
+    for index, data in blocks.items():
+        client.put_snapshot_block(SnapshotId=snapshot_id, BlockIndex=index, BlockData=data, DataLength=len(data),
+                                  Checksum=base64.b64encode(hashlib.sha256(data).digest()).decode(),
+                                  ChecksumAlgorithm="SHA256")
+    client.complete_snapshot(SnapshotId=snapshot_id, ChangedBlocksCount=len(blocks))
+    return snapshot_id
+
+
+class FlakyClient:
+    """An EBS client whose GetSnapshotBlock fails after a number of calls; it counts the calls."""
+
+    def __init__(self, client, fail_after=None):
+        self.client = client
+        self.fail_after = fail_after
+        self.fetched = []
+
+    def get_snapshot_block(self, **arguments):
+        if self.fail_after is not None and len(self.fetched) >= self.fail_after:
+            raise Exception("connection reset")
+        self.fetched.append(arguments['BlockIndex'])
+        return self.client.get_snapshot_block(**arguments)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+def read_blocks(path, block_size, indexes):
+    with open(path, "rb") as f:
+        result = {}
+        for index in indexes:
+            f.seek(index * block_size)
+            result[index] = f.read(block_size)
+        return result
+
+
+def block(value):
+    return bytes([value]) * 512
+
+
+def test_download_snapshot(aws, tmp_path):
+    blocks = {0: block(1), 7: block(2), 2048: block(3)}
+    snapshot_id = make_snapshot(aws, blocks)
+    output = str(tmp_path / "disk.raw")
+    result = ebs_direct.download_snapshot(aws.client("ebs"), snapshot_id, output, connections=4)
+    assert result['blocks'] == 3
+    assert os.path.getsize(output) == 1024**3
+    assert read_blocks(output, result['block_size'], [0, 1, 7, 2048]) == {**blocks, 1: bytes(512)}
+    assert not ebs_direct.is_partial(output)
+
+
+def test_interrupted_download_continues_with_the_missing_blocks(aws, tmp_path):
+    blocks = {index: block(index % 250 + 1) for index in range(0, 40, 2)}
+    snapshot_id = make_snapshot(aws, blocks)
+    output = str(tmp_path / "disk.raw")
+    flaky = FlakyClient(aws.client("ebs"), fail_after=8)
+    with pytest.raises(Exception):
+        ebs_direct.download_snapshot(flaky, snapshot_id, output, connections=1)
+    assert ebs_direct.is_partial(output)
+
+    client = FlakyClient(aws.client("ebs"))
+    ebs_direct.download_snapshot(client, snapshot_id, output, connections=4)
+    assert sorted(client.fetched) == sorted(set(blocks) - set(flaky.fetched))
+    assert read_blocks(output, 512, blocks) == blocks
+    assert not ebs_direct.is_partial(output)
+
+
+def test_changed_blocks(aws, tmp_path):
+    first = make_snapshot(aws, {0: block(1), 1: block(2), 2: block(3)})
+    second = make_snapshot(aws, {0: block(1), 1: block(9)})  # block 1 changed, block 2 is gone
+    output = str(tmp_path / "disk.raw")
+    client = aws.client("ebs")
+    ebs_direct.download_snapshot(client, first, output)
+    result = ebs_direct.download_changed_blocks(client, first, second, output)
+    assert result['changed_blocks'] == 2
+    assert read_blocks(output, 512, [0, 1, 2]) == {0: block(1), 1: block(9), 2: bytes(512)}
+    assert not ebs_direct.is_partial(output)
+
+
+@pytest.fixture
+def stopped_instance(aws, tmp_path, monkeypatch):
+    import config
+    monkeypatch.setattr(config, "download_method", "ebs_direct")
+    monkeypatch.setattr(config, "download_path", str(tmp_path))
+    monkeypatch.setattr(sys, "argv", ["download_vm.py", "aws", "azure", "web01", "{}", "job-1"])
+    ec2 = aws.client("ec2")
+    instance_id = ec2.run_instances(ImageId="ami-12c6146b", MinCount=1, MaxCount=1)['Instances'][0]['InstanceId']
+    ec2.stop_instances(InstanceIds=[instance_id])
+    migration_ledger.use_job("job-1")
+    return ec2, {'region': region, 'resource_id': instance_id}
+
+
+def test_snapshot_is_kept_when_the_block_read_fails(aws, stopped_instance, monkeypatch):
+    import downloading_vm
+    ec2, shared_data = stopped_instance
+    blocks = {index: block(index + 1) for index in range(12)}
+    # the snapshot of this migration, as an engine restart finds it in the ledger
+    snapshot_id = make_snapshot(aws, blocks)
+    migration_ledger.record_artifact('snapshot_id', snapshot_id)
+
+    flaky = FlakyClient(aws.client("ebs"), fail_after=5)
+    monkeypatch.setattr(ebs_direct, "ebs_client", lambda session, region: flaky)
+    with pytest.raises(Exception, match="is kept"):
+        downloading_vm.download_aws_osdisk(shared_data)
+    assert migration_ledger.find_artifact('snapshot_id') == snapshot_id
+    assert ec2.describe_snapshots(SnapshotIds=[snapshot_id])['Snapshots']
+
+    client = FlakyClient(aws.client("ebs"))
+    monkeypatch.setattr(ebs_direct, "ebs_client", lambda session, region: client)
+    result = downloading_vm.download_aws_osdisk(shared_data)
+    assert sorted(client.fetched) == sorted(set(blocks) - set(flaky.fetched))
+    assert read_blocks(result['output_path'], 512, blocks) == blocks
+    # cleaned up after the success
+    assert migration_ledger.find_artifact('snapshot_id') is None
+    assert snapshot_id not in [snapshot['SnapshotId'] for snapshot in ec2.describe_snapshots()['Snapshots']]
+
+
+def test_delta_snapshots_are_kept_until_the_delta_is_applied(aws, stopped_instance, monkeypatch, tmp_path):
+    import downloading_vm
+    ec2, shared_data = stopped_instance
+    first = make_snapshot(aws, {index: block(1) for index in range(12)})
+    second = make_snapshot(aws, {index: block(2) if index % 2 else block(1) for index in range(12)})
+    # the pre-copy read the first snapshot while the instance ran, the stop snapshot is in the ledger
+    output = str(tmp_path / "web01.raw")
+    ebs_direct.download_snapshot(aws.client("ebs"), first, output)
+    migration_ledger.record_artifact('output_path', output)
+    migration_ledger.record_artifact('precopy_snapshot_id', first)
+    migration_ledger.record_artifact('snapshot_id', second)
+
+    flaky = FlakyClient(aws.client("ebs"), fail_after=3)
+    monkeypatch.setattr(ebs_direct, "ebs_client", lambda session, region: flaky)
+    with pytest.raises(Exception, match="is kept"):
+        downloading_vm.download_aws_osdisk(shared_data)
+    assert migration_ledger.find_artifact('snapshot_id') == second
+    assert migration_ledger.find_artifact('precopy_snapshot_id') == first
+
+    client = FlakyClient(aws.client("ebs"))
+    monkeypatch.setattr(ebs_direct, "ebs_client", lambda session, region: client)
+    result = downloading_vm.download_aws_osdisk(shared_data)
+    # the blocks of the first attempt are not fetched again
+    assert sorted(client.fetched + flaky.fetched) == list(range(1, 12, 2))
+    assert read_blocks(output, 512, range(12)) == {index: block(2) if index % 2 else block(1) for index in range(12)}
+    assert result['status'] == 'download_completed'
+    assert migration_ledger.find_artifact('snapshot_id') is None
+    assert migration_ledger.find_artifact('precopy_snapshot_id') is None
+
+
+class SnapshotsWithBlocks:
+    """
+    A session whose EC2 create_snapshot writes the next of the given block sets through the EBS API:
+    moto keeps the snapshots of EC2 apart from the blocks of EBS direct.
+    """
+
+    def __init__(self, session, block_sets):
+        self.session = session
+        self.block_sets = list(block_sets)
+
+    def client(self, service, *args, **kwargs):
+        client = self.session.client(service, *args, **kwargs)
+        if service != "ec2":
+            return client
+        outer = self
+
+        class Client:
+            def create_snapshot(self, **arguments):
+                return {'SnapshotId': make_snapshot(outer.session, outer.block_sets.pop(0))}
+
+            def __getattr__(self, name):
+                return getattr(client, name)
+
+        return Client()
+
+
+def test_download_step_syncs_the_delta_after_an_aws_precopy(aws, stopped_instance, monkeypatch, tmp_path):
+    pytest.importorskip("opencensus.ext.azure")
+    import config
+    import artifact_cache
+    import downloading_vm
+    import download_vm
+    ec2, shared_data = stopped_instance
+    # the step sends its log to Application Insights only when its logger has no handler yet
+    monkeypatch.setattr(logging.getLogger("download_vm"), "handlers", [logging.NullHandler()])
+    monkeypatch.setattr(config, "precopy", True)
+    running = {index: block(1) for index in range(12)}
+    stopped = {index: block(2) if index % 2 else block(1) for index in range(12)}
+    session = SnapshotsWithBlocks(aws, [running, stopped])
+    monkeypatch.setattr(boto3, "Session", lambda *args, **kwargs: session)
+    # a disk of the same instance downloaded by an earlier migration, it must not stand in for the synced one
+    stale = tmp_path / "stale.raw"
+    stale.write_bytes(bytes(4096))
+    artifact_cache.register(str(stale), "aws", "web01", shared_data['resource_id'], "raw")
+
+    precopy = downloading_vm.precopy_aws_osdisk(shared_data)
+    assert precopy['precopy_snapshot_id']
+    shared_data = dict(shared_data, exportdisktype="raw", **precopy)
+    result = download_vm.run("aws", "azure", "web01", shared_data, "job-1")
+
+    assert not result.get('cached')
+    assert result['output_path'] == precopy['output_path']
+    assert result['status'] == 'download_completed'
+    assert result['changed_blocks'] == 6
+    assert read_blocks(result['output_path'], 512, range(12)) == stopped
+    assert migration_ledger.find_artifact('precopy_snapshot_id') is None
+    assert precopy['precopy_snapshot_id'] not in [snapshot['SnapshotId'] for snapshot in ec2.describe_snapshots()['Snapshots']]
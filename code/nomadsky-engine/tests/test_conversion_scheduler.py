@@ -0,0 +1,77 @@
+import time
+import threading
+from contextlib import contextmanager
+
+import conversion_scheduler
+import migration_jobs
+import migration_ledger
+import step_runner
+
+
+def test_priority_then_smallest_first():
+    scheduler = conversion_scheduler.ConversionScheduler(1)
+    first = scheduler.acquire("job-0", "transform_vm.py", 10)
+    order = []
+
+    def convert(job_id, size, priority):
+        with scheduler.slot(job_id, "transform_vm.py", size, priority):
+            order.append(job_id)
+
+    threads = [threading.Thread(target=convert, args=args)
+               for args in (("big", 300, 0), ("small", 100, 0), ("urgent", 900, 5))]
+    for thread in threads:
+        thread.start()
+    while scheduler.status()['queue_depth'] < 3:
+        time.sleep(0.01)
+    scheduler.release(first)
+    for thread in threads:
+        thread.join()
+    assert order == ["urgent", "small", "big"]
+
+
+class SlowWorker:
+    def __init__(self, release):
+        self.release = release
+
+    def run(self, script, source, destination, vmname, shared_data, unique_id):
+        self.release.wait()
+        return {'success': True, 'output': shared_data}
+
+
+def test_slot_is_taken_after_the_worker(monkeypatch):
+    # one worker: a conversion that waits for it must not hold or queue for a slot meanwhile
+    scheduler = conversion_scheduler.ConversionScheduler(2)
+    release = threading.Event()
+    pool = step_runner.WorkerPool(1, maximum=1)
+    pool.workers = [SlowWorker(release)]
+    pool.free.get()
+    pool.free.put(pool.workers[0])
+
+    @contextmanager
+    def gate():
+        with scheduler.slot("job", "transform_vm.py", 10) as conversion:
+            yield {'conversion_processes': conversion['processes']}
+
+    results = []
+    transfer = threading.Thread(target=lambda: results.append(pool.run("upload_image.py", "a", "b", "vm", {}, "id")))
+    transfer.start()
+    time.sleep(0.05)
+    conversion = threading.Thread(target=lambda: results.append(
+        pool.run("transform_vm.py", "a", "b", "vm", {}, "id", gate)))
+    conversion.start()
+    time.sleep(0.05)
+    status = scheduler.status()
+    assert status['queue_depth'] == 0 and status['running'] == []
+    release.set()
+    transfer.join()
+    conversion.join()
+    assert results[1]['output'] == {'conversion_processes': scheduler.processes}
+    assert scheduler.status()['finished'][0]['job_id'] == "job"
+
+
+def test_priority_is_kept_in_the_ledger():
+    migration_ledger.create_migration("job-7", "azure", "aws", "web01", 5)
+    job = migration_jobs.MigrationJob.from_ledger(migration_ledger.load_migration("job-7"))
+    assert job.priority == 5
+    migration_ledger.create_migration("job-8", "azure", "aws", "web02")
+    assert migration_jobs.MigrationJob.from_ledger(migration_ledger.load_migration("job-8")).priority == 0
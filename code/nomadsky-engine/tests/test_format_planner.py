@@ -0,0 +1,33 @@
+import format_planner
+import migration_ledger
+
+
+def test_huawei_to_azure_uploads_from_the_qcow2():
+    plan = format_planner.plan("huawei", "azure", 100 * 1024**3)
+    assert (plan['export'], plan['import']) == ("qcow2", "vhd")
+    assert plan['hops'] == [["qcow2", "vhd", "qcow2 reader at upload"]]
+
+
+def test_cyso_to_leaf_has_no_hop():
+    plan = format_planner.plan("cyso", "leaf", 100 * 1024**3)
+    assert plan['export'] == plan['import'] == "qcow2"
+    assert plan['hops'] == []
+    assert plan['convert_seconds'] == 0
+
+
+def test_aws_to_azure_keeps_the_vhd():
+    plan = format_planner.plan("aws", "azure")
+    assert (plan['export'], plan['import'], plan['hops']) == ("vhd", "vhd", [])
+
+
+def test_gcp_to_azure_decodes_the_vmdk():
+    plan = format_planner.plan("gcp", "azure")
+    assert plan['export'] == "vmdk"
+    assert plan['hops'] == [["vmdk", "vhd", "vmdk decoder"]]
+
+
+def test_measured_throughput_is_used():
+    assert "default" in format_planner.plan("aws", "azure")['reason']
+    migration_ledger.record_throughput("download", "aws", 300 * 1024**2, 1.0)
+    plan = format_planner.plan("aws", "azure")
+    assert "300 MiB/s measured" in plan['reason']
@@ -0,0 +1,43 @@
+import hashlib
+import os
+
+import pytest
+
+import integrity
+
+leaf = 64 * 1024
+range_size = 4 * leaf
+connections = 4
+
+
+def in_flight_order(data):
+    # the ranges of a parallel download finish a round at a time, the first range of every round last
+    ranges = [(start, data[start:start + range_size]) for start in range(0, len(data), range_size)]
+    for first in range(0, len(ranges), connections):
+        yield from reversed(ranges[first:first + connections])
+
+
+@pytest.fixture
+def data(monkeypatch):
+    # no slack beyond what the connections keep in flight
+    monkeypatch.setattr(integrity, "flat_window", 0)
+    return os.urandom(40 * range_size + 123)
+
+
+def test_flat_hash_keeps_up_with_ranges_out_of_order(data):
+    tree = integrity.TreeHash(len(data), leaf=leaf, flat=("md5",),
+                              window=integrity.in_flight_window(connections, range_size))
+    for offset, piece in in_flight_order(data):
+        tree.update(offset, piece)
+    # without a path nothing can be read back, every leaf and the flat hash came from the updates
+    manifest = tree.finish()
+    assert manifest['flat'] == {'md5': hashlib.md5(data).hexdigest()}
+    assert len(manifest['leaves']) == -(-len(data) // leaf)
+
+
+def test_flat_hash_stalls_when_the_window_is_smaller(data):
+    tree = integrity.TreeHash(len(data), leaf=leaf, flat=("md5",), window=range_size)
+    for offset, piece in in_flight_order(data):
+        tree.update(offset, piece)
+    with pytest.raises(Exception, match="misses data"):
+        tree.finish()
@@ -0,0 +1,130 @@
+import os
+import zlib
+import struct
+
+import pytest
+
+import qcow2_reader
+import vhd_format
+
+cluster_bits = 12  # 4 KiB clusters, so an L2 table covers 2 MiB and a small image needs two of them
+cluster_size = 1 << cluster_bits
+entries = cluster_size // 8
+
+
+def build_qcow2(path, size, clusters, backing=False):
+    """
+    A qcow2 version 3 image written by hand: clusters is guest offset -> (kind, data), kind "data", "deflate" or "zero".
+    Refcounts are left out, the reader does not use them.
+    """
+    l1_size = -(-size // (entries * cluster_size))
+    l1_offset = cluster_size
+    position = 2 * cluster_size
+    l2_tables = {}
+    body = {}
+    for guest, (kind, data) in sorted(clusters.items()):
+        table = l2_tables.setdefault(guest // (entries * cluster_size), [0] * entries)
+        index = guest // cluster_size % entries
+        if kind == "zero":
+            table[index] = qcow2_reader._zero
+        elif kind == "deflate":
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -12)
+            packed = compressor.compress(data) + compressor.flush()
+            sectors = ((position + len(packed) - 1) >> 9) - (position >> 9)
+            table[index] = qcow2_reader._compressed | sectors << (62 - (cluster_bits - 8)) | position
+            body[position] = packed
+            position += len(packed)
+        else:
+            position = -(-position // cluster_size) * cluster_size
+            table[index] = position
+            body[position] = data.ljust(cluster_size, b"\0")
+            position += cluster_size
+    l1 = [0] * l1_size
+    for index, table in sorted(l2_tables.items()):
+        position = -(-position // cluster_size) * cluster_size
+        body[position] = struct.pack(f">{entries}Q", *table)
+        l1[index] = position
+        position += cluster_size
+    header = struct.pack(">4sIQIIQIIQQIIQQQQII", qcow2_reader.magic, 3, 1024 if backing else 0, 0, cluster_bits,
+                         size, 0, l1_size, l1_offset, 0, 0, 0, 0, 0, 0, 0, 4, 104)
+    with open(path, "wb") as f:
+        f.write(header)
+        f.seek(l1_offset)
+        f.write(struct.pack(f">{l1_size}Q", *l1))
+        for offset, data in body.items():
+            f.seek(offset)
+            f.write(data)
+
+
+@pytest.fixture
+def image(tmp_path):
+    size = 5 * 1024 * 1024 + 1000  # the last cluster is cut off by the end of the disk
+    text = b"nomadsky " * (cluster_size // 9 + 1)
+    clusters = {
+        0: ("data", os.urandom(cluster_size)),
+        cluster_size: ("data", os.urandom(cluster_size)),  # joined with the first one
+        3 * cluster_size: ("deflate", text[:cluster_size]),
+        4 * cluster_size: ("zero", b""),
+        4 * 1024 * 1024 - cluster_size: ("data", os.urandom(cluster_size)),  # in the second L2 table, up to a block
+        4 * 1024 * 1024: ("data", os.urandom(cluster_size)),  # after the 4 MiB block boundary
+        size - size % cluster_size: ("deflate", text[:cluster_size]),
+    }
+    disk = bytearray(size)
+    for guest, (kind, data) in clusters.items():
+        if kind != "zero":
+            disk[guest:guest + cluster_size] = data[:size - guest]
+    path = str(tmp_path / "disk.qcow2")
+    build_qcow2(path, size, clusters)
+    return path, bytes(disk), size
+
+
+def test_extents_skip_unallocated_and_zero_clusters(image):
+    path, disk, size = image
+    tail = size - size % cluster_size
+    with qcow2_reader.Qcow2Image(path) as qcow2:
+        assert qcow2.size == size
+        assert qcow2.extents() == [
+            (0, 2 * cluster_size),
+            (3 * cluster_size, cluster_size),
+            (4 * 1024 * 1024 - cluster_size, 2 * cluster_size),
+            (tail, size - tail),
+        ]
+        assert qcow2.allocated_bytes() == 5 * cluster_size + size - tail
+
+
+def test_blocks_do_not_cross_block_size(image):
+    path, disk, size = image
+    with qcow2_reader.Qcow2Image(path) as qcow2:
+        blocks = list(qcow2.blocks())
+    for offset, data in blocks:
+        assert offset // qcow2_reader.block_size == (offset + len(data) - 1) // qcow2_reader.block_size
+        assert data == disk[offset:offset + len(data)]
+    assert (4 * 1024 * 1024, disk[4 * 1024 * 1024:4 * 1024 * 1024 + cluster_size]) in blocks
+
+
+def test_to_raw_round_trip(image, tmp_path):
+    path, disk, size = image
+    output = str(tmp_path / "disk.raw")
+    with qcow2_reader.Qcow2Image(path) as qcow2:
+        written = qcow2.to_raw(output)
+    assert written == 5 * cluster_size + size % cluster_size
+    assert open(output, "rb").read() == disk
+
+
+def test_fixed_vhd_ends_with_a_footer(image):
+    path, disk, size = image
+    with qcow2_reader.Qcow2Image(path) as qcow2:
+        vhd_size, blocks = qcow2.fixed_vhd()
+        blocks = list(blocks)
+    disk_size = vhd_format.aligned_size(size)
+    assert vhd_size == disk_size + vhd_format.footer_size
+    offset, footer = blocks[-1]
+    assert offset == disk_size
+    assert vhd_format.parse_footer(footer)['current_size'] == disk_size
+
+
+def test_backing_file_is_left_to_qemu(tmp_path):
+    path = str(tmp_path / "overlay.qcow2")
+    build_qcow2(path, 1024 * 1024, {0: ("data", os.urandom(cluster_size))}, backing=True)
+    assert qcow2_reader.is_qcow2(path)
+    assert not qcow2_reader.supported(path)
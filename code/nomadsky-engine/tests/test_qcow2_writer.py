@@ -0,0 +1,152 @@
+import os
+import struct
+
+import pytest
+
+import qcow2_writer
+import qcow2_reader
+import vhd_format
+
+cluster_size = qcow2_writer.cluster_size
+
+
+def check_refcounts(path):
+    """Every cluster the header, L1/L2 tables, data and refcount structures use has refcount 1, no other has."""
+    data = open(path, "rb").read()
+    header = struct.unpack(qcow2_writer._header, data[:104])
+    cluster_bits, l1_size, l1_offset, table_offset, table_clusters = header[4], header[7], header[8], header[9], header[10]
+    counts = {}
+
+    def add(offset, length):
+        for index in range(offset >> cluster_bits, ((offset + length - 1) >> cluster_bits) + 1):
+            counts[index] = counts.get(index, 0) + 1
+
+    add(0, cluster_size)
+    add(l1_offset, l1_size * 8)
+    shift = 62 - (cluster_bits - 8)
+    for l1_entry in struct.unpack(f">{l1_size}Q", data[l1_offset:l1_offset + l1_size * 8]):
+        if not l1_entry:
+            continue
+        assert l1_entry & qcow2_writer._copied
+        table = l1_entry & qcow2_reader._offset_mask
+        add(table, cluster_size)
+        for entry in struct.unpack(f">{cluster_size // 8}Q", data[table:table + cluster_size]):
+            if entry & qcow2_writer._compressed:
+                host = entry & ((1 << shift) - 1)
+                sectors = (entry >> shift) & ((1 << (cluster_bits - 8)) - 1)
+                add(host, (sectors + 1) * 512 - (host & 511))
+            elif entry:
+                assert entry & qcow2_writer._copied
+                add(entry & qcow2_reader._offset_mask, cluster_size)
+    add(table_offset, table_clusters * cluster_size)
+    blocks = [offset for offset in struct.unpack(f">{table_clusters * cluster_size // 8}Q",
+                                                 data[table_offset:table_offset + table_clusters * cluster_size]) if offset]
+    stored = {}
+    for index, offset in enumerate(blocks):
+        add(offset, cluster_size)
+        for position, count in enumerate(struct.unpack(f">{cluster_size // 2}H", data[offset:offset + cluster_size])):
+            if count:
+                stored[index * (cluster_size // 2) + position] = count
+    assert stored == counts
+
+
+@pytest.fixture
+def raw_disk(tmp_path):
+    size = 40 * cluster_size + 12345  # the last cluster is cut off by the end of the disk
+    text = b"nomadsky migration " * (cluster_size // 19 + 1)
+    disk = bytearray(size)
+    disk[0:3 * cluster_size] = (text * 3)[:3 * cluster_size]  # compresses well
+    disk[5 * cluster_size:6 * cluster_size] = os.urandom(cluster_size)  # does not compress, stored as it is
+    disk[7 * cluster_size + 100:7 * cluster_size + 200] = b"x" * 100  # a few bytes in an otherwise empty cluster
+    disk[size - 50:] = b"y" * 50  # the tail cluster
+    path = str(tmp_path / "disk.raw")
+    with open(path, "wb") as f:
+        f.write(disk)
+    return path, bytes(disk), size
+
+
+def read_back(path, tmp_path):
+    output = str(tmp_path / "back.raw")
+    with qcow2_reader.Qcow2Image(path) as image:
+        extents = image.extents()
+        image.to_raw(output)
+    return open(output, "rb").read(), extents
+
+
+@pytest.mark.parametrize("compression", ["zlib", None])
+def test_round_trip(raw_disk, tmp_path, compression):
+    path, disk, size = raw_disk
+    output = str(tmp_path / "disk.qcow2")
+    _, extents = qcow2_writer.source(path, "raw")
+    stats = qcow2_writer.write(output, size, qcow2_writer.clusters(extents, size), compression, processes=2)
+    check_refcounts(output)
+    data, allocated = read_back(output, tmp_path)
+    assert data == disk
+    # the zero clusters are left out
+    assert allocated == [(0, 3 * cluster_size), (5 * cluster_size, cluster_size), (7 * cluster_size, cluster_size),
+                         (40 * cluster_size, 12345)]
+    assert stats['allocated'] == 6 * cluster_size
+    if compression:
+        assert stats['compressed'] == 5  # all but the random cluster
+        assert stats['size'] < os.path.getsize(path) // 4
+    else:
+        assert stats['compressed'] == 0
+
+
+def test_sparse_disk_has_no_clusters(tmp_path):
+    output = str(tmp_path / "empty.qcow2")
+    size = 3 * 1024**3  # the L1 table spans several L2 tables
+    stats = qcow2_writer.write(output, size, iter(()), "zlib", processes=1)
+    check_refcounts(output)
+    with qcow2_reader.Qcow2Image(output) as image:
+        assert image.size == size
+        assert image.extents() == []
+    assert stats['allocated'] == 0
+
+
+def test_clusters_must_be_in_disk_order():
+    with pytest.raises(Exception):
+        list(qcow2_writer.clusters([(2 * cluster_size, b"a"), (0, b"b")], 3 * cluster_size))
+
+
+def test_convert_from_fixed_vhd(raw_disk, tmp_path):
+    path, disk, size = raw_disk
+    vhd_format.raw_to_vhd_in_place(path)
+    output = str(tmp_path / "disk.qcow2")
+    # a slow link: compression pays
+    stats = qcow2_writer.convert(path, output, "vhd", "zlib", upload_speed=1024**2, processes=2)
+    assert stats['compression'] == "zlib"
+    check_refcounts(output)
+    data, _ = read_back(output, tmp_path)
+    padded = vhd_format.aligned_size(size)
+    assert data == disk + bytes(padded - size)
+
+
+def test_convert_skips_compression_on_a_fast_link(raw_disk, tmp_path):
+    path, disk, size = raw_disk
+    output = str(tmp_path / "disk.qcow2")
+    stats = qcow2_writer.convert(path, output, "raw", "zlib", upload_speed=1024**4, processes=1)
+    assert stats['compression'] is None
+    assert stats['compressed'] == 0
+    data, _ = read_back(output, tmp_path)
+    assert data == disk
+
+
+def test_qcow2_to_qcow2(raw_disk, tmp_path):
+    path, disk, size = raw_disk
+    first = str(tmp_path / "first.qcow2")
+    qcow2_writer.convert(path, first, "raw", None)
+    second = str(tmp_path / "second.qcow2")
+    stats = qcow2_writer.convert(first, second, "qcow2", "zlib", upload_speed=1024**2, processes=2)
+    assert stats['compression'] == "zlib"
+    check_refcounts(second)
+    data, _ = read_back(second, tmp_path)
+    assert data == disk
+
+
+def test_worth_compressing():
+    # 1 GB/s on four cores against a 10 MB/s link: half the bytes is twice as fast
+    assert qcow2_writer.worth_compressing(0.5, 250e6, 4, 10e6)
+    # the link is faster than the cores
+    assert not qcow2_writer.worth_compressing(0.5, 10e6, 1, 1e9)
+    assert not qcow2_writer.worth_compressing(1.0, 250e6, 4, 10e6)
@@ -0,0 +1,145 @@
+import os
+import json
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+import ranged_download
+import integrity
+
+
+class RangeServer:
+    """A local HTTP server for one object, with Range support, a log of the ranges asked and optional failures."""
+
+    def __init__(self, data, delay=0.0):
+        self.data = data
+        self.delay = delay
+        self.requests = []
+        self.fail = set()  # starts of ranges that fail once
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_HEAD(self):
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(server.data)))
+                self.end_headers()
+
+            def do_GET(self):
+                header = self.headers.get("Range")
+                start, end = (int(value) for value in header.split("=")[1].split("-"))
+                with server.lock:
+                    server.requests.append((start, end))
+                    server.active += 1
+                    server.max_active = max(server.max_active, server.active)
+                    failing = start in server.fail
+                    server.fail.discard(start)
+                try:
+                    time.sleep(server.delay)
+                    if failing:
+                        self.send_response(503)
+                        self.send_header("Content-Length", "0")
+                        self.end_headers()
+                        return
+                    body = server.data[start:end + 1]
+                    self.send_response(206)
+                    self.send_header("Content-Range", f"bytes {start}-{end}/{len(server.data)}")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                finally:
+                    with server.lock:
+                        server.active -= 1
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}/disk.vhd"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def disk():
+    data = os.urandom(1024 * 1024) + bytes(2 * 1024 * 1024) + os.urandom(512 * 1024 + 512)
+    server = RangeServer(data, delay=0.05)
+    yield server
+    server.close()
+
+
+def test_parallel_ranges(disk, tmp_path):
+    output = str(tmp_path / "disk.vhd")
+    size = ranged_download.download(disk.url, output, connections=4, range_size=256 * 1024, retry_wait=0)
+    assert size == len(disk.data)
+    assert open(output, "rb").read() == disk.data
+    assert sorted(disk.requests) == ranged_download.split_ranges(len(disk.data), 256 * 1024)
+    assert disk.max_active > 1
+    assert not ranged_download.is_partial(output)
+    assert integrity.read_manifest(output)['root']
+
+
+def test_failed_range_is_retried_alone(disk, tmp_path):
+    output = str(tmp_path / "disk.vhd")
+    disk.fail.add(512 * 1024)
+    ranged_download.download(disk.url, output, connections=4, range_size=256 * 1024, retry_wait=0)
+    assert open(output, "rb").read() == disk.data
+    starts = [start for start, _ in disk.requests]
+    assert starts.count(512 * 1024) == 2
+    assert len(starts) == len(ranged_download.split_ranges(len(disk.data), 256 * 1024)) + 1
+
+
+def test_resume_from_ranges_file(disk, tmp_path):
+    output = str(tmp_path / "disk.vhd")
+    range_size = 256 * 1024
+    pieces = ranged_download.split_ranges(len(disk.data), range_size)
+    done = [start for start, _ in pieces[:5]]
+    # an interrupted download: the first ranges are in the file and in the state file, the rest is missing
+    with open(output, "wb") as f:
+        f.truncate(len(disk.data))
+        f.write(disk.data[:5 * range_size])
+    with open(ranged_download.state_path(output), "w") as f:
+        json.dump({'size': len(disk.data), 'range_size': range_size, 'done': done}, f)
+    assert ranged_download.is_partial(output)
+
+    ranged_download.download(disk.url, output, connections=4, range_size=range_size, retry_wait=0)
+    assert open(output, "rb").read() == disk.data
+    assert sorted(disk.requests) == pieces[5:]
+    assert not ranged_download.is_partial(output)
+
+
+def test_allocated_ranges_and_footer(disk, tmp_path):
+    # an Azure page blob: the allocated pages and the 512 byte VHD footer at the end, the rest stays a hole
+    output = str(tmp_path / "disk.vhd")
+    size = len(disk.data)
+    footer = (size - 512, size - 1)
+    ranges = [(0, 1024 * 1024 - 1), (3 * 1024 * 1024, size - 513), footer]
+    ranged_download.download(disk.url, output, size=size, ranges=ranges, connections=4,
+                             range_size=256 * 1024, retry_wait=0)
+    data = open(output, "rb").read()
+    assert len(data) == size
+    assert data[-512:] == disk.data[-512:]
+    assert data == disk.data
+    # the zero part in between was never asked for
+    assert all(end < 1024 * 1024 or start >= 3 * 1024 * 1024 for start, end in disk.requests)
+    assert max(end for _, end in disk.requests) == size - 1
+
+
+def test_footer_range_alone(disk, tmp_path):
+    output = str(tmp_path / "disk.vhd")
+    size = len(disk.data)
+    ranged_download.download(disk.url, output, size=size, ranges=[(size - 512, size - 1)], connections=2,
+                             retry_wait=0)
+    data = open(output, "rb").read()
+    assert disk.requests == [(size - 512, size - 1)]
+    assert data[-512:] == disk.data[-512:]
+    assert data[:-512] == bytes(size - 512)
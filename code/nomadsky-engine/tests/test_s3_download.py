@@ -0,0 +1,141 @@
+# The S3 export download of Amazon/downloading_vm.py against a local S3 stand-in
+import os
+import sys
+import types
+
+import pytest
+
+boto3 = pytest.importorskip("boto3")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "Amazon"))
+import config
+import downloading_vm
+import integrity
+import migration_ledger
+import ranged_download
+from s3_stand_in import S3StandIn
+
+part = 8 * 1024 * 1024  # the smallest part of s3_transfer_config()
+bucket, key = "my-disk-export-bucket", "exports/web01.vhd"
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    for name in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"):
+        monkeypatch.setenv(name, "testing")
+    data = os.urandom(5 * part + 123)
+    server = S3StandIn({(bucket, key): data}, latency=0.02)
+    monkeypatch.setattr(config, "s3_endpoint_url", server.url)
+    monkeypatch.setattr(config, "s3_bucket_name", bucket)
+    monkeypatch.setattr(config, "s3_multipart_chunksize", part)
+    monkeypatch.setattr(config, "s3_max_concurrency", 4)
+    # the failed parts are tried again right away
+    monkeypatch.setattr(ranged_download, "time", types.SimpleNamespace(sleep=lambda seconds: None))
+    yield server, data
+    server.close()
+
+
+def test_ranged_download_is_hashed_and_verified(s3, tmp_path):
+    server, data = s3
+    client = downloading_vm.s3_client(boto3.Session(), "eu-west-1")
+    output = str(tmp_path / "web01.vhd")
+    assert downloading_vm.download_export(client, bucket, key, output) == len(data)
+    assert open(output, "rb").read() == data
+    manifest = integrity.read_manifest(output)
+    assert manifest['verified'] == ['md5']
+    assert not ranged_download.is_partial(output)
+    # ranged parts of the configured size, several at the same time
+    assert sorted(start for start, _ in server.requests) == list(range(0, len(data), part))
+    assert server.max_active > 1
+
+
+def test_parts_shrink_so_every_connection_has_one(monkeypatch):
+    monkeypatch.setattr(config, "s3_multipart_chunksize", 64 * 1024 * 1024)
+    monkeypatch.setattr(config, "s3_max_concurrency", 16)
+    assert downloading_vm.s3_transfer_config(100 * 1024**3).multipart_chunksize == 64 * 1024 * 1024
+    assert downloading_vm.s3_transfer_config(256 * 1024**2).multipart_chunksize == 16 * 1024 * 1024
+    assert downloading_vm.s3_transfer_config(20 * 1024**2).multipart_chunksize == 8 * 1024 * 1024
+
+
+class ExportedInstance:
+    """
+    The EC2 calls of an export download for a stopped instance whose export is already in S3;
+    moto has no instance export tasks.
+    """
+
+    def __init__(self):
+        self.exports = 0
+        self.deleted_snapshots = []
+
+    def describe_instances(self, InstanceIds):
+        instance = {'InstanceId': InstanceIds[0], 'State': {'Name': 'stopped'}, 'RootDeviceName': '/dev/xvda',
+                    'BlockDeviceMappings': [{'DeviceName': '/dev/xvda', 'Ebs': {'VolumeId': 'vol-1'}}]}
+        return {'Reservations': [{'Instances': [instance]}]}
+
+    def describe_volumes(self, VolumeIds):
+        return {'Volumes': [{'VolumeId': VolumeIds[0], 'Size': 8}]}
+
+    def create_snapshot(self, **arguments):
+        return {'SnapshotId': 'snap-1'}
+
+    def describe_snapshots(self, SnapshotIds):
+        return {'Snapshots': [{'SnapshotId': SnapshotIds[0], 'State': 'completed'}]}
+
+    def delete_snapshot(self, SnapshotId):
+        self.deleted_snapshots.append(SnapshotId)
+
+    def create_instance_export_task(self, **arguments):
+        self.exports += 1
+        return {'ExportTask': {'ExportTaskId': 'export-1'}}
+
+    def describe_export_tasks(self, ExportTaskIds):
+        return {'ExportTasks': [{'ExportTaskId': ExportTaskIds[0], 'State': 'completed',
+                                 'ExportToS3Task': {'S3Bucket': bucket, 'S3Key': key}}]}
+
+
+@pytest.fixture
+def exported_instance(s3, tmp_path, monkeypatch):
+    ec2 = ExportedInstance()
+    session = boto3.Session()
+
+    class Session:
+        def client(self, service, *args, **kwargs):
+            return ec2 if service == "ec2" else session.client(service, *args, **kwargs)
+
+    monkeypatch.setattr(boto3, "Session", Session)
+    monkeypatch.setattr(config, "download_method", "export")
+    monkeypatch.setattr(config, "download_path", str(tmp_path))
+    monkeypatch.setattr(sys, "argv", ["download_vm.py", "aws", "azure", "web01", "{}", "job-1"])
+    migration_ledger.use_job("job-1")
+    return ec2, {'region': "eu-west-1", 'resource_id': "i-1"}
+
+
+def test_failed_download_keeps_the_export_and_continues(s3, exported_instance):
+    server, data = s3
+    ec2, shared_data = exported_instance
+    server.fail_after = 2
+    with pytest.raises(Exception, match="is kept to continue"):
+        downloading_vm.download_aws_osdisk(shared_data)
+    # nothing of the export is cleaned up, the retry of the step needs it
+    assert (bucket, key) in server.objects
+    assert migration_ledger.find_artifact('export_task_id') == "export-1"
+    assert migration_ledger.find_artifact('s3_key') == f"s3://{bucket}/{key}"
+    assert migration_ledger.find_artifact('snapshot_id') == "snap-1"
+    assert ec2.deleted_snapshots == []
+    finished = {start for start, _ in server.requests}
+    assert len(finished) == 2
+
+    server.fail_after = None
+    server.requests.clear()
+    result = downloading_vm.download_aws_osdisk(shared_data)
+    assert ec2.exports == 1
+    # only the parts that were missing are fetched again
+    assert {start for start, _ in server.requests} == set(range(0, len(data), part)) - finished
+    assert open(result['output_path'], "rb").read() == data
+    assert integrity.read_manifest(result['output_path'])['verified'] == ['md5']
+    assert not os.path.exists(result['output_path'] + ".part")
+    # the export and the snapshot are cleaned up and cleared from the ledger
+    assert (bucket, key) not in server.objects
+    assert ec2.deleted_snapshots == ["snap-1"]
+    for kind in ('snapshot_id', 'export_task_id', 's3_key'):
+        assert migration_ledger.find_artifact(kind) is None
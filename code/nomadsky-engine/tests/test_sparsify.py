@@ -0,0 +1,360 @@
+import io
+import os
+import shutil
+import struct
+import subprocess
+
+import pytest
+
+import sparsify
+
+block = 4096  # the block size of the ext and XFS images and the cluster size of the NTFS images
+sector = 512
+mib = 1024 * 1024
+
+
+def garbage(length):
+    # old data: everything that is not written as metadata below, used and free blocks alike
+    return bytearray(os.urandom(length))
+
+
+def sparsified(disk):
+    f = io.BytesIO(bytes(disk))
+    ranges, report = sparsify.free_ranges(f, len(disk))
+    sparsify.zero_ranges(f, ranges)
+    return sorted(ranges), report, f.getvalue()
+
+
+def with_zeros(disk, ranges):
+    expected = bytearray(disk)
+    for offset, length in ranges:
+        expected[offset:offset + length] = bytes(length)
+    return bytes(expected)
+
+
+def moved(ranges, start):
+    return [(start + offset, length) for offset, length in ranges]
+
+
+# -------------------------------
+# ext4: one group of 256 blocks, blocks 16-47 and 72-255 free, block 70 used in a byte of free blocks
+# -------------------------------
+ext_free = [(16 * block, 32 * block), (72 * block, 184 * block)]
+
+
+def build_ext(incompat=0, state=1):
+    blocks = 256
+    fs = garbage(blocks * block)
+    sb = bytearray(1024)
+    struct.pack_into("<IIIIIIII", sb, 0, 64, blocks, 0, 0, 0, 0, 2, 2)  # 1024 << 2: blocks of 4 KiB
+    struct.pack_into("<I", sb, 32, 32768)
+    sb[56:58] = b"\x53\xef"
+    struct.pack_into("<H", sb, 58, state)
+    struct.pack_into("<I", sb, 96, incompat)
+    fs[0:block] = bytes(1024) + sb + bytes(2048)
+    fs[block:2 * block] = struct.pack("<III", 2, 3, 4).ljust(block, b"\0")  # the descriptor of group 0
+    bitmap = bytearray(b"\xff" * block)  # the bits after the last block are set, as mke2fs does
+    bitmap[:blocks // 8] = bytes(blocks // 8)
+    for used in list(range(0, 16)) + list(range(48, 64)) + [70]:
+        bitmap[used // 8] |= 1 << (used % 8)
+    fs[2 * block:3 * block] = bitmap
+    return fs
+
+
+# -------------------------------
+# XFS (version 4): two allocation groups of 128 blocks, the log in blocks 8-9 of group 0
+# -------------------------------
+xfs_free = [(32 * block, 32 * block), ((128 + 16) * block, 112 * block)]
+
+
+def build_xfs(clean=True):
+    ag_blocks, log_block, log_blocks = 128, 8, 2
+    fs = garbage(2 * ag_blocks * block)
+    for ag, (first, count) in enumerate([(32, 32), (16, 112)]):
+        ag_start = ag * ag_blocks * block
+        agf = bytearray(sector)
+        agf[0:4] = b"XAGF"
+        struct.pack_into(">IIII", agf, 4, 1, ag, ag_blocks, 1)  # the free space by block btree is in block 1
+        struct.pack_into(">I", agf, 28, 1)
+        fs[ag_start:ag_start + block] = bytes(sector) + agf + bytes(block - 2 * sector)
+        leaf = bytearray(block)
+        leaf[0:4] = b"ABTB"
+        struct.pack_into(">HHii", leaf, 4, 0, 1, -1, -1)  # a single leaf, no siblings
+        struct.pack_into(">II", leaf, 16, first, count)
+        fs[ag_start + block:ag_start + 2 * block] = leaf
+    sb = bytearray(sector)
+    sb[0:4] = b"XFSB"
+    struct.pack_into(">IQ", sb, 4, block, 2 * ag_blocks)
+    struct.pack_into(">Q", sb, 48, log_block)
+    struct.pack_into(">III", sb, 84, ag_blocks, 2, 0)
+    struct.pack_into(">IHH", sb, 96, log_blocks, 4, sector)
+    sb[124] = 7  # log2 of the blocks per group
+    fs[0:sector] = sb
+
+    # a record header and its operation: an unmount record when clean, a transaction otherwise
+    log = bytearray(log_blocks * block)
+    lsn = 1 << 32  # cycle 1, block 0
+    struct.pack_into(">4sIIIQQ", log, 0, b"\xfe\xed\xba\xbe", 1, 1, sector, lsn, lsn)
+    struct.pack_into(">I", log, 40, 1)
+    struct.pack_into(">I", log, sector, 1)
+    log[sector + 9] = 0x20 if clean else 0x01
+    fs[log_block * block:(log_block + log_blocks) * block] = log
+    return fs
+
+
+# -------------------------------
+# NTFS: 256 clusters, $MFT in clusters 4-11, $Bitmap 12, $LogFile 16-17, an index block 20, hiberfil.sys 24;
+# clusters 48-79 and 88-255 free
+# -------------------------------
+record_size = 1024
+ntfs_free = [(48 * block, 32 * block), (88 * block, 168 * block)]
+
+
+def protect(data, magic, usa_offset):
+    # the update sequence array: the last two bytes of every 512 byte stride move there
+    data = bytearray(data)
+    count = len(data) // 512 + 1
+    data[0:4] = magic
+    struct.pack_into("<HH", data, 4, usa_offset, count)
+    data[usa_offset:usa_offset + 2] = b"\x07\x00"
+    for index in range(1, count):
+        end = index * 512
+        data[usa_offset + 2 * index:usa_offset + 2 * index + 2] = data[end - 2:end]
+        data[end - 2:end] = b"\x07\x00"
+    return bytes(data)
+
+
+def resident(attribute_type, value):
+    length = -(-(24 + len(value)) // 8) * 8
+    attribute = bytearray(length)
+    struct.pack_into("<IIBBHHHIH", attribute, 0, attribute_type, length, 0, 0, 0, 0, 0, len(value), 24)
+    attribute[24:24 + len(value)] = value
+    return bytes(attribute)
+
+
+def non_resident(attribute_type, extents, size):
+    runs = b""
+    previous = 0
+    for first, count in extents:
+        runs += b"\x44" + count.to_bytes(4, "little") + (first - previous).to_bytes(4, "little", signed=True)
+        previous = first
+    runs += b"\0"
+    length = -(-(64 + len(runs)) // 8) * 8
+    clusters = sum(count for _, count in extents)
+    attribute = bytearray(length)
+    struct.pack_into("<IIBBHHH", attribute, 0, attribute_type, length, 1, 0, 0, 0, 0)
+    struct.pack_into("<QQH", attribute, 16, 0, clusters - 1, 64)
+    struct.pack_into("<QQQ", attribute, 40, clusters * block, size, size)
+    attribute[64:64 + len(runs)] = runs
+    return bytes(attribute)
+
+
+def mft_record(*attributes):
+    record = bytearray(record_size)
+    struct.pack_into("<H", record, 20, 56)
+    body = b"".join(attributes) + b"\xff\xff\xff\xff"
+    record[56:56 + len(body)] = body
+    return protect(record, b"FILE", 48)
+
+
+def restart_page(lsn, clean, magic=b"RSTR"):
+    page = bytearray(block)
+    struct.pack_into("<QIIHHH", page, 8, 0, block, block, 48, 1, 1)
+    struct.pack_into("<QHHHH", page, 48, lsn, 1, 0xFFFF, 0xFFFF if clean else 0, 0)
+    return protect(page, magic, 30)
+
+
+def index_entry(reference, name):
+    key = bytearray(66)
+    key[64] = len(name)
+    key[65] = 1  # the Win32 name
+    key += name.encode("utf-16-le")
+    length = -(-(16 + len(key)) // 8) * 8
+    return struct.pack("<QHHI", reference, length, len(key), 0) + bytes(key).ljust(length - 16, b"\0")
+
+
+def build_ntfs(dirty=False, log=None, hiberfil=None, in_allocation=False):
+    clusters = 256
+    fs = garbage(clusters * block)
+    boot = bytearray(block)
+    boot[0:11] = b"\xebR\x90NTFS    "
+    struct.pack_into("<HB", boot, 11, sector, block // sector)
+    struct.pack_into("<QQQb", boot, 40, clusters * block // sector, 4, 2, -10)  # records of 1 << 10 bytes
+    boot[510:512] = b"\x55\xaa"
+    fs[0:block] = boot
+
+    entries = index_entry(4 | 4 << 48, "$AttrDef")
+    if hiberfil is not None:
+        entries += index_entry(30 | 1 << 48, "hiberfil.sys")
+        fs[24 * block:25 * block] = hiberfil.ljust(block, b"\0")
+    entries += struct.pack("<QHHI", 0, 16, 0, 2)
+    if in_allocation:
+        # the names are in an index block, the root only points to it
+        index_block = bytearray(block)
+        struct.pack_into("<IIIB", index_block, 24, 40, 40 + len(entries), block - 24, 0)
+        index_block[64:64 + len(entries)] = entries
+        fs[20 * block:21 * block] = protect(index_block, b"INDX", 40)
+        root_entries = struct.pack("<QHHIQ", 0, 24, 0, 3, 0)
+        root = [resident(0x90, struct.pack("<IIIB3xIIIB3x", 0x30, 1, block, 1, 16, 16 + len(root_entries),
+                                           16 + len(root_entries), 1) + root_entries),
+                non_resident(0xA0, [(20, 1)], block)]
+    else:
+        root = [resident(0x90, struct.pack("<IIIB3xIIIB3x", 0x30, 1, block, 1, 16, 16 + len(entries),
+                                           16 + len(entries), 0) + entries)]
+
+    records = {
+        0: mft_record(non_resident(0x80, [(4, 8)], 8 * block)),
+        2: mft_record(non_resident(0x80, [(16, 2)], 2 * block)),
+        3: mft_record(resident(0x70, struct.pack("<8xBBH", 3, 1, 0x0001 if dirty else 0))),
+        5: mft_record(*root),
+        6: mft_record(non_resident(0x80, [(12, 1)], clusters // 8)),
+        30: mft_record(non_resident(0x80, [(24, 1)], block)),
+    }
+    mft = bytearray(8 * block)
+    for number, record in records.items():
+        mft[number * record_size:(number + 1) * record_size] = record
+    fs[4 * block:12 * block] = mft
+
+    bitmap = bytearray(block)
+    bitmap[0:6] = b"\xff" * 6
+    bitmap[10] = 0x01
+    fs[12 * block:13 * block] = bitmap
+    fs[16 * block:18 * block] = log if log is not None else restart_page(5, True) + restart_page(6, True)
+    return fs
+
+
+# -------------------------------
+# partition tables
+# -------------------------------
+def mbr_entry(partition_type, first_lba, sectors):
+    return struct.pack("<4xB3xII", partition_type, first_lba, sectors)
+
+
+def boot_record(*entries):
+    record = bytearray(sector)
+    for index, entry in enumerate(entries):
+        record[446 + 16 * index:462 + 16 * index] = entry
+    record[510:512] = b"\x55\xaa"
+    return bytes(record)
+
+
+def place(disk, lba, data):
+    disk[lba * sector:lba * sector + len(data)] = data
+
+
+def build_mbr_disk():
+    """ext in a primary partition, XFS and NTFS in logical partitions, then a swap partition."""
+    disk = garbage(9216 * sector)
+    disk[0:mib] = bytes(mib)
+    place(disk, 0, boot_record(mbr_entry(0x83, 2048, 2048), mbr_entry(0x05, 4096, 4608), mbr_entry(0x82, 8704, 256)))
+    place(disk, 4096, boot_record(mbr_entry(0x83, 128, 2048), mbr_entry(0x05, 2304, 2176)))
+    place(disk, 6400, boot_record(mbr_entry(0x07, 128, 2048)))
+    place(disk, 2048, build_ext())
+    place(disk, 4224, build_xfs())
+    place(disk, 6528, build_ntfs())
+    return disk, moved(ext_free, 2048 * sector) + moved(xfs_free, 4224 * sector) + moved(ntfs_free, 6528 * sector)
+
+
+def build_gpt_disk():
+    """ext, XFS and NTFS in GPT partitions, then a partition of an unknown type."""
+    disk = garbage(8704 * sector)
+    disk[0:mib] = bytes(mib)
+    place(disk, 0, boot_record(mbr_entry(0xEE, 1, 8703)))
+    header = bytearray(sector)
+    header[0:8] = b"EFI PART"
+    struct.pack_into("<QII", header, 72, 2, 128, 128)
+    place(disk, 1, header)
+    for index, (first, last) in enumerate([(2048, 4095), (4096, 6143), (6144, 8191), (8192, 8447)]):
+        entry = 2 * sector + index * 128
+        disk[entry:entry + 48] = os.urandom(32) + struct.pack("<QQ", first, last)
+    place(disk, 2048, build_ext())
+    place(disk, 4096, build_xfs())
+    place(disk, 6144, build_ntfs())
+    return disk, moved(ext_free, 2048 * sector) + moved(xfs_free, 4096 * sector) + moved(ntfs_free, 6144 * sector)
+
+
+# -------------------------------
+# tests
+# -------------------------------
+@pytest.mark.parametrize("build, free, file_system", [
+    (build_ext, ext_free, "ext"),
+    (build_xfs, xfs_free, "xfs"),
+    (build_ntfs, ntfs_free, "ntfs"),
+])
+def test_whole_disk_file_system_only_free_extents_are_zeroed(build, free, file_system):
+    disk = build()
+    ranges, report, result = sparsified(disk)
+    assert ranges == free
+    assert report == [{'start': 0, 'file_system': file_system, 'free_bytes': sum(length for _, length in free)}]
+    assert result == with_zeros(disk, free)
+
+
+@pytest.mark.parametrize("build_disk", [build_mbr_disk, build_gpt_disk])
+def test_partitioned_disk_only_free_extents_are_zeroed(build_disk):
+    disk, free = build_disk()
+    ranges, report, result = sparsified(disk)
+    assert ranges == sorted(free)
+    assert [entry['file_system'] for entry in report] == ["ext", "xfs", "ntfs"]
+    assert result == with_zeros(disk, free)  # the unknown partition and all used blocks are left as they were
+
+
+@pytest.mark.parametrize("fs", [
+    pytest.param(lambda: build_ext(incompat=0x4), id="ext journal to replay"),
+    pytest.param(lambda: build_ext(state=0x2), id="ext with errors"),
+    pytest.param(lambda: build_xfs(clean=False), id="xfs log not clean"),
+    pytest.param(lambda: build_ntfs(dirty=True), id="ntfs dirty"),
+    pytest.param(lambda: build_ntfs(log=restart_page(5, False) + restart_page(4, True)), id="ntfs log in use"),
+    pytest.param(lambda: build_ntfs(log=restart_page(5, True) + restart_page(6, False)), id="ntfs newest restart area"),
+    pytest.param(lambda: build_ntfs(log=restart_page(5, True, b"CHKD") + restart_page(6, True)), id="ntfs chkdsk"),
+    pytest.param(lambda: build_ntfs(hiberfil=b"hibr"), id="ntfs hibernated"),
+    pytest.param(lambda: build_ntfs(hiberfil=b"HIBR"), id="ntfs fast startup"),
+    pytest.param(lambda: build_ntfs(hiberfil=b"hibr", in_allocation=True), id="ntfs hibernated, index block"),
+])
+def test_unclean_file_system_is_skipped(fs):
+    disk = fs()
+    ranges, report, result = sparsified(disk)
+    assert ranges == []
+    assert report == []
+    assert result == bytes(disk)
+
+
+@pytest.mark.parametrize("fs", [
+    pytest.param(lambda: build_ntfs(log=b"\xff" * (2 * block)), id="empty log"),
+    pytest.param(lambda: build_ntfs(log=restart_page(5, False) + restart_page(6, True)), id="newest restart area clean"),
+    pytest.param(lambda: build_ntfs(hiberfil=b"wake"), id="hiberfil after resume"),
+    pytest.param(lambda: build_ntfs(hiberfil=b"", in_allocation=True), id="hiberfil cleared, index block"),
+])
+def test_clean_ntfs_is_sparsified(fs):
+    disk = fs()
+    ranges, _, result = sparsified(disk)
+    assert ranges == ntfs_free
+    assert result == with_zeros(disk, ntfs_free)
+
+
+def test_sparsify_raw_image(tmp_path):
+    disk, free = build_gpt_disk()
+    path = str(tmp_path / "disk.raw")
+    with open(path, "wb") as f:
+        f.write(disk)
+    result = sparsify.sparsify(path)
+    assert result['free_bytes'] == result['zeroed_bytes'] == sum(length for _, length in free)
+    assert open(path, "rb").read() == with_zeros(disk, free)
+    assert sparsify.sparsify(path)['zeroed_bytes'] == 0
+
+
+@pytest.mark.skipif(not all(shutil.which(tool) for tool in ("mkfs.ext4", "debugfs", "e2fsck")),
+                    reason="e2fsprogs is not installed")
+def test_mkfs_ext4_image_stays_consistent(tmp_path):
+    image = tmp_path / "disk.raw"
+    image.write_bytes(os.urandom(16 * mib))
+    subprocess.run(["mkfs.ext4", "-q", "-F", "-b", "4096", "-E", "nodiscard", str(image)], check=True)
+    content = os.urandom(3 * mib)
+    (tmp_path / "data").write_bytes(content)
+    subprocess.run(["debugfs", "-w", "-R", f"write {tmp_path / 'data'} data", str(image)], check=True,
+                   capture_output=True)
+    result = sparsify.sparsify(str(image))
+    assert [entry['file_system'] for entry in result['file_systems']] == ["ext"]
+    assert result['zeroed_bytes'] > 4 * mib
+    subprocess.run(["e2fsck", "-fn", str(image)], check=True, capture_output=True)
+    subprocess.run(["debugfs", "-R", f"dump data {tmp_path / 'out'}", str(image)], check=True, capture_output=True)
+    assert (tmp_path / "out").read_bytes() == content
@@ -0,0 +1,38 @@
+import os
+
+import vhd_format
+
+
+def test_raw_to_vhd_in_place_pads_and_appends_footer(tmp_path):
+    path = str(tmp_path / "disk.raw")
+    with open(path, "wb") as f:
+        f.write(os.urandom(vhd_format.mib + 4096))
+    size, changed = vhd_format.raw_to_vhd_in_place(path)
+    assert changed
+    assert size == 2 * vhd_format.mib
+    assert os.path.getsize(path) == size + vhd_format.footer_size
+    assert vhd_format.detect_format(path) == "vhd"
+
+
+def test_aligned_vhd_is_left_alone(tmp_path):
+    path = str(tmp_path / "disk.vhd")
+    with open(path, "wb") as f:
+        f.write(os.urandom(vhd_format.mib))
+    vhd_format.raw_to_vhd_in_place(path)
+    before = open(path, "rb").read()
+    size, changed = vhd_format.raw_to_vhd_in_place(path)
+    assert not changed
+    assert size == vhd_format.mib
+    assert open(path, "rb").read() == before
+
+
+def test_vhd_to_raw_in_place_cuts_the_footer(tmp_path):
+    path = str(tmp_path / "disk.vhd")
+    data = os.urandom(vhd_format.mib)
+    with open(path, "wb") as f:
+        f.write(data)
+    vhd_format.raw_to_vhd_in_place(path)
+    size, changed = vhd_format.vhd_to_raw_in_place(path)
+    assert changed
+    assert size == vhd_format.mib
+    assert open(path, "rb").read() == data
@@ -0,0 +1,100 @@
+import os
+import zlib
+import struct
+
+import pytest
+
+import vmdk_stream
+
+sector = vmdk_stream.sector_size
+grain_sectors = 128  # 64 KiB grains
+
+
+def _marker(value, size, marker_type=0):
+    return struct.pack("<QII", value, size, marker_type).ljust(sector, b"\0")
+
+
+def build_vmdk(path, capacity, grains, end_marker=True):
+    """
+    A streamOptimized VMDK as GCP writes it: header, descriptor, then grain markers with their deflated grain,
+    a grain table after them, the grain directory, the footer and the end-of-stream marker.
+    grains is a list of (offset on the disk, data) in stream order.
+    """
+    descriptor = b"# Disk DescriptorFile\ncreateType=\"streamOptimized\"\n".ljust(sector, b"\0")
+    overhead = 2  # the header and the descriptor
+    flags = 1 | vmdk_stream._compressed_grains | vmdk_stream._markers
+    header = struct.pack(vmdk_stream._header, vmdk_stream.magic, 3, flags, -(-capacity // sector), grain_sectors,
+                         1, 1, 512, 0, 0xFFFFFFFFFFFFFFFF, overhead, 0, b"\n \r\n", vmdk_stream._deflate)
+    with open(path, "wb") as f:
+        f.write(header.ljust(sector, b"\0"))
+        f.write(descriptor)
+        for offset, data in grains:
+            packed = zlib.compress(data)
+            record = struct.pack("<QI", offset // sector, len(packed)) + packed
+            f.write(record.ljust(-(-len(record) // sector) * sector, b"\0"))
+        f.write(_marker(4, 0, vmdk_stream._grain_table) + os.urandom(4 * sector))
+        f.write(_marker(1, 0, vmdk_stream._grain_directory) + os.urandom(sector))
+        f.write(_marker(1, 0, vmdk_stream._footer) + header.ljust(sector, b"\0"))
+        if end_marker:
+            f.write(_marker(0, 0, vmdk_stream._end_of_stream))
+
+
+@pytest.fixture
+def stream(tmp_path):
+    grain = grain_sectors * sector
+    capacity = 40 * grain + 3 * sector  # the last grain is cut off by the end of the disk
+    text = b"digital nomadsky " * (grain // 17 + 1)
+    grains = [(0, os.urandom(grain)), (grain, text[:grain]), (5 * grain, text[:grain])]
+    grains += [((10 + index) * grain, os.urandom(grain)) for index in range(20)]
+    grains.append((40 * grain, text[:grain]))
+    disk = bytearray(capacity)
+    for offset, data in grains:
+        disk[offset:offset + len(data)] = data[:capacity - offset]
+    path = str(tmp_path / "disk.vmdk")
+    build_vmdk(path, capacity, grains)
+    return path, bytes(disk), capacity, grains
+
+
+def test_header_and_detection(stream, tmp_path):
+    path, disk, capacity, grains = stream
+    assert vmdk_stream.is_stream_optimized(path)
+    with open(path, "rb") as f:
+        header = vmdk_stream.read_header(f)
+    assert header['capacity'] == -(-capacity // sector) * sector
+    assert header['grain_size'] == grain_sectors * sector
+    other = tmp_path / "disk.raw"
+    other.write_bytes(bytes(4096))
+    assert not vmdk_stream.is_stream_optimized(str(other))
+
+
+def test_grains_skip_metadata_markers(stream):
+    path, disk, capacity, grains = stream
+    with open(path, "rb") as f:
+        read = [(offset, zlib.decompress(data)) for offset, data in vmdk_stream.grains(f)]
+    assert read == grains
+
+
+def test_to_raw_round_trip(stream, tmp_path, monkeypatch):
+    path, disk, capacity, grains = stream
+    monkeypatch.setattr(vmdk_stream, "batch_bytes", 64 * 1024)  # many batches, so the pool order matters
+    output = str(tmp_path / "disk.raw")
+    assert vmdk_stream.to_raw(path, output, processes=2) == capacity
+    assert open(output, "rb").read() == disk
+
+
+def test_extents_join_neighbouring_grains(stream):
+    path, disk, capacity, grains = stream
+    grain = grain_sectors * sector
+    with open(path, "rb") as f:
+        extents = [(offset, len(data)) for offset, data in vmdk_stream.extents(f, processes=1)]
+    assert extents == [(0, 2 * grain), (5 * grain, grain), (10 * grain, 20 * grain), (40 * grain, 3 * sector)]
+
+
+def test_stream_without_end_marker(tmp_path):
+    grain = grain_sectors * sector
+    data = os.urandom(grain)
+    path = str(tmp_path / "cut.vmdk")
+    build_vmdk(path, 2 * grain, [(grain, data)], end_marker=False)
+    output = str(tmp_path / "cut.raw")
+    vmdk_stream.to_raw(path, output, processes=1)
+    assert open(output, "rb").read() == bytes(grain) + data